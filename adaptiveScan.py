@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Adaptive scan which refines a 2D grid of points around the exclusion contour."""
+
+#The scan starts from a coarse seed grid in the plane defined by two parameters.
+#After each iteration, the points are triangulated (as done by plots/getContour) and the
+#triangles whose r-values straddle one of the target levels are split by adding a new point
+#at the middle of their longest edge. The iterations stop when the contours change by less
+#than the tolerance (in units of the normalized plane), when no triangle can be further
+#refined or when the maximum number of iterations is reached. Points without results
+#(failed runs) are kept in the triangulation, so they are not proposed again, but the
+#triangles with a failed vertex are not refined.
+#The SLHA files are generated from a template (see slhaGridGenerator) by setting the masses
+#and widths or replacing the lines defined in the [AdaptiveScan] section of the parameters file.
+
+import sys,os,time
+import csv
+import logging
+import numpy as np
+from matplotlib import tri
+from configParserWrapper import ConfigParserExt
+from slhaGridGenerator import SLHATemplate,getPointValues,writeSLHAFile
+from runCheckMateScan import runScan,setLogLevel
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'plots'))
+from getContour import getContour
+
+logger = logging.getLogger(__name__)
+
+
+class PlaneMap(object):
+    """
+    Map between the parameter plane and the unit square (used for triangulating
+    and measuring distances).
+
+    :param xRange: [min,max] values for the x parameter
+    :param yRange: [min,max] values for the y parameter
+    :param xLog: If True, use a log scale for x
+    :param yLog: If True, use a log scale for y
+    """
+
+    def __init__(self,xRange,yRange,xLog=False,yLog=False):
+
+        self.xLog = xLog
+        self.yLog = yLog
+        self.xRange = [self._tr(v,xLog) for v in xRange]
+        self.yRange = [self._tr(v,yLog) for v in yRange]
+
+    def _tr(self,v,log):
+        if log:
+            return np.log10(v)
+        return np.array(v,dtype=float)
+
+    def toUnit(self,x,y):
+        u = (self._tr(x,self.xLog)-self.xRange[0])/(self.xRange[1]-self.xRange[0])
+        v = (self._tr(y,self.yLog)-self.yRange[0])/(self.yRange[1]-self.yRange[0])
+        return u,v
+
+    def fromUnit(self,u,v):
+        x = self.xRange[0]+np.array(u)*(self.xRange[1]-self.xRange[0])
+        y = self.yRange[0]+np.array(v)*(self.yRange[1]-self.yRange[0])
+        if self.xLog:
+            x = 10**x
+        if self.yLog:
+            y = 10**y
+        return x,y
+
+
+def readRValues(resultsFile,names):
+    """
+    Read the r-values for the given points from the results table.
+    For points with several signal regions, the r-value for the signal region
+    with the largest expected r is used.
+
+    :param resultsFile: Path to the results table (see scanResults.ResultsTable)
+    :param names: Collection with the point names
+
+    :return: Dictionary with the point names as keys and r-values as values
+    """
+
+    best = {}
+    if not os.path.isfile(resultsFile):
+        return {}
+    with open(resultsFile,'r') as f:
+        for row in csv.DictReader(f):
+            if not row['name'] in names:
+                continue
+            try:
+                robs = float(row['robs'])
+                rexp = float(row.get('rexp') or robs)
+            except (KeyError,ValueError):
+                continue
+            if not row['name'] in best or rexp > best[row['name']][0]:
+                best[row['name']] = (rexp,robs)
+
+    return dict([(name,v[1]) for name,v in best.items()])
+
+def refinePoints(u,v,r,levels,minCellSize=0.01,maxNewPoints=50):
+    """
+    Find the triangles (from the Delaunay triangulation of the points) crossing
+    the contour levels and select the middle points of their longest edges as new points.
+
+    :param u: Array with the x-coordinates (in the unit square)
+    :param v: Array with the y-coordinates (in the unit square)
+    :param r: Array with the r-values (NaN for the points without results)
+    :param levels: List of contour levels
+    :param minCellSize: Triangles with the longest edge smaller than this are not refined
+    :param maxNewPoints: Maximum number of new points (the largest triangles are refined first)
+
+    :return: List of (u,v) coordinates for the new points
+    """
+
+    triang = tri.Triangulation(u,v)
+    existing = set(zip(np.round(u,9),np.round(v,9)))
+    candidates = {}
+    for triangle in triang.triangles:
+        rT = r[triangle]
+        if np.isnan(rT).any(): #Failed vertex
+            continue
+        if not any(min(rT) < level < max(rT) for level in levels):
+            continue
+        edges = [(triangle[i],triangle[(i+1)%3]) for i in range(3)]
+        lengths = [np.hypot(u[a]-u[b],v[a]-v[b]) for a,b in edges]
+        iMax = int(np.argmax(lengths))
+        if lengths[iMax] < minCellSize:
+            continue
+        a,b = edges[iMax]
+        newPt = (round((u[a]+u[b])/2.,9),round((v[a]+v[b])/2.,9))
+        if newPt in existing:
+            continue
+        candidates[newPt] = max(candidates.get(newPt,0.),lengths[iMax])
+
+    newPoints = sorted(candidates,key=lambda pt: candidates[pt],reverse=True)
+
+    return newPoints[:maxNewPoints]
+
+def contourDistance(contoursA,contoursB):
+    """
+    Compute the (symmetric Hausdorff) distance between two sets of contours.
+
+    :param contoursA: Dictionary with levels as keys and lists of arrays with contour points as values
+    :param contoursB: Dictionary with levels as keys and lists of arrays with contour points as values
+
+    :return: Largest distance over all levels (infinity if the contours for a level
+             are only present in one of the sets)
+    """
+
+    dist = 0.
+    for level in set(list(contoursA.keys())+list(contoursB.keys())):
+        ptsA = contoursA.get(level,[])
+        ptsB = contoursB.get(level,[])
+        if not ptsA and not ptsB:
+            continue
+        if not ptsA or not ptsB:
+            return np.inf
+        ptsA = np.concatenate(ptsA)
+        ptsB = np.concatenate(ptsB)
+        d = np.hypot(ptsA[:,None,0]-ptsB[None,:,0],ptsA[:,None,1]-ptsB[None,:,1])
+        dist = max(dist,d.min(axis=1).max(),d.min(axis=0).max())
+
+    return dist
+
+def main(parfile,verbose):
+    """
+    Run the adaptive scan defined in the [AdaptiveScan] section of the parameter file.
+
+    :param parfile: name of the parameter file.
+    :param verbose: level of debugging messages.
+    """
+
+    setLogLevel(verbose)
+
+    parser = ConfigParserExt()
+    ret = parser.read(parfile)
+    if ret == []:
+        logger.error( "No such file or directory: '%s'" % parfile)
+        sys.exit()
+    if not parser.has_section("AdaptiveScan"):
+        logger.error("The [AdaptiveScan] section must be defined in %s" %parfile)
+        sys.exit()
+
+    pars = parser.toDict(raw=False)["AdaptiveScan"]
+    xLabel,yLabel = pars['xParameter'],pars['yParameter']
+    levels = sorted(pars.get('levels',[1.0]))
+    tolerance = pars.get('tolerance',0.01)
+    planeMap = PlaneMap(pars['xRange'],pars['yRange'],
+                        xLog=pars.get('xLog',False),yLog=pars.get('yLog',False))
+    slhaFolder = os.path.abspath(pars['slhaFolder'])
+    if not os.path.isdir(slhaFolder):
+        os.makedirs(slhaFolder)
+    try:
+        template = SLHATemplate(pars['template'],masses=pars.get('masses',{}),widths=pars.get('widths',{}),
+                                replacements=pars.get('replacements',{}))
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit()
+
+    #Seed grid:
+    nx,ny = pars.get('seedPoints',[10,10])
+    uu,vv = np.meshgrid(np.linspace(0.,1.,nx),np.linspace(0.,1.,ny))
+    newPoints = list(zip(np.round(uu.ravel(),9),np.round(vv.ravel(),9)))
+
+    points = {}
+    rValues = {}
+    contours = None
+    for iteration in range(pars.get('maxIterations',5)):
+        t0 = time.time()
+        #Create SLHA files for the new points:
+        inputFiles = []
+        for u,v in newPoints:
+            x,y = planeMap.fromUnit(u,v)
+            values = {xLabel : float(x), yLabel : float(y)}
+            slhaFile = os.path.join(slhaFolder,pars['filename'] %values)
+            if not os.path.isfile(slhaFile):
+                writeSLHAFile(template,getPointValues(values,pars.get('derived',{})),slhaFile)
+            name = os.path.splitext(os.path.basename(slhaFile))[0]
+            points[name] = (u,v)
+            inputFiles.append(slhaFile)
+
+        logger.info("Iteration %i: running %i points" %(iteration,len(inputFiles)))
+        resultsFile = runScan(parser,inputFiles)
+        rValues.update(readRValues(resultsFile,points))
+        #All submitted points (the ones without results have NaN r-values):
+        u = np.array([points[name][0] for name in points])
+        v = np.array([points[name][1] for name in points])
+        r = np.array([rValues.get(name,np.nan) for name in points])
+        done = ~np.isnan(r)
+        if done.sum() < 3:
+            failed = [name for name in points if not name in rValues]
+            logger.error("Only %i points have results (the contours need at least 3). Failed points: %s"
+                         %(done.sum(),', '.join(failed)))
+            break
+
+        try:
+            newContours = getContour(u[done],v[done],r[done],levels)
+        except (ValueError,RuntimeError) as e: #E.g. all the points with results are collinear
+            logger.error("Could not compute the contours from %i points: %s" %(done.sum(),e))
+            break
+        if contours is not None:
+            dist = contourDistance(contours,newContours)
+        else:
+            dist = np.inf
+        contours = newContours
+        newPoints = refinePoints(u,v,r,levels,minCellSize=pars.get('minCellSize',0.01),
+                                 maxNewPoints=pars.get('maxNewPoints',50))
+        print("Iteration %i: %i points computed, contour change = %1.3g, %i new points (%3.2f min)"
+              %(iteration,done.sum(),dist,len(newPoints),(time.time()-t0)/60.))
+        if dist < tolerance:
+            logger.info("Contours converged")
+            break
+        if not newPoints:
+            logger.info("No more points to refine")
+            break
+
+    #Store the contours in the parameter plane:
+    if contours is None:
+        logger.warning("No contours were computed")
+    elif 'contourFile' in pars:
+        with open(pars['contourFile'],'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['level','segment',xLabel,yLabel])
+            for level,segments in sorted(contours.items()):
+                for iseg,seg in enumerate(segments):
+                    xs,ys = planeMap.fromUnit(seg[:,0],seg[:,1])
+                    for x,y in zip(xs,ys):
+                        writer.writerow([level,iseg,x,y])
+        print("Contours written to %s" %pars['contourFile'])
+
+    return contours
+
+
+if __name__ == "__main__":
+
+    import argparse
+    ap = argparse.ArgumentParser( description=
+            "Run CheckMATE over an adaptive grid of points refined around the exclusion contour." )
+    ap.add_argument('-p', '--parfile', default='checkmate_parameters.ini',
+            help='path to the parameters file (with an [AdaptiveScan] section). Default is checkmate_parameters.ini')
+    ap.add_argument('-v', '--verbose', default='error',
+            help='verbose level (debug, info, warning or error). Default is error')
+
+    args = ap.parse_args()
+
+    t0 = time.time()
+    main(args.parfile,args.verbose)
+
+    print("\n\nDone in %3.2f min" %((time.time()-t0)/60.))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the scan driver (scheduling, bookkeeping and I/O overheads) using a stub CheckMATE executable."""
+
+#For each grid size a set of synthetic SLHA files and a parameters file pointing
+#checkmateFolder to the stub (benchmarks/stubCheckMATE) are created and
+#runCheckMateScan.main is run in a new process. The stub sleeps and/or burns CPU for
+#the requested times (see stubCheckMATE/bin/CheckMATE), so the driver overheads can be
+#measured without running any simulation. The results are obtained from the job
+#metrics file written by the scan:
+#  jobs/s: number of points divided by the total wall time of the scan
+#  submission latency: time between the job submission and the start of the job in the worker
+#  overhead per job: core time not used by the jobs (ncpu*wall time - sum of job times)/number of jobs
+#  driver memory: peak RSS of the driver process (the worker and CheckMATE processes are not included)
+#  tail: time between 90% and 100% of the jobs completed
+#The results can be stored (-o) and compared to a previous run (-b) for regression tests.
+
+import os,sys,time
+import json
+import resource
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+stubFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)),'stubCheckMATE')
+
+#Template for the synthetic SLHA files (only the entries used by the scan):
+slhaTemplate = """BLOCK MASS
+   1000022     %(mN1)1.6e   # ~chi_10
+   1000024     %(mC1)1.6e   # ~chi_1+
+DECAY   1000022     0.00000000E+00   # ~chi_10
+DECAY   1000024     %(widthC1)1.6e   # ~chi_1+
+"""
+
+
+def createGrid(gridFolder,nPoints):
+    """
+    Create nPoints synthetic SLHA files with different chargino masses and widths
+    (existing files are reused).
+
+    :param gridFolder: Folder for the SLHA files
+    :param nPoints: Number of files
+
+    :return: Glob pattern for the files
+    """
+
+    if not os.path.isdir(gridFolder):
+        os.makedirs(gridFolder)
+    nX = int(np.ceil(np.sqrt(nPoints)))
+    for i in range(nPoints):
+        slhaFile = os.path.join(gridFolder,'point_%06i.slha' %i)
+        if os.path.isfile(slhaFile):
+            continue
+        mC1 = 100.+900.*(i % nX)/max(1,nX-1)
+        widthC1 = 10**(-17.+4.*(i // nX)/max(1,nX-1))
+        with open(slhaFile,'w') as f:
+            f.write(slhaTemplate %{'mC1' : mC1, 'mN1' : mC1-0.5, 'widthC1' : widthC1})
+
+    return os.path.join(gridFolder,'point_*.slha')
+
+def writeParameterFile(parFile,inputFiles,outputDir,ncpus,options={}):
+    """
+    Write the parameters file for the benchmark scan.
+
+    :param parFile: Path to the parameters file
+    :param inputFiles: Glob pattern for the SLHA files
+    :param outputDir: Scan output folder
+    :param ncpus: Number of cores
+    :param options: Dictionary with additional (or replacement) entries for the options section
+    """
+
+    pars = {'input' : inputFiles, 'checkmateFolder' : stubFolder,
+            'checkmatePython' : sys.executable, 'ncpu' : ncpus, 'resume' : False,
+            'maxRetries' : 0, 'logTailLines' : 5, 'cleanUp' : False,
+            'resultParameters' : {'mC1' : ('MASS',1000024), 'widthC1' : ('DECAY',1000024)}}
+    pars.update(options)
+    with open(parFile,'w') as f:
+        f.write("[options]\n")
+        for key,val in pars.items():
+            f.write("%s = %r\n" %(key,val))
+        f.write("\n[CheckMateParameters]\n")
+        f.write("Analyses = stub_analysis\n")
+        f.write("OutputExists = 'overwrite'\n")
+        f.write("OutputDirectory = %r\n" %outputDir)
+        f.write("TotalResultFileColumns: analysis,sr,robs,rexp,s,ds,eff,signalsumofweights,s95obs,robscons,rexpcons\n")
+        f.write("\n[CheckMateProcess1]\n")
+        f.write('Name = "C1C1"\n')
+        f.write('MGcommand = "import model MSSM_SLHA2\\n generate p p > x1+ x1-;"\n')
+        f.write("MGparam = ${CheckMateParameters:SLHAfile}\n")
+
+def runDriver(parFile,logFile,resultQueue):
+    """
+    Run the scan driver (in a new process) and send the wall time
+    and the peak memory of the driver to the queue.
+    """
+
+    import runCheckMateScan
+
+    #Redirect the driver (and worker) output to the log file:
+    fd = os.open(logFile,os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(fd,1)
+    os.dup2(fd,2)
+    t0 = time.time()
+    runCheckMateScan.main(parFile,'error')
+    sys.stdout.flush()
+    wallTime = time.time()-t0
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+    resultQueue.put({'startTime' : t0, 'wallTime' : wallTime, 'driverRSS' : maxRSS})
+
+def runBenchmark(nPoints,workDir,ncpus,options={}):
+    """
+    Run the scan over a synthetic grid and compute the benchmark quantities.
+
+    :param nPoints: Number of points
+    :param workDir: Folder for the grids and the scan outputs
+    :param ncpus: Number of cores
+    :param options: Dictionary with additional entries for the options section
+
+    :return: Dictionary with the benchmark results
+    """
+
+    workDir = os.path.abspath(workDir)
+    inputFiles = createGrid(os.path.join(workDir,'grid_%i' %nPoints),nPoints)
+    outputDir = os.path.join(workDir,'scan_%i' %nPoints)
+    parFile = os.path.join(workDir,'benchmark_%i.ini' %nPoints)
+    metricsFile = os.path.join(outputDir,'jobMetrics.jsonl')
+    if os.path.isfile(metricsFile):
+        os.remove(metricsFile)
+    writeParameterFile(parFile,inputFiles,outputDir,ncpus,options)
+
+    ctx = multiprocessing.get_context('spawn')
+    resultQueue = ctx.Queue()
+    driver = ctx.Process(target=runDriver,args=(parFile,os.path.join(workDir,'driver_%i.log' %nPoints),resultQueue))
+    driver.start()
+    driverResult = resultQueue.get()
+    driver.join()
+
+    with open(metricsFile,'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        raise RuntimeError("No job metrics found for %i points (see %s)" %(nPoints,os.path.join(workDir,'driver_%i.log' %nPoints)))
+    t0 = driverResult['startTime']
+    wallTime = driverResult['wallTime']
+    latency = np.array([e['startTime']-e['submitTime'] for e in entries if e.get('submitTime')])
+    endTimes = np.sort([e['endTime']-t0 for e in entries])
+    jobTime = sum([e['endTime']-e['startTime'] for e in entries])
+    result = {'points' : nPoints, 'ncpu' : ncpus, 'jobs' : len(entries),
+              'failed' : len([e for e in entries if e['status'] != 'finished']),
+              'wallTime' : wallTime, 'jobsPerSecond' : len(entries)/wallTime,
+              'firstSubmission' : min([e['submitTime'] for e in entries if e.get('submitTime')])-t0,
+              'latencyP50' : np.percentile(latency,50), 'latencyP99' : np.percentile(latency,99),
+              'overheadPerJob' : (ncpus*wallTime-jobTime)/max(1,len(entries)),
+              'driverRSS' : driverResult['driverRSS'],
+              'tail' : endTimes[-1]-endTimes[int(np.ceil(0.9*len(endTimes)))-1]}
+
+    return dict([(key,float(val)) for key,val in result.items()])
+
+def formatResults(results,baseline=None):
+    """
+    Format the benchmark results as a table (with the relative change with respect
+    to the baseline results, if given).
+    """
+
+    columns = [('points','points',8,'i'),('jobs/s','jobsPerSecond',9,'.2f'),('wall (s)','wallTime',9,'.1f'),
+               ('1st sub (s)','firstSubmission',12,'.2f'),('lat p50 (s)','latencyP50',12,'.3f'),
+               ('lat p99 (s)','latencyP99',12,'.3f'),('ovh/job (s)','overheadPerJob',12,'.3f'),
+               ('driver (MB)','driverRSS',12,'.1f'),('tail (s)','tail',9,'.2f'),('failed','failed',7,'i')]
+    lines = [" ".join(['%*s' %(width,label) for label,key,width,fmt in columns])]
+    for res in results:
+        lines.append(" ".join([('%*'+fmt) %(width,res[key]) for label,key,width,fmt in columns]))
+        if baseline and str(int(res['points'])) in baseline:
+            base = baseline[str(int(res['points']))]
+            changes = []
+            for label,key,width,fmt in columns[1:-1]:
+                if base.get(key):
+                    changes.append('%s %+1.0f%%' %(key,100.*(res[key]/base[key]-1.)))
+            lines.append("  vs baseline: "+", ".join(changes))
+
+    return "\n".join(lines)
+
+def main(sizes,workDir,ncpus,sleepTime,cpuTime,jitter,failFraction,options,outputFile,baselineFile,tolerance):
+    """
+    Run the benchmarks for all grid sizes.
+
+    :return: True if the throughput did not drop by more than the tolerance with respect to the baseline
+    """
+
+    os.environ['CHECKMATE_STUB_SLEEP'] = str(sleepTime)
+    os.environ['CHECKMATE_STUB_CPU'] = str(cpuTime)
+    os.environ['CHECKMATE_STUB_JITTER'] = str(jitter)
+    os.environ['CHECKMATE_STUB_FAIL'] = str(failFraction)
+
+    baseline = None
+    if baselineFile:
+        with open(baselineFile,'r') as f:
+            baseline = json.load(f)
+
+    results = []
+    for nPoints in sizes:
+        print("Running benchmark with %i points over %i cores" %(nPoints,ncpus))
+        results.append(runBenchmark(nPoints,workDir,ncpus,options))
+    print(formatResults(results,baseline))
+
+    if outputFile:
+        with open(outputFile,'w') as f:
+            json.dump(dict([(str(int(res['points'])),res) for res in results]),f,indent=1,sort_keys=True)
+        print("Benchmark results stored in %s" %outputFile)
+
+    passed = True
+    if baseline:
+        for res in results:
+            base = baseline.get(str(int(res['points'])))
+            if base and res['jobsPerSecond'] < (1.-tolerance)*base['jobsPerSecond']:
+                print("Throughput regression for %i points: %1.2f jobs/s (baseline %1.2f jobs/s)"
+                      %(res['points'],res['jobsPerSecond'],base['jobsPerSecond']))
+                passed = False
+
+    return passed
+
+
+if __name__ == "__main__":
+
+    import argparse
+    ap = argparse.ArgumentParser( description=
+            "Benchmark the scan driver over synthetic grids using a stub CheckMATE executable." )
+    ap.add_argument('-n', '--sizes', default=[100,1000], type=int, nargs='+',
+            help='number of points in each benchmark grid. Default is 100 1000')
+    ap.add_argument('-d', '--workdir', default='./benchmarkRuns',
+            help='folder for the grids and scan outputs. Default is ./benchmarkRuns')
+    ap.add_argument('-c', '--ncpu', default=multiprocessing.cpu_count(), type=int,
+            help='number of cores. Default is all cores')
+    ap.add_argument('-s', '--sleep', default=0., type=float,
+            help='wall time (in seconds) each stub run sleeps. Default is 0')
+    ap.add_argument('-u', '--cpu', default=0., type=float,
+            help='CPU time (in seconds) each stub run burns. Default is 0')
+    ap.add_argument('-j', '--jitter', default=0., type=float,
+            help='relative spread of the stub run times. Default is 0')
+    ap.add_argument('-f', '--fail', default=0., type=float,
+            help='fraction of the stub runs which fail. Default is 0')
+    ap.add_argument('-x', '--option', default=[], action='append',
+            help='additional scan option (key=value, with value a python expression). Can be repeated')
+    ap.add_argument('-o', '--output', default=None,
+            help='store the results in this JSON file')
+    ap.add_argument('-b', '--baseline', default=None,
+            help='compare the results to a previous run (JSON file written with -o)')
+    ap.add_argument('-t', '--tolerance', default=0.1, type=float,
+            help='maximum relative drop in jobs/s with respect to the baseline. Default is 0.1')
+
+    args = ap.parse_args()
+
+    options = {}
+    for opt in args.option:
+        key,val = opt.split('=',1)
+        options[key.strip()] = eval(val)
+
+    passed = main(args.sizes,args.workdir,args.ncpu,args.sleep,args.cpu,args.jitter,args.fail,
+                  options,args.output,args.baseline,args.tolerance)
+    if not passed:
+        sys.exit(1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""Fork server keeping the CheckMATE modules imported between points (see jobRunner.ForkServer)."""
+
+#Started by the scan workers with the CheckMATE python interpreter in the CheckMATE bin folder:
+#  python checkmateForkServer.py ./CheckMATE '["module1","module2"]'
+#The modules imported by the CheckMATE script (and the sys.path changes done before
+#them) plus the extra modules given are imported once. Then, for each request
+#(one JSON line in stdin with the steering card and the output file), a child process
+#is forked and runs the CheckMATE script with the modules already imported.
+#The request may also contain the CPUs the run is pinned to ("cpus") and
+#environment variables ("environ", e.g. the thread limits) set in the child.
+#The replies (JSON lines) are written to the original stdout:
+#  {"pid" : <child pid>} when the child is started
+#  {"returncode" : <code>, "maxRSS" : <MB>, "cpuUser" : <s>, "cpuSystem" : <s>, "writeBytes" : <bytes>}
+#  when the child finishes.
+#Each child runs in its own session, so it can be killed together with its subprocesses.
+#This file must run with python2 and python3.
+
+import os,sys
+import ast
+import json
+import runpy
+import traceback
+
+
+def changesPath(node):
+    """
+    Check if the statement uses sys.path (e.g. sys.path.append(...)).
+    """
+
+    for child in ast.walk(node):
+        if (isinstance(child,ast.Attribute) and child.attr == 'path'
+                and isinstance(child.value,ast.Name) and child.value.id == 'sys'):
+            return True
+
+    return False
+
+def preload(scriptFile,modules=[]):
+    """
+    Import the modules used by the CheckMATE script. Only the top-level import
+    statements and sys.path changes of the script are executed.
+
+    :param scriptFile: Path to the CheckMATE script
+    :param modules: List with the names of additional modules to be imported
+
+    :return: Number of statements executed without errors
+    """
+
+    scriptFile = os.path.abspath(scriptFile)
+    sys.path.insert(0,os.path.dirname(scriptFile))
+    with open(scriptFile,'r') as f:
+        tree = ast.parse(f.read(),scriptFile)
+    nodes = []
+    for node in tree.body:
+        if isinstance(node,(ast.Import,ast.ImportFrom)):
+            nodes.append(node)
+        elif isinstance(node,ast.Expr) and changesPath(node):
+            nodes.append(node)
+    namespace = {'__name__' : '__checkmate_preload__', '__file__' : scriptFile}
+    nOK = 0
+    for node in nodes:
+        module = ast.Module(body=[node])
+        module.type_ignores = []
+        try:
+            exec(compile(module,scriptFile,'exec'),namespace)
+            nOK += 1
+        except Exception as e:
+            sys.stderr.write("Could not preload line %i of %s: %s\n" %(node.lineno,scriptFile,e))
+    for name in modules:
+        try:
+            __import__(name)
+            nOK += 1
+        except Exception as e:
+            sys.stderr.write("Could not preload %s: %s\n" %(name,e))
+
+    return nOK
+
+def runChild(scriptFile,cardFile,outputFd,cpus=None,environ={}):
+    """
+    Run the CheckMATE script in the forked child (never returns).
+    """
+
+    code = 1
+    try:
+        os.setsid()
+        if cpus and hasattr(os,'sched_setaffinity'):
+            os.sched_setaffinity(0,cpus)
+        os.environ.update(environ)
+        devNull = os.open(os.devnull,os.O_RDONLY)
+        os.dup2(devNull,0)
+        os.dup2(outputFd,1)
+        os.dup2(outputFd,2)
+        sys.argv = [scriptFile,cardFile]
+        runpy.run_path(scriptFile,run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code,int):
+            code = e.code
+        else:
+            sys.stderr.write("%s\n" %e.code)
+    except BaseException:
+        traceback.print_exc()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def main(scriptFile,modules):
+
+    #Keep the original stdout for the replies and send everything else to stderr:
+    replies = os.fdopen(os.dup(1),'w')
+    os.dup2(2,1)
+
+    def reply(message):
+        replies.write(json.dumps(message)+'\n')
+        replies.flush()
+
+    reply({'ready' : True, 'preloaded' : preload(scriptFile,modules)})
+    for line in iter(sys.stdin.readline,''):
+        request = json.loads(line)
+        if request.get('exit'):
+            break
+        try:
+            outputFd = os.open(request['output'],os.O_WRONLY)
+        except OSError as e:
+            reply({'error' : str(e)})
+            continue
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            replies.close()
+            runChild(scriptFile,request['card'],outputFd,request.get('cpus'),request.get('environ',{}))
+        os.close(outputFd)
+        reply({'pid' : pid})
+        pid,status,usage = os.wait4(pid,0)
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        reply({'returncode' : returncode, 'maxRSS' : usage.ru_maxrss/1024.,
+               'cpuUser' : usage.ru_utime, 'cpuSystem' : usage.ru_stime,
+               'writeBytes' : usage.ru_oublock*512})
+
+
+if __name__ == "__main__":
+
+    modules = []
+    if len(sys.argv) > 2:
+        modules = json.loads(sys.argv[2])
+    main(sys.argv[1],modules)
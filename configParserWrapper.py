@@ -3,10 +3,20 @@
 #A wrapper for ConfigParser which allows to evaluate expressions
 #in the parameters. The expressions should be of the type ${expr}.
 #References for other parameters in the parser should be in the format section:parameter.
+#The raw values are compiled once into templates (literal text and references) and
+#the evaluated value of each option is cached. The options referenced by each value
+#are stored, so setting an option only invalidates the values which depend on it.
+#Cloned parsers share the cached values, making the per-point parsers cheap to create.
+#The values are evaluated as python expressions restricted to literals, arithmetic,
+#comparisons, comprehensions and the math and numpy functions (see compileExpression). Values which
+#are not expressions (e.g. unquoted names) are kept as strings. Use validate() to find
+#invalid expressions and undefined references before running.
 
 
-from math import *
+import math
+import ast
 import re, itertools, tempfile, random
+import copy
 import numpy
 import logging
 logger = logging.getLogger("ufo2slha")
@@ -16,16 +26,267 @@ try:
 except:
     from configparser import RawConfigParser,InterpolationDepthError,ParsingError
 
+#Matches ${section:option} and ${option}:
+referencePattern = re.compile(r'\$\{(\w*):(\w*)\}|\$\{([^{}]+)\}')
+immutableTypes = (str,int,float,bool,complex,type(None))
+
+#Templates and compiled expressions shared by all parsers (keyed by the raw and the interpolated values):
+_templateCache = {}
+_codeCache = {}
+maxCacheSize = 100000
+
+
+def getTemplate(valueRaw):
+    """
+    Split a raw value into literal strings and references.
+
+    :param valueRaw: Raw option value
+
+    :return: List with strings and (section,option,text) tuples (section is None for options in the same section)
+    """
+
+    if valueRaw in _templateCache:
+        return _templateCache[valueRaw]
+    template = []
+    pos = 0
+    for match in referencePattern.finditer(valueRaw):
+        if match.start() > pos:
+            template.append(valueRaw[pos:match.start()])
+        if match.group(3) is None:
+            template.append((match.group(1),match.group(2),match.group(0)))
+        else:
+            template.append((None,match.group(3),match.group(0)))
+        pos = match.end()
+    if pos < len(valueRaw):
+        template.append(valueRaw[pos:])
+    if len(_templateCache) > maxCacheSize:
+        _templateCache.clear()
+    _templateCache[valueRaw] = template
+
+    return template
+
+def stripComment(valueRaw):
+    """
+    Remove the inline comment (starting with a # outside quotes) from a raw value.
+    """
+
+    quote = None
+    for i,c in enumerate(valueRaw):
+        if quote:
+            if c == quote and valueRaw[i-1] != '\\':
+                quote = None
+        elif c in ('"',"'"):
+            quote = c
+        elif c == '#':
+            return valueRaw[:i].rstrip()
+
+    return valueRaw
+
+#Names allowed in the expressions:
+safeNames = dict([(name,getattr(math,name)) for name in dir(math) if not name.startswith('_')])
+safeNames.update({'math' : math, 'numpy' : numpy, 'np' : numpy, 'True' : True, 'False' : False, 'None' : None})
+for name in ['abs','min','max','round','int','float','str','bool','complex','len','range','list',
+             'tuple','dict','set','sum','pow','sorted','zip','enumerate']:
+    safeNames[name] = __builtins__[name] if isinstance(__builtins__,dict) else getattr(__builtins__,name)
+safeGlobals = dict(safeNames)
+safeGlobals['__builtins__'] = {}
+#Numpy attributes allowed (besides the ufuncs):
+numpyNames = ['array','linspace','logspace','geomspace','arange','pi','e','inf','nan','sum','prod',
+              'mean','median','std','round','around','clip','diff','cumsum','interp','where',
+              'zeros','ones','full','concatenate','unique','sort','amin','amax']
+allowedNodes = tuple([getattr(ast,name) for name in ['Expression','Constant','Num','Str','Bytes','NameConstant',
+                                                     'BinOp','UnaryOp','BoolOp','Compare','IfExp','Call','keyword',
+                                                     'Name','Attribute','List','Tuple','Dict','Set','Subscript',
+                                                     'Index','Slice','ExtSlice','Ellipsis',
+                                                     'ListComp','SetComp','DictComp','GeneratorExp','comprehension',
+                                                     'operator','unaryop','cmpop','boolop','expr_context']
+                      if hasattr(ast,name)])
+
+def checkExpression(tree,names=()):
+    """
+    Check that the expression only uses the allowed operations, functions and names.
+
+    :param tree: Parsed expression (ast.Expression)
+    :param names: Additional names allowed in the expression
+
+    :return: None if the expression is allowed, True if it uses undefined names
+             (it is then not an expression, but a string) or the error message
+    """
+
+    #The comprehension targets are local names:
+    names = set(names)
+    for node in ast.walk(tree):
+        if isinstance(node,ast.comprehension):
+            names.update([n.id for n in ast.walk(node.target) if isinstance(n,ast.Name)])
+    undefined = False
+    for node in ast.walk(tree):
+        if not isinstance(node,allowedNodes):
+            return "%s is not allowed" %type(node).__name__
+        if isinstance(node,ast.Call):
+            if isinstance(node.func,ast.Name):
+                if not node.func.id in safeNames and not node.func.id in names:
+                    return "unknown function %s" %node.func.id
+            elif not isinstance(node.func,ast.Attribute):
+                return "only named functions can be called"
+        elif isinstance(node,ast.Attribute):
+            if not isinstance(node.value,ast.Name):
+                return "attribute %s is not allowed" %node.attr
+            if node.value.id in ('numpy','np'):
+                attr = getattr(numpy,node.attr,None)
+                if not node.attr in numpyNames and not isinstance(attr,numpy.ufunc):
+                    return "numpy.%s is not allowed" %node.attr
+            elif node.value.id == 'math':
+                if not node.attr in safeNames:
+                    return "math.%s is not allowed" %node.attr
+            elif node.value.id in safeNames or node.value.id in names:
+                return "attribute %s is not allowed" %node.attr
+            else:
+                undefined = True
+        elif isinstance(node,ast.Name):
+            if not node.id in safeNames and not node.id in names:
+                undefined = True
+
+    if undefined:
+        return True
+
+    return None
+
+def compileExpression(expr,names=()):
+    """
+    Parse the expression, check it (see checkExpression) and compile it for evaluation.
+    The results are cached.
+
+    :param expr: String with the expression
+    :param names: Additional names allowed in the expression (passed to the evaluation)
+
+    :return: Tuple with the code object (None if the string is not an allowed expression)
+             and the error message (None if it is valid or is not meant as an expression)
+    """
+
+    key = (expr,tuple(names))
+    if key in _codeCache:
+        return _codeCache[key]
+    code,error = None,None
+    try:
+        tree = ast.parse(expr.strip(),'<config>','eval')
+        check = checkExpression(tree,names)
+        if check is None:
+            code = compile(tree,'<config>','eval')
+        elif check is not True:
+            error = check
+    except (SyntaxError,ValueError,TypeError) as e:
+        #Only report strings which look like expressions:
+        if expr.strip()[:1] in ('[','(','{'):
+            error = "syntax error (%s)" %e
+    if len(_codeCache) > maxCacheSize:
+        _codeCache.clear()
+    _codeCache[key] = (code,error)
+
+    return code,error
+
+def evaluateExpression(expr,names={}):
+    """
+    Evaluate an expression (see compileExpression).
+
+    :param expr: String with the expression
+    :param names: Dictionary with additional names and their values
+
+    :return: Value of the expression
+
+    :raises ValueError: if the string is not an allowed expression
+    """
+
+    code,error = compileExpression(expr,sorted(names.keys()))
+    if code is None:
+        raise ValueError("Invalid expression %s: %s" %(expr,error or "undefined names"))
+    if names:
+        namespace = dict(safeGlobals)
+        namespace.update(names)
+        return eval(code,namespace)
+
+    return eval(code,safeGlobals)
+
 
 class ConfigParserExt(RawConfigParser):
     
     
     def __init__(self,*args,**kargs):
+        self._values = {}
+        self._dependents = {}
+        self._evaluating = set()
         RawConfigParser.__init__(self,*args,**kargs)
         self.cur_depth = 0
         self.MAX_INTERPOLATION_DEPTH=100
         self.optionxform=str    #Preserve string cases    
 
+    def clearCache(self):
+        """
+        Remove all the cached values.
+        """
+
+        self._values = {}
+        self._dependents = {}
+
+    def invalidate(self,section,option):
+        """
+        Remove the cached value for the option and for all the options depending on it.
+        """
+
+        keys = [(section,option)]
+        done = set()
+        while keys:
+            key = keys.pop()
+            if key in done:
+                continue
+            done.add(key)
+            self._values.pop(key,None)
+            keys += list(self._dependents.get(key,[]))
+
+    def set(self, section, option, value=None):
+
+        RawConfigParser.set(self, section, option, value)
+        self.invalidate(section,self.optionxform(option))
+
+    def remove_option(self, section, option):
+
+        removed = RawConfigParser.remove_option(self, section, option)
+        self.invalidate(section,self.optionxform(option))
+
+        return removed
+
+    def add_section(self, section):
+
+        RawConfigParser.add_section(self, section)
+        self.clearCache()
+
+    def remove_section(self, section):
+
+        removed = RawConfigParser.remove_section(self, section)
+        self.clearCache()
+
+        return removed
+
+    def _read(self, *args, **kargs):
+
+        RawConfigParser._read(self, *args, **kargs)
+        self.clearCache()
+
+    def clone(self):
+        """
+        Create a copy of the parser (sharing the cached values).
+
+        :return: ConfigParserExt object
+        """
+
+        newParser = ConfigParserExt()
+        for section in self.sections():
+            RawConfigParser.add_section(newParser,section)
+            newParser._sections[section].update(self._sections[section])
+        newParser._values = dict(self._values)
+        newParser._dependents = dict([(key,set(deps)) for key,deps in self._dependents.items()])
+
+        return newParser
+
     def toDict(self,raw=True):
         """
         Convert parser to dictionary.
@@ -66,72 +327,138 @@ class ConfigParserExt(RawConfigParser):
         if raw:            
             return valueRaw
 
-        self.cur_depth = current_depth
+        key = (section,option)
+        if not key in self._values:
+            #Avoid infinite loops (options referencing each other):
+            if key in self._evaluating or len(self._evaluating) >= self.MAX_INTERPOLATION_DEPTH:
+                raise InterpolationDepthError(option, section, valueRaw)
+            self._evaluating.add(key)
+            try:
+                self._values[key] = self.evaluate(section,option,valueRaw)
+            finally:
+                self._evaluating.discard(key)
+        value = self._values[key]
+        #Do not let the caller modify the cached value:
+        if not isinstance(value,immutableTypes):
+            value = copy.deepcopy(value)
+
+        return value
+
+    def interpolate(self, section, option, valueRaw):
+        """
+        Replace the references to other options by their values.
+        The references are registered as dependencies of the option.
+
+        :return: String with the interpolated value
+        """
 
-        #Find all instances of ${(alphanumeric characters):(alphanumeric characters)}
         ret = valueRaw
-        varSectOpts = re.findall(r'\$\{(\w*):(\w*)\}',ret)
-        if varSectOpts:
-            for v_section, v_option in varSectOpts:
-                self.cur_depth = self.cur_depth + 1
-                #Skip matches which do not correspond to any section
-                if not v_section in self.sections():
+        template = getTemplate(valueRaw)
+        if len(template) != 1 or not isinstance(template[0],str):
+            pieces = []
+            for piece in template:
+                if isinstance(piece,str):
+                    pieces.append(piece)
                     continue
-                #Skip matches which do not correspond to any option
-                if not v_option in self.options(v_section):
+                v_section,v_option,text = piece
+                if v_section is None:
+                    v_section = section
+                #Changes to the referenced option (even if it does not exist yet) change this value:
+                self._dependents.setdefault((v_section,v_option),set()).add((section,option))
+                #Skip matches which do not correspond to any section or option
+                if not self.has_section(v_section) or not self.has_option(v_section,v_option):
+                    pieces.append(text)
                     continue
-                
-                #Try to get the value for the corresponding section/option
-                #(avoid infinite loops with interpolation depth:            
-                self.cur_depth = self.cur_depth + 1 
-                if self.cur_depth < self.MAX_INTERPOLATION_DEPTH:
-                    sub = self.get(v_section, v_option, current_depth=self.cur_depth)
-                    #Replace all instances of (section):(option)
-                    ret = re.sub(r'\$\{%s:%s\}' %(v_section, v_option), str(sub),ret)
-                else:
-                    raise InterpolationDepthError(option, section, valueRaw)
-                
-        #Now try to get all variables from the same section:
-        for v_option in self.options(section):            
-            #Check if the option appears in the string surrounded by any non-alphanumeric character
-            #or the beginning of the expression or end of the expression
-            if re.findall(r'\$\{%s\}'%v_option,ret):
-                self.cur_depth = self.cur_depth + 1 
-                if self.cur_depth < self.MAX_INTERPOLATION_DEPTH:
-                    sub = self.get(section, v_option, current_depth=self.cur_depth)
-                    #Replaces the correct instances:
-                    ret = re.sub(r'\$\{%s\}' %v_option, str(sub),ret)
-                else:
-                    raise InterpolationDepthError(option, section, valueRaw)
-        
-        
+                pieces.append(str(self.get(v_section,v_option)))
+            ret = ''.join(pieces)
+
+        return ret
+
+    def evaluate(self, section, option, valueRaw):
+        """
+        Interpolate the value and evaluate the expression
+        (if it is not a valid expression, the string is returned).
+        """
+
+        ret = self.interpolate(section,option,valueRaw)
+        code,_ = compileExpression(ret)
+        if code is None:
+            return ret
         try:
-            return eval(ret)
-        except:
+            return eval(code,safeGlobals)
+        except Exception:
             return ret
 
+    def checkOption(self, section, option):
+        """
+        Check if the option value can be evaluated.
+
+        :return: List of error messages (empty if no problems were found)
+        """
+
+        problems = []
+        valueRaw = self.get(section,option,raw=True)
+        for piece in getTemplate(valueRaw):
+            if isinstance(piece,str):
+                continue
+            v_section,v_option,text = piece
+            if not self.has_section(v_section or section) or not self.has_option(v_section or section,v_option):
+                problems.append("%s refers to an undefined option" %text)
+        try:
+            self.get(section,option)
+        except InterpolationDepthError:
+            return problems+["circular reference"]
+        ret = self.interpolate(section,option,valueRaw)
+        code,error = compileExpression(ret)
+        if error:
+            problems.append("invalid expression %s: %s" %(ret.strip(),error))
+        elif code is not None:
+            try:
+                eval(code,safeGlobals)
+            except Exception as e:
+                problems.append("could not evaluate %s (%s: %s)" %(ret.strip(),type(e).__name__,e))
+
+        return problems
+
+    def validate(self):
+        """
+        Check all the values: the references to other options must be defined and
+        the expressions must be valid and evaluate without errors. The loop options
+        are checked with the first value of each loop.
+
+        :return: List of error messages (empty if no problems were found)
+        """
+
+        try:
+            _,parser = next(self.iterLoops())
+        except ParsingError as e:
+            return [str(e)]
+        problems = []
+        for section in parser.sections():
+            for option in parser.options(section):
+                problems += ["%s:%s: %s" %(section,option,p) for p in parser.checkOption(section,option)]
+
+        return problems
+
         
     def getstr(self,*args,**kargs):
         
         return str(self.get(*args,**kargs))
     
     
-    def expandLoops(self):
+    def getLoops(self):
         """
-        If one or more options have the tag $loop{}, it will
-        generate new parsers for product of all values in the loop.
-        E.g. if option1 = $loop{[100,200]} and option2 = $loop{['a','b']},
-        it will generate parsers with option1,option2 = (100,'a'), (100,'b'), (200,'a') and (200,'b')
-        
-        :return: List of parsers with the options set to the respective value defined by the loop
+        Collect the options with the tag $loop{} and evaluate their values.
+
+        :return: List of (section,option) tuples and list with the values for each of them
         """
-        
+
         loopVars = []
         varValues = []
-        #Collect all loop options
         for section in self.sections():
             for option in self.options(section):
-                ret = self.get(section,option,raw=True)
+                #Loop tags in inline comments are ignored:
+                ret = stripComment(self.get(section,option,raw=True))
                 varSectLoop = re.findall(r'\$loop\{(.*)\}',ret)
                 if not varSectLoop:
                     continue
@@ -139,28 +466,62 @@ class ConfigParserExt(RawConfigParser):
                     raise ParsingError("Syntax error. Multiple loops found for option %s." %option)
                 loopStr = varSectLoop[0]
                 try:
-                    varList = eval(loopStr)
-                except:
+                    varList = evaluateExpression(loopStr)
+                except Exception:
                     raise ParsingError("Could not evaluate loop %s" %loopStr)
                 if not isinstance(varList,(list,numpy.ndarray,tuple)):
                     raise ParsingError("Loop expression %s did not generate a list" %loopStr)
                 loopVars.append((section,option))
                 varValues.append(varList)
-                
+
+        return loopVars,varValues
+
+    def countLoops(self):
+        """
+        Number of parsers generated by expandLoops (or iterLoops).
+        """
+
+        nParsers = 1
+        for varList in self.getLoops()[1]:
+            nParsers *= len(varList)
+
+        return nParsers
+
+    def iterLoops(self):
+        """
+        Generator version of expandLoops. The parsers are only created when
+        requested, so the number of loop points is not limited by the memory.
+        Each parser is a clone of this one (sharing the cached values), with the
+        loop options set.
+
+        :return: Generator over (loop index, parser). The loop index is the position of
+                 the parser in the product of the loop values (None if there are no loops).
+        """
+
+        loopVars,varValues = self.getLoops()
         if not loopVars:
-            return [self]
+            yield None,self
+            return
 
         logger.info(" Looping over variables:  " + ", ".join(["%s:%s" %lvar for lvar in loopVars]))
-        parserList = []
-        for values in itertools.product(*varValues):
-            newParser = ConfigParserExt()
-            newParser.read_dict(self.toDict(raw=True))
+        for iLoop,values in enumerate(itertools.product(*varValues)):
+            newParser = self.clone()
             for i,v in enumerate(values):
                 sect,opt = loopVars[i]   
                 newParser.set(sect,opt,str(v))
-            parserList.append(newParser)
-            
-        return parserList
+            yield iLoop,newParser
+
+    def expandLoops(self):
+        """
+        If one or more options have the tag $loop{}, it will
+        generate new parsers for product of all values in the loop.
+        E.g. if option1 = $loop{[100,200]} and option2 = $loop{['a','b']},
+        it will generate parsers with option1,option2 = (100,'a'), (100,'b'), (200,'a') and (200,'b')
+        
+        :return: List of parsers with the options set to the respective value defined by the loop
+        """
+        
+        return [newParser for _,newParser in self.iterLoops()]
 
 if __name__ == "__main__":
     
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""Runtime estimates for the scan points, used to order the job submission (longest first)."""
+
+#The runtime of a point is modelled as:
+#  t = nProcesses * exp(c0 + sum_i c_i*log(p_i))
+#where p_i are the point parameters (e.g. masses and widths, see the costParameters option).
+#The coefficients are fitted (least squares with a small ridge term pulling them towards
+#the prior) to the timings of the finished points stored in the scan ledger. The prior
+#assumes the runtime grows linearly with the masses (massExponent) and does not depend
+#on the widths. If there are not enough timings for the fit, the prior coefficients are
+#used with the average cost per process and, without any timings, with the default time
+#for masses equal to referenceMass. Points already in the ledger use their own previous timing.
+
+import os
+import heapq
+import logging
+import numpy as np
+from slhaTools import readMassesAndWidths
+
+logger = logging.getLogger(__name__)
+
+
+def getCostFeatures(slhaFile,parameters):
+    """
+    Compute the features used by the cost model for a point.
+
+    :param slhaFile: Path to the SLHA file
+    :param parameters: Dictionary with labels as keys and (block,pdg) as values
+                       (e.g. {'mC1' : ('MASS',1000024)})
+
+    :return: Array with the log of the absolute parameter values (or None if the file can not be read)
+    """
+
+    if not parameters:
+        return np.array([])
+    try:
+        masses,widths = readMassesAndWidths(slhaFile)
+    except (IOError,OSError,ValueError):
+        return None
+    features = []
+    for label in sorted(parameters):
+        block,pdg = parameters[label]
+        if block.upper() == 'MASS':
+            value = masses.get(pdg)
+        else:
+            value = widths.get(pdg)
+        if value is None:
+            return None
+        features.append(np.log(max(abs(value),1e-300)))
+
+    return np.array(features)
+
+
+class CostModel(object):
+    """
+    Model for the expected runtime of the points.
+
+    :param parameters: Dictionary with labels as keys and (block,pdg) as values defining
+                       the parameters used for the estimate. If None, all points in
+                       the same scan are assumed to have the same cost.
+    :param nProcesses: Number of CheckMATE processes for each point
+    :param defaultTime: Runtime (in seconds) assumed for each process if there are no timings
+                        (for masses equal to referenceMass)
+    :param ridge: Regularization for the fit of the coefficients
+    :param massExponent: Prior for the exponent of the masses (runtime ~ mass^massExponent)
+    :param referenceMass: Mass (in GeV) for which the runtime is defaultTime if there are no timings
+    """
+
+    def __init__(self,parameters=None,nProcesses=1,defaultTime=600.,ridge=1e-3,
+                 massExponent=1.,referenceMass=1000.):
+
+        self.parameters = parameters
+        self.nProcesses = max(1,nProcesses)
+        self.defaultTime = float(defaultTime)
+        self.ridge = ridge
+        self.timings = {}
+        self.features = []
+        self.logCosts = []
+        self.meanLogCost = np.log(self.defaultTime)
+        #Prior coefficients and center (features for referenceMass) in the order of getCostFeatures:
+        isMass = [parameters[label][0].upper() == 'MASS' for label in sorted(parameters or {})]
+        self.prior = np.array([massExponent if m else 0. for m in isMass])
+        self.center = np.array([np.log(referenceMass) if m else 0. for m in isMass])
+        self.coeffs = np.concatenate([[self.meanLogCost],self.prior])
+
+    def addTimings(self,ledger):
+        """
+        Add the timings of the finished points stored in the ledger.
+
+        :param ledger: ScanLedger object
+        """
+
+        for name,entry in ledger.entries.items():
+            if entry['status'] != 'finished' or not entry['startTime'] or not entry['endTime']:
+                continue
+            runtime = entry['endTime']-entry['startTime']
+            if runtime <= 0.:
+                continue
+            self.timings[name] = runtime
+            if not entry['slhaFile'] or not os.path.isfile(entry['slhaFile']):
+                continue
+            features = getCostFeatures(entry['slhaFile'],self.parameters)
+            if features is None:
+                continue
+            self.features.append(features)
+            self.logCosts.append(np.log(runtime/self.nProcesses))
+
+    def fit(self):
+        """
+        Fit the model coefficients to the timings.
+        """
+
+        if not self.logCosts:
+            logger.info("No timings available, using a default time of %1.0f s per process" %self.defaultTime)
+            return
+        y = np.array(self.logCosts)
+        self.meanLogCost = y.mean()
+        X = np.column_stack([np.ones(len(y)),np.array(self.features)])
+        #Center the features, so the ridge term does not bias the intercept:
+        self.center = X[:,1:].mean(axis=0)
+        X[:,1:] -= self.center
+        self.coeffs = np.concatenate([[self.meanLogCost],self.prior])
+        nFeatures = len(self.prior)
+        if nFeatures == 0 or len(y) < nFeatures+2:
+            return
+        reg = self.ridge*len(y)*np.eye(X.shape[1])
+        reg[0,0] = 0.
+        self.coeffs = np.linalg.solve(X.T.dot(X)+reg,X.T.dot(y)+reg.dot(np.concatenate([[0.],self.prior])))
+        logger.info("Cost model fitted to %i timings" %len(y))
+
+    def estimate(self,name,slhaFile):
+        """
+        Estimate the runtime for a point.
+
+        :param name: Point name
+        :param slhaFile: Path to the SLHA file
+
+        :return: Expected runtime (in seconds)
+        """
+
+        if name in self.timings:
+            return self.timings[name]
+        features = getCostFeatures(slhaFile,self.parameters)
+        if features is not None:
+            logCost = self.coeffs[0]+np.dot(self.coeffs[1:],features-self.center)
+            return self.nProcesses*np.exp(logCost)
+
+        return self.nProcesses*np.exp(self.meanLogCost)
+
+
+def getMakespan(costs,ncpus):
+    """
+    Compute the expected total time for running the jobs (in the given order)
+    on ncpus cores, with each job starting on the first free core.
+
+    :param costs: List of job runtimes (in submission order)
+    :param ncpus: Number of cores
+
+    :return: Expected makespan
+    """
+
+    cores = [0.]*max(1,ncpus)
+    for cost in costs:
+        heapq.heappush(cores,heapq.heappop(cores)+cost)
+
+    return max(cores)
+
+def orderJobs(costs):
+    """
+    Get the longest-processing-time-first order for the jobs.
+
+    :param costs: List of job runtimes
+
+    :return: List of job indices sorted by decreasing runtime
+    """
+
+    return sorted(range(len(costs)),key = lambda i: costs[i],reverse=True)
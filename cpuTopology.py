@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""CPU topology, core pinning and memory-based limits for the number of simultaneous jobs."""
+
+#The available cores (the affinity of this process) are split into one core set per
+#job slot, keeping each set inside a NUMA node when possible. A job takes the first
+#free slot, pins itself to the slot cores and caps the number of threads used by its
+#child processes (OpenMP, BLAS and MadGraph) to the size of the set.
+#Each core has its own lock file (locked with flock, so it is released even if the
+#worker dies) in a node-local folder and a slot is free only if all its cores can be
+#locked. Scans using a different number of slots (and so different core sets) on the
+#same node therefore never share cores.
+
+import os
+import re
+import glob
+import fcntl
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Core slots used by this process (see getCoreSlots):
+_coreSlots = {}
+
+#Environment variables limiting the number of threads used by the libraries:
+threadVariables = ['OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS','NUMEXPR_NUM_THREADS']
+
+
+def parseCPUList(cpuList):
+    """
+    Parse a CPU list in the kernel format (e.g. '0-3,8,10-11').
+
+    :return: List of CPU indices
+    """
+
+    cpus = []
+    for item in cpuList.strip().split(','):
+        if not item:
+            continue
+        if '-' in item:
+            first,last = item.split('-')
+            cpus += list(range(int(first),int(last)+1))
+        else:
+            cpus.append(int(item))
+
+    return cpus
+
+def getAvailableCPUs():
+    """
+    Get the CPUs this process is allowed to run on.
+    """
+
+    if hasattr(os,'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+def getNUMANodes(cpus=None):
+    """
+    Get the available CPUs in each NUMA node.
+
+    :param cpus: List of available CPUs (default is getAvailableCPUs())
+
+    :return: List with the CPUs in each node (a single node if the topology is not available)
+    """
+
+    if cpus is None:
+        cpus = getAvailableCPUs()
+    nodes = []
+    for nodeDir in sorted(glob.glob('/sys/devices/system/node/node[0-9]*'),
+                          key = lambda d: int(re.sub(r'\D','',os.path.basename(d)))):
+        try:
+            with open(os.path.join(nodeDir,'cpulist'),'r') as f:
+                nodeCPUs = [c for c in parseCPUList(f.read()) if c in cpus]
+        except (IOError,OSError,ValueError):
+            continue
+        if nodeCPUs:
+            nodes.append(nodeCPUs)
+    if sum([len(n) for n in nodes]) != len(cpus):
+        return [list(cpus)]
+
+    return nodes
+
+def getCoreSets(nSlots,cpus=None):
+    """
+    Split the available CPUs into core sets for nSlots simultaneous jobs.
+    The slots are distributed over the NUMA nodes according to their size and
+    the sets do not cross node boundaries (unless there are more slots than CPUs,
+    in which case the sets have a single, shared CPU).
+
+    :param nSlots: Number of job slots
+    :param cpus: List of available CPUs (default is getAvailableCPUs())
+
+    :return: List of core sets (lists of CPU indices)
+    """
+
+    if cpus is None:
+        cpus = getAvailableCPUs()
+    nSlots = max(1,int(nSlots))
+    if nSlots >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(nSlots)]
+    nodes = getNUMANodes(cpus)
+    #Number of slots in each node (largest remainder):
+    shares = [nSlots*len(node)/float(len(cpus)) for node in nodes]
+    nodeSlots = [int(s) for s in shares]
+    for i in sorted(range(len(nodes)),key = lambda i: shares[i]-nodeSlots[i],reverse=True):
+        if sum(nodeSlots) >= nSlots:
+            break
+        nodeSlots[i] += 1
+    coreSets = []
+    for node,n in zip(nodes,nodeSlots):
+        if not n:
+            continue
+        n = min(n,len(node))
+        size = len(node)//n
+        for i in range(n):
+            coreSets.append(node[i*size:(i+1)*size])
+
+    return coreSets
+
+def getThreadEnvironment(nThreads):
+    """
+    Environment variables capping the number of threads.
+    """
+
+    return dict([(var,str(max(1,int(nThreads)))) for var in threadVariables])
+
+def pinProcess(cores):
+    """
+    Pin this process (and the processes it starts) to the cores and cap
+    the number of threads to the number of cores.
+
+    :param cores: List of CPU indices
+
+    :return: Dictionary with the previous affinity and thread variables (see restoreProcess)
+    """
+
+    state = {'affinity' : None, 'environ' : dict([(var,os.environ.get(var)) for var in threadVariables])}
+    if hasattr(os,'sched_setaffinity'):
+        state['affinity'] = os.sched_getaffinity(0)
+        try:
+            os.sched_setaffinity(0,cores)
+        except OSError as e:
+            logger.warning("Could not pin process to cores %s: %s" %(cores,e))
+    os.environ.update(getThreadEnvironment(len(cores)))
+
+    return state
+
+def restoreProcess(state):
+    """
+    Restore the affinity and thread variables changed by pinProcess.
+    """
+
+    if state['affinity'] is not None:
+        os.sched_setaffinity(0,state['affinity'])
+    for var,val in state['environ'].items():
+        if val is None:
+            os.environ.pop(var,None)
+        else:
+            os.environ[var] = val
+
+def readMemoryMB():
+    """
+    Read the total and available memory.
+
+    :return: Tuple with the total and available memory (in MB) or (None,None) if not available
+    """
+
+    memInfo = {}
+    try:
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                key,val = line.split(':',1)
+                memInfo[key] = float(val.split()[0])/1024.
+    except (IOError,OSError,ValueError):
+        return None,None
+    if not memInfo.get('MemTotal'):
+        return None,None
+    if 'MemAvailable' in memInfo:
+        available = memInfo['MemAvailable']
+    else:
+        available = memInfo.get('MemFree',0.)+memInfo.get('Cached',0.)
+
+    return memInfo['MemTotal'],available
+
+def getMemorySlots(jobMemory,minFreeMemory=0.1):
+    """
+    Number of jobs which fit in the available memory.
+
+    :param jobMemory: Expected peak memory of each job (in MB)
+    :param minFreeMemory: Fraction of the total memory which should be kept free
+
+    :return: Number of jobs or None if the memory can not be read
+    """
+
+    total,available = readMemoryMB()
+    if total is None or not jobMemory:
+        return None
+
+    return max(0,int((available-minFreeMemory*total)//jobMemory))
+
+
+class CoreSlots(object):
+    """
+    Job slots with pinned core sets, shared by the workers on a node.
+
+    :param nSlots: Number of slots
+    :param slotDir: Folder for the lock files (should be node-local)
+    """
+
+    def __init__(self,nSlots,slotDir=None):
+
+        self.coreSets = getCoreSets(nSlots)
+        if slotDir is None:
+            slotDir = os.path.join(tempfile.gettempdir(),'checkmateCoreSlots_%i' %os.getuid())
+        self.slotDir = slotDir
+        if not os.path.isdir(self.slotDir):
+            os.makedirs(self.slotDir,exist_ok=True)
+
+    def acquire(self):
+        """
+        Get a free slot (if all slots are taken, the slot for this process id is shared).
+
+        :return: Tuple with the core set and the list of lock file objects for its cores
+                 (None if the slot is shared), which must be released with release
+        """
+
+        for cores in self.coreSets:
+            lockFiles = []
+            for core in cores:
+                lockF = open(os.path.join(self.slotDir,'core_%i.lock' %core),'w')
+                try:
+                    fcntl.flock(lockF,fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError,OSError):
+                    lockF.close()
+                    break
+                lockFiles.append(lockF)
+            if len(lockFiles) == len(cores):
+                return cores,lockFiles
+            self.release(lockFiles)
+        logger.debug("No free core slot, sharing slot %i" %(os.getpid() % len(self.coreSets)))
+
+        return self.coreSets[os.getpid() % len(self.coreSets)],None
+
+    def release(self,lockFiles):
+
+        if lockFiles is None:
+            return
+        for lockF in lockFiles:
+            fcntl.flock(lockF,fcntl.LOCK_UN)
+            lockF.close()
+
+
+def getCoreSlots(nSlots):
+    """
+    Get the core slots for nSlots simultaneous jobs (created once per process).
+    """
+
+    if not nSlots in _coreSlots:
+        _coreSlots[nSlots] = CoreSlots(nSlots)
+
+    return _coreSlots[nSlots]
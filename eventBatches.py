@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""Helpers for running CheckMATE over batches of events until the required statistical precision is reached."""
+
+#Each batch is a complete CheckMATE run with a smaller number of events (set in a copy
+#of the MadGraph run card) and a new random seed. After each batch, the relative
+#statistical (Monte Carlo) uncertainty on r for the best signal region is estimated from
+#the merged results and new events are only requested if the uncertainty is above the
+#target precision and r is not clearly away from 1. The ds column from CheckMATE also
+#contains the systematic uncertainty on the signal (e.g. from XSectErr), which does not
+#decrease with the number of events: the statistical error is taken from the signal_err_stat
+#column, if available, or obtained by subtracting the systematic part (sysError*s) from ds.
+#The batches are merged weighting each one by its number of events.
+
+import re
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Columns which do not depend on the signal (copied from the first batch):
+signalIndependentColumns = ['analysis','sr','o','b','db','s95obs','s95exp']
+#Columns with the statistical error on the signal (added in quadrature):
+errorColumns = ['ds','signal_err_stat']
+#Column with the statistical error on the signal (optional, see TotalResultFileColumns):
+statErrorColumn = 'signal_err_stat'
+#Columns with conservative r-values (r - k*ds/s95) and the corresponding r-values:
+consColumns = {'robscons' : 'robs', 'rexpcons' : 'rexp'}
+
+
+def writeRunCard(runCard,newRunCard,nEvents,seed):
+    """
+    Create a copy of the MadGraph run card with a new number of events and random seed.
+
+    :param runCard: Path to the original run card
+    :param newRunCard: Path to the new run card
+    :param nEvents: Number of events
+    :param seed: Random seed
+    """
+
+    with open(runCard,'r') as f:
+        lines = f.readlines()
+    for i,line in enumerate(lines):
+        if re.match(r'^\s*\S+\s*=\s*nevents\b',line):
+            lines[i] = re.sub(r'^(\s*)\S+',r'\g<1>%i' %nEvents,line,count=1)
+        elif re.match(r'^\s*\S+\s*=\s*iseed\b',line):
+            lines[i] = re.sub(r'^(\s*)\S+',r'\g<1>%i' %seed,line,count=1)
+    with open(newRunCard,'w') as f:
+        f.writelines(lines)
+
+def getBatchSeed(pointHash,batch):
+    """
+    Get a (reproducible) random seed for a batch.
+
+    :param pointHash: Hex digest identifying the point
+    :param batch: Batch index
+
+    :return: Integer seed (between 1 and 30000000)
+    """
+
+    return 1 + (int(pointHash[:12],16)+batch*7919) % 30000000
+
+def getBestRow(rows):
+    """
+    Select the signal region with the largest expected r-value
+    (or observed, if the expected is not available).
+
+    :param rows: List of dictionaries with the results for each signal region (see scanResults.readTotalResults)
+
+    :return: Dictionary for the best signal region (or None)
+    """
+
+    col = 'rexp'
+    if not rows:
+        return None
+    if not col in rows[0]:
+        col = 'robs'
+
+    return max(rows,key = lambda row: row.get(col,0.))
+
+def getStatError(row,sysError=0.):
+    """
+    Get the statistical (Monte Carlo) error on the signal for a signal region.
+
+    :param row: Dictionary with the results for the signal region
+    :param sysError: Relative systematic uncertainty on the signal included in ds
+                     (only used if the signal_err_stat column is not available)
+
+    :return: Statistical error (or None if the s and ds columns are not available)
+    """
+
+    if statErrorColumn in row:
+        return row[statErrorColumn]
+    if not 's' in row or not 'ds' in row:
+        return None
+
+    return np.sqrt(max(0.,row['ds']**2-(sysError*row['s'])**2))
+
+def getExtraEvents(rows,nEvents,maxEvents,targetPrecision=0.1,rSeparation=3.,minBatch=1000,sysError=0.):
+    """
+    Estimate the number of events still required for the point.
+    No more events are needed if the relative statistical uncertainty on r (see getStatError,
+    for the best signal region) is below the target precision, if r is away from 1 by more than
+    rSeparation times this uncertainty or if the maximum number of events has been reached.
+
+    :param rows: Merged results (list of dictionaries, one for each signal region)
+    :param nEvents: Number of events generated so far
+    :param maxEvents: Maximum number of events for the point
+    :param targetPrecision: Target relative uncertainty on r
+    :param rSeparation: Required separation (in units of the r uncertainty) between r and 1
+    :param minBatch: Minimum number of events for a new batch
+    :param sysError: Relative systematic uncertainty on the signal included in ds
+
+    :return: Number of events for the next batch (0 if no more events are needed)
+    """
+
+    best = getBestRow(rows)
+    if best is None or getStatError(best,sysError) is None:
+        logger.warning("The s and ds columns are needed for estimating the number of events")
+        return 0
+    if nEvents >= maxEvents:
+        return 0
+    s,dsStat = best['s'],getStatError(best,sysError)
+    r = best.get('robs',best.get('rexp'))
+    if s <= 0. or dsStat <= 0.:
+        return 0 #No signal events (or no statistical uncertainty) in any signal region
+    relErr = dsStat/s
+    if relErr < targetPrecision:
+        return 0
+    #Events required to reach the target precision (dsStat/s ~ 1/sqrt(N)):
+    nRequired = nEvents*(relErr/targetPrecision)**2
+    if r is not None:
+        if abs(r-1.) > rSeparation*r*relErr:
+            return 0
+        #Events required to separate r from 1:
+        if r != 1.:
+            nRequired = min(nRequired,nEvents*(rSeparation*r*relErr/abs(r-1.))**2)
+
+    nExtra = max(int(np.ceil(nRequired))-nEvents,minBatch)
+
+    return max(0,min(nExtra,maxEvents-nEvents))
+
+def mergeResults(batchRows,batchEvents,sysError=0.):
+    """
+    Merge the results for several batches of the same point.
+    The signal dependent quantities are averaged weighting by the number of events
+    and the statistical errors are combined in quadrature. The systematic part of ds
+    is averaged (it is fully correlated between batches).
+
+    :param batchRows: List with the results for each batch (see scanResults.readTotalResults)
+    :param batchEvents: List with the number of events in each batch
+    :param sysError: Relative systematic uncertainty on the signal included in ds (see getStatError)
+
+    :return: List of dictionaries with the merged results for each signal region
+    """
+
+    nTotal = float(sum(batchEvents))
+    merged = []
+    for irow,row in enumerate(batchRows[0]):
+        key = (row.get('analysis'),row.get('sr'))
+        rows = []
+        for rowsB,n in zip(batchRows,batchEvents):
+            rowB = rowsB[irow] if irow < len(rowsB) else None
+            if rowB is None or (rowB.get('analysis'),rowB.get('sr')) != key:
+                rowB = [r for r in rowsB if (r.get('analysis'),r.get('sr')) == key][0]
+            rows.append((rowB,n))
+        newRow = {}
+        for col,val in row.items():
+            if col in signalIndependentColumns or not isinstance(val,float):
+                newRow[col] = val
+            elif col == 'ds' and 's' in row:
+                dsStat = np.sqrt(sum((n*getStatError(r,sysError))**2 for r,n in rows))/nTotal
+                dsSys = sum(n*np.sqrt(max(0.,r['ds']**2-getStatError(r,sysError)**2)) for r,n in rows)/nTotal
+                newRow[col] = np.sqrt(dsStat**2+dsSys**2)
+            elif col in errorColumns:
+                newRow[col] = np.sqrt(sum((n*r[col])**2 for r,n in rows))/nTotal
+            elif not col in consColumns:
+                newRow[col] = sum(n*r[col] for r,n in rows)/nTotal
+        #The conservative r-values are rescaled using the combined error:
+        for col,rCol in consColumns.items():
+            if not col in row:
+                continue
+            if not rCol in newRow or not 'ds' in newRow:
+                newRow[col] = sum(n*r[col] for r,n in rows)/nTotal
+                continue
+            factors = [(r[rCol]-r[col])/r['ds'] for r,n in rows if r['ds'] > 0.]
+            if factors:
+                newRow[col] = newRow[rCol]-np.mean(factors)*newRow['ds']
+            else:
+                newRow[col] = newRow[rCol]
+        merged.append(newRow)
+
+    return merged
+
+def writeTotalResults(rows,header,outputFile):
+    """
+    Write the results in the CheckMATE total_results.txt format.
+
+    :param rows: List of dictionaries with the results for each signal region
+    :param header: List of column names
+    :param outputFile: Path to the output file
+    """
+
+    with open(outputFile,'w') as f:
+        f.write(" ".join(header)+"\n")
+        for row in rows:
+            fields = []
+            for col in header:
+                val = row.get(col,'')
+                if isinstance(val,float):
+                    fields.append('%.6g' %val)
+                else:
+                    fields.append(str(val))
+            f.write(" ".join(fields)+"\n")
+
+def readHeader(resultFile):
+    """
+    Read the column names from a CheckMATE total_results.txt file.
+    """
+
+    with open(resultFile,'r') as f:
+        for line in f:
+            if line.split():
+                return line.split()
+
+    return []
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""Per-stage timing and resource metrics for the CheckMATE jobs."""
+
+#The stages are identified from the CheckMATE output: each line is checked against the
+#stage markers (regular expressions) and the job moves to the matching stage. Since
+#CheckMATE runs the stages sequentially, the job can only move forward in the list of
+#stages. Lines echoing parameters ("Key: value" or "Key = value") are not used,
+#so the steering card printed at the start does not trigger any stage.
+#The time before the first marker is assigned to the 'startup' stage.
+
+import os,time
+import re
+import json
+import socket
+import resource
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+defaultStageMarkers = [('madgraph',r'(?i)madgraph|mg5_?amc'),
+                       ('pythia',r'(?i)pythia'),
+                       ('delphes',r'(?i)delphes'),
+                       ('analysis',r'(?i)analy[sz](is|ing)\b'),
+                       ('evaluation',r'(?i)evaluat')]
+
+
+class StageTimer(object):
+    """
+    Measures the wall time spent in each stage of a job from its output lines.
+
+    :param stageMarkers: List of (stage,regular expression) tuples in the order the stages run
+    :param startTime: Start time of the job (default is now)
+    """
+
+    def __init__(self,stageMarkers=None,startTime=None):
+
+        if stageMarkers is None:
+            stageMarkers = defaultStageMarkers
+        self.markers = [(stage,re.compile(expr.encode('utf-8'))) for stage,expr in stageMarkers]
+        self.stages = {}
+        self.current = 'startup'
+        self.iCurrent = -1
+        self.tStart = startTime or time.time()
+        self.parameterLine = re.compile(rb'^\s*[\w\-\.]+\s*[:=]\s')
+
+    def line(self,line):
+        """
+        Process an output line (bytes).
+        """
+
+        if self.parameterLine.match(line):
+            return
+        for i,(stage,marker) in enumerate(self.markers[self.iCurrent+1:]):
+            if marker.search(line):
+                self._switch(stage,self.iCurrent+1+i)
+                return
+
+    def _switch(self,stage,iStage):
+
+        now = time.time()
+        self.stages[self.current] = self.stages.get(self.current,0.)+now-self.tStart
+        self.current = stage
+        self.iCurrent = iStage
+        self.tStart = now
+
+    def close(self):
+        """
+        Close the current stage.
+
+        :return: Dictionary with the wall time (in seconds) for each stage
+        """
+
+        self._switch(self.current,self.iCurrent)
+        return self.stages
+
+
+def getChildrenUsage():
+    """
+    Get the resources used by the (finished) child processes of this process.
+
+    :return: Dictionary with the user and system CPU times (in seconds) and the bytes written
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {'cpuUser' : usage.ru_utime, 'cpuSystem' : usage.ru_stime,
+            'writeBytes' : usage.ru_oublock*512}
+
+def getFolderSize(folder):
+    """
+    Get the total size (in bytes) of the files in a folder.
+    """
+
+    size = 0
+    for root,dirs,files in os.walk(folder):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root,f)).st_size
+            except OSError:
+                pass
+
+    return size
+
+def newMetrics():
+    """
+    Create the dictionary for storing the metrics of a job.
+    """
+
+    metrics = {'host' : socket.gethostname(), 'stages' : {}, 'maxRSS' : 0.}
+    metrics.update(dict([('%s0' %key,val) for key,val in getChildrenUsage().items()]))
+
+    return metrics
+
+def addStages(metrics,stages):
+    """
+    Add the stage times to the job metrics.
+    """
+
+    for stage,dt in stages.items():
+        metrics['stages'][stage] = metrics['stages'].get(stage,0.)+dt
+
+def addUsage(metrics,usage):
+    """
+    Add the CPU times and bytes written by a process which is not a child of
+    this process (e.g. a run started by a fork server), so they are included by closeMetrics.
+
+    :param metrics: Dictionary created by newMetrics
+    :param usage: Dictionary with the cpuUser, cpuSystem and writeBytes of the process
+    """
+
+    for key in getChildrenUsage():
+        metrics['%s0' %key] -= usage.get(key,0)
+
+def closeMetrics(metrics,startTime,outputFolder=None):
+    """
+    Compute the resources used by the job since newMetrics was called.
+
+    :param metrics: Dictionary created by newMetrics
+    :param startTime: Start time of the job
+    :param outputFolder: If defined, the size of this folder is stored as outputBytes
+
+    :return: Dictionary with the metrics
+    """
+
+    usage = getChildrenUsage()
+    for key,val in usage.items():
+        metrics[key] = val-metrics.pop('%s0' %key)
+    metrics['wallTime'] = time.time()-startTime
+    if outputFolder is not None and os.path.isdir(outputFolder):
+        metrics['outputBytes'] = getFolderSize(outputFolder)
+
+    return metrics
+
+
+class MetricsLog(object):
+    """
+    JSON-lines file with the metrics for each job.
+
+    :param metricsFile: Path to the file (new lines are appended)
+    """
+
+    def __init__(self,metricsFile):
+
+        self.metricsFile = os.path.abspath(metricsFile)
+        metricsDir = os.path.dirname(self.metricsFile)
+        if not os.path.isdir(metricsDir):
+            os.makedirs(metricsDir)
+        self.f = open(self.metricsFile,'a')
+        self.entries = []
+
+    def add(self,entry):
+        """
+        Store the metrics for a job.
+
+        :param entry: Dictionary with the metrics (must be JSON serializable)
+        """
+
+        self.f.write(json.dumps(entry,sort_keys=True)+'\n')
+        self.f.flush()
+        self.entries.append(entry)
+
+    def close(self):
+
+        self.f.close()
+
+
+def readMetrics(metricsFile,status='finished'):
+    """
+    Read the job metrics stored by MetricsLog.
+
+    :param metricsFile: Path to the metrics file
+    :param status: If defined, only return the entries for jobs with this status
+
+    :return: List of dictionaries with the job metrics (empty if the file does not exist)
+    """
+
+    entries = []
+    if not os.path.isfile(metricsFile):
+        return entries
+    with open(metricsFile,'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError: #Incomplete line (e.g. from an interrupted scan)
+                continue
+            if status is None or entry.get('status') == status:
+                entries.append(entry)
+
+    return entries
+
+def summarizeMetrics(entries,nSlowest=5):
+    """
+    Build a summary of the job metrics (percentiles for each stage and resource and the slowest points).
+
+    :param entries: List of dictionaries with the job metrics
+    :param nSlowest: Number of slowest points to be listed
+
+    :return: String with the summary
+    """
+
+    entries = [e for e in entries if 'wallTime' in e]
+    if not entries:
+        return "No job metrics available"
+
+    rows = []
+    stages = []
+    for e in entries:
+        for stage in e.get('stages',{}):
+            if not stage in stages:
+                stages.append(stage)
+    quantities = [('wall time (s)',[e['wallTime'] for e in entries])]
+    for stage in stages:
+        quantities.append(('  %s (s)' %stage,[e['stages'].get(stage,0.) for e in entries]))
+    quantities += [('CPU time (s)',[e.get('cpuUser',0.)+e.get('cpuSystem',0.) for e in entries]),
+                   ('peak RSS (MB)',[e.get('maxRSS',0.) for e in entries]),
+                   ('written (MB)',[e.get('writeBytes',0)/1e6 for e in entries]),
+                   ('output size (MB)',[e.get('outputBytes',0)/1e6 for e in entries])]
+    rows.append("Job metrics for %i jobs:" %len(entries))
+    rows.append("  %-20s %10s %10s %10s %10s %12s" %('','p50','p90','p99','max','total'))
+    for label,values in quantities:
+        values = np.array(values,dtype=float)
+        p50,p90,p99 = np.percentile(values,[50,90,99])
+        rows.append("  %-20s %10.1f %10.1f %10.1f %10.1f %12.1f"
+                    %(label,p50,p90,p99,values.max(),values.sum()))
+    rows.append("Slowest points:")
+    for e in sorted(entries,key = lambda e: e['wallTime'],reverse=True)[:nSlowest]:
+        stageStr = ", ".join(["%s %1.0f s" %(stage,dt) for stage,dt in sorted(e.get('stages',{}).items(),
+                                                                         key = lambda x: x[1],reverse=True)])
+        rows.append("  %s: %1.0f s (%s)" %(e.get('name'),e['wallTime'],stageStr))
+
+    return "\n".join(rows)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""Helpers for running external commands (CheckMATE) from the scan workers."""
+
+import os,signal,time
+import gzip
+import json
+import select
+import shutil
+import tempfile
+import subprocess
+import threading
+import collections
+import logging
+from cpuTopology import threadVariables
+
+logger = logging.getLogger(__name__)
+
+
+def openLogFile(logFile):
+    """
+    Open a log file for writing (in binary mode). If the file name ends
+    with .gz, the output is compressed.
+
+    :param logFile: Path to the log file
+
+    :return: File object
+    """
+
+    logDir = os.path.dirname(os.path.abspath(logFile))
+    if not os.path.isdir(logDir):
+        os.makedirs(logDir)
+    if logFile.endswith('.gz'):
+        return gzip.open(logFile,'wb',compresslevel=6)
+    else:
+        return open(logFile,'wb')
+
+def streamOutput(stream,logF,tail,lineCallback=None):
+    """
+    Copy the lines from stream to the log file, keeping the last
+    lines in tail.
+
+    :param stream: Stream (binary) to be read
+    :param logF: File object for writing the lines
+    :param tail: collections.deque object with maximum length for storing the last lines
+    :param lineCallback: Function called with each line (e.g. for monitoring the job stages)
+    """
+
+    for line in iter(stream.readline, b''):
+        logF.write(line)
+        tail.append(line)
+        if lineCallback is not None:
+            try:
+                lineCallback(line)
+            except Exception as e:
+                logger.debug("Line callback failed: %s" %e)
+    stream.close()
+
+def waitWithUsage(run,timeout=None,pollInterval=0.1):
+    """
+    Wait for a process to finish and get its resource usage
+    (which includes the usage of its finished children).
+
+    :param run: subprocess.Popen object
+    :param timeout: Maximum time (in seconds) to wait. If None, wait forever.
+    :param pollInterval: Time (in seconds) between checks
+
+    :return: Tuple with the return code and the resource.struct_rusage object
+
+    :raises subprocess.TimeoutExpired: if the process is still running after the timeout
+    """
+
+    deadline = None
+    if timeout:
+        deadline = time.time()+timeout
+    while True:
+        pid,status,usage = os.wait4(run.pid,os.WNOHANG)
+        if pid != 0:
+            #Let Popen know the process has been reaped
+            if os.WIFSIGNALED(status):
+                run.returncode = -os.WTERMSIG(status)
+            else:
+                run.returncode = os.WEXITSTATUS(status)
+            return run.returncode,usage
+        if deadline is not None and time.time() > deadline:
+            raise subprocess.TimeoutExpired(run.args,timeout)
+        time.sleep(pollInterval)
+
+def killProcessTree(run,gracePeriod=10.):
+    """
+    Kill a process started in its own session (start_new_session=True)
+    together with all its children (the whole process group).
+    The processes are first terminated and killed if they are still
+    running after gracePeriod seconds.
+
+    :param run: subprocess.Popen object
+    :param gracePeriod: Time (in seconds) to wait before killing the processes
+    """
+
+    for sig in [signal.SIGTERM,signal.SIGKILL]:
+        try:
+            os.killpg(run.pid,sig)
+        except OSError:
+            return #Process group no longer exists
+        try:
+            run.wait(timeout=gracePeriod)
+            #Make sure no children were left behind
+            os.killpg(run.pid,signal.SIGKILL)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+        except OSError:
+            return
+
+def runLogged(cmd,cwd,logFile,tailLines=50,shell=False,timeout=None,lineCallback=None,usage=None):
+    """
+    Run a command, streaming its standard output and error to a log file.
+    The command runs in a new session, so all its child processes can be
+    killed if the time limit is exceeded.
+
+    :param cmd: Command to be executed
+    :param cwd: Working directory
+    :param logFile: Path to the log file (compressed if it ends with .gz)
+    :param tailLines: Number of lines from the end of the output kept in memory
+    :param shell: Passed to subprocess.Popen
+    :param timeout: Maximum wall-clock time (in seconds). If None or 0, there is no limit.
+    :param lineCallback: Function called with each output line (bytes)
+    :param usage: If a dictionary is given, the peak memory (maxRSS, in MB) and CPU times
+                  (cpuUser and cpuSystem, in seconds) of the command are stored in it
+
+    :return: Tuple with the return code, a string with the last lines of the output
+             and a flag which is True if the command was killed due to the timeout
+    """
+
+    if not timeout:
+        timeout = None
+    tail = collections.deque(maxlen=max(1,int(tailLines)))
+    timedOut = False
+    with openLogFile(logFile) as logF:
+        run = subprocess.Popen(cmd,shell=shell,cwd=cwd,start_new_session=True,
+                               stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        reader = threading.Thread(target=streamOutput,args=(run.stdout,logF,tail,lineCallback))
+        reader.daemon = True
+        reader.start()
+        try:
+            returncode,rusage = waitWithUsage(run,timeout=timeout)
+            if usage is not None:
+                usage.update({'maxRSS' : rusage.ru_maxrss/1024., 'cpuUser' : rusage.ru_utime,
+                              'cpuSystem' : rusage.ru_stime})
+            killProcessTree(run) #Remove any processes left behind
+        except subprocess.TimeoutExpired:
+            logger.warning("Time limit of %1.0f s exceeded, killing %s" %(timeout,cmd))
+            timedOut = True
+            killProcessTree(run)
+            returncode = run.wait()
+        except BaseException:
+            killProcessTree(run)
+            raise
+        reader.join()
+
+    tailStr = b''.join(tail).decode('utf-8','replace')
+
+    return returncode,tailStr,timedOut
+
+
+forkServerScript = os.path.join(os.path.dirname(os.path.abspath(__file__)),'checkmateForkServer.py')
+#Fork servers started by this process (see getForkServer):
+_forkServers = {}
+
+
+class ForkServer(object):
+    """
+    Long-lived CheckMATE process (see checkmateForkServer.py) with the CheckMATE
+    modules already imported. Each run is a fork of this process, so the
+    interpreter start-up and the module imports are only done once.
+
+    :param python: Python interpreter used to run CheckMATE
+    :param cwd: CheckMATE bin folder
+    :param script: CheckMATE script (relative to cwd)
+    :param preload: List of additional modules to be imported by the server
+    :param startTimeout: Maximum time (in seconds) for starting the server
+    """
+
+    def __init__(self,python,cwd,script='./CheckMATE',preload=None,startTimeout=300.):
+
+        self.cwd = cwd
+        #Unbuffered, so select does not miss replies already read into a buffer:
+        self.server = subprocess.Popen([python,forkServerScript,script,json.dumps(preload or [])],
+                                       cwd=cwd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                       bufsize=0,start_new_session=True)
+        ready = self._receive(startTimeout)
+        if ready is None or not ready.get('ready'):
+            self.close()
+            raise RuntimeError("CheckMATE fork server could not be started in %s" %cwd)
+        logger.debug("CheckMATE fork server started in %s (%i preloaded statements)"
+                     %(cwd,ready['preloaded']))
+
+    def isAlive(self):
+
+        return self.server.poll() is None
+
+    def _send(self,message):
+
+        self.server.stdin.write((json.dumps(message)+'\n').encode('utf-8'))
+        self.server.stdin.flush()
+
+    def _receive(self,timeout=None):
+        """
+        Read a reply from the server.
+
+        :return: Dictionary with the reply or None if the timeout was reached
+
+        :raises RuntimeError: if the server exited
+        """
+
+        ready,_,_ = select.select([self.server.stdout],[],[],timeout)
+        if not ready:
+            return None
+        line = self.server.stdout.readline()
+        if not line:
+            raise RuntimeError("CheckMATE fork server exited (return code %s)" %self.server.poll())
+
+        return json.loads(line.decode('utf-8'))
+
+    def _killRun(self,pid,gracePeriod=10.):
+        """
+        Kill the run (and its child processes) and wait for its final reply.
+        """
+
+        for sig,timeout in [(signal.SIGTERM,gracePeriod),(signal.SIGKILL,None)]:
+            try:
+                os.killpg(pid,sig)
+            except OSError:
+                pass
+            reply = self._receive(timeout)
+            if reply is not None:
+                return reply
+
+    def run(self,cardFile,logFile,tailLines=50,timeout=None,lineCallback=None,usage=None):
+        """
+        Run CheckMATE for a steering card, streaming its output to a log file
+        (same interface as runLogged).
+
+        :param cardFile: Path to the steering card
+        :param logFile: Path to the log file (compressed if it ends with .gz)
+        :param tailLines: Number of lines from the end of the output kept in memory
+        :param timeout: Maximum wall-clock time (in seconds). If None or 0, there is no limit.
+        :param lineCallback: Function called with each output line (bytes)
+        :param usage: If a dictionary is given, the peak memory (maxRSS, in MB), CPU times
+                      (cpuUser and cpuSystem, in seconds) and bytes written (writeBytes) are stored in it
+
+        :return: Tuple with the return code, a string with the last lines of the output
+                 and a flag which is True if the run was killed due to the timeout
+        """
+
+        if not timeout:
+            timeout = None
+        tail = collections.deque(maxlen=max(1,int(tailLines)))
+        timedOut = False
+        #The output is sent through a named pipe, read by a thread:
+        fifoDir = tempfile.mkdtemp(prefix='checkmateFork_')
+        fifo = os.path.join(fifoDir,'output')
+        os.mkfifo(fifo)
+        try:
+            with openLogFile(logFile) as logF:
+                def readOutput():
+                    with open(fifo,'rb') as stream:
+                        streamOutput(stream,logF,tail,lineCallback)
+                reader = threading.Thread(target=readOutput)
+                reader.daemon = True
+                reader.start()
+                pid = None
+                try:
+                    #The run gets the affinity and thread limits of this process (not of the server):
+                    request = {'card' : os.path.abspath(cardFile), 'output' : fifo,
+                               'environ' : dict([(var,os.environ[var]) for var in threadVariables
+                                                 if var in os.environ])}
+                    if hasattr(os,'sched_getaffinity'):
+                        request['cpus'] = sorted(os.sched_getaffinity(0))
+                    self._send(request)
+                    reply = self._receive()
+                    if 'error' in reply:
+                        raise RuntimeError("CheckMATE fork server could not start the run: %s" %reply['error'])
+                    pid = reply['pid']
+                    reply = self._receive(timeout)
+                    if reply is None:
+                        logger.warning("Time limit of %1.0f s exceeded, killing CheckMATE for %s" %(timeout,cardFile))
+                        timedOut = True
+                        reply = self._killRun(pid)
+                    else:
+                        try:
+                            os.killpg(pid,signal.SIGKILL) #Remove any processes left behind
+                        except OSError:
+                            pass
+                except BaseException:
+                    if pid is not None:
+                        try:
+                            os.killpg(pid,signal.SIGKILL)
+                        except OSError:
+                            pass
+                    self.close()
+                    #Unblock the reader if the server never opened the pipe:
+                    try:
+                        os.close(os.open(fifo,os.O_WRONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+                    reader.join()
+                    raise
+                reader.join()
+        finally:
+            shutil.rmtree(fifoDir,ignore_errors=True)
+
+        if usage is not None:
+            usage.update(dict([(key,reply[key]) for key in ['maxRSS','cpuUser','cpuSystem','writeBytes']]))
+        tailStr = b''.join(tail).decode('utf-8','replace')
+
+        return reply['returncode'],tailStr,timedOut
+
+    def close(self):
+
+        if self.isAlive():
+            try:
+                self._send({'exit' : True})
+                self.server.wait(timeout=10.)
+            except (OSError,ValueError,subprocess.TimeoutExpired):
+                pass
+        if self.isAlive():
+            self.server.kill()
+            self.server.wait()
+
+
+def getForkServer(python,cwd,preload=None):
+    """
+    Get the fork server for the CheckMATE installation, starting it if needed.
+    The server is kept for the following runs in the same process (e.g. a pool worker).
+
+    :param python: Python interpreter used to run CheckMATE
+    :param cwd: CheckMATE bin folder
+    :param preload: List of additional modules to be imported by the server
+
+    :return: ForkServer object
+    """
+
+    key = (python,os.path.abspath(cwd),tuple(preload or []))
+    server = _forkServers.get(key)
+    if server is None or not server.isAlive():
+        server = ForkServer(python,cwd,preload=preload)
+        _forkServers[key] = server
+
+    return server
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+"""Cache of MadGraph5 process folders shared by all points in a scan."""
+
+#The MadGraph process (matrix element code) only depends on the model, the MG5 commands
+#and the run card. It is generated once for each (MGcommand,run card) combination and
+#stored in the cache folder. Each running job locks one copy of the process folder
+#(the copies are reused, so the code is only compiled once per copy) and generates the parton level events
+#for each point by replacing the param card. The events are then passed to CheckMATE
+#(which showers them) instead of the MG5 commands.
+#Optionally, the events are also shared by the points which only differ in the widths of
+#some particles (e.g. the points in a lifetime scan with the same masses). The widths of
+#these particles do not change the hard scattering, so the events are generated once for
+#each spectrum and copied for each point, with the param card in the header replaced
+#(Pythia decays the particles using its widths) and the lifetimes of these particles
+#sampled again from their widths.
+
+import os,shutil
+import hashlib
+import fcntl
+import gzip
+import re
+import json
+import math
+import random
+import logging
+from jobRunner import runLogged
+from slhaTools import readMassesAndWidths
+
+logger = logging.getLogger(__name__)
+
+#Reduced Planck constant times the speed of light (in GeV mm):
+hbarc = 1.973269804e-13
+
+
+def getProcessKey(mgCommand,runCard):
+    """
+    Compute the cache key for a MadGraph process.
+
+    :param mgCommand: MadGraph commands (e.g. 'import model MSSM_SLHA2\\n generate p p > x1+ x1-')
+    :param runCard: Path to the run card. The number of events and the random
+                    seed do not change the process code and are not included in the key.
+
+    :return: Hex digest
+    """
+
+    sha = hashlib.sha1()
+    commands = [c.strip().rstrip(';') for c in mgCommand.split('\n') if c.strip()]
+    sha.update("\n".join(commands).encode('utf-8'))
+    with open(runCard,'rb') as f:
+        for line in f:
+            if re.match(rb'^\s*\S+\s*=\s*(nevents|iseed)\b',line):
+                continue
+            sha.update(line)
+
+    return sha.hexdigest()
+
+def getProcessTemplate(mg5Folder,cacheFolder,mgCommand,runCard,logDir,timeout=None):
+    """
+    Get the MadGraph process folder for the given commands and run card,
+    generating it if it is not yet in the cache. A file lock ensures that
+    the process is only generated once when several workers request it.
+
+    :param mg5Folder: Path to the MadGraph5 installation
+    :param cacheFolder: Path to the cache folder
+    :param mgCommand: MadGraph commands (model import and process generation)
+    :param runCard: Path to the run card
+    :param logDir: Folder for storing the MadGraph output
+    :param timeout: Maximum time (in seconds) for generating the process
+
+    :return: Path to the process folder or None if it could not be generated
+    """
+
+    key = getProcessKey(mgCommand,runCard)
+    templateDir = os.path.join(cacheFolder,key,'template')
+    if os.path.isdir(templateDir):
+        return templateDir
+
+    if not os.path.isdir(os.path.dirname(templateDir)):
+        os.makedirs(os.path.dirname(templateDir))
+    with open(os.path.join(cacheFolder,key,'template.lock'),'w') as lockF:
+        fcntl.flock(lockF,fcntl.LOCK_EX)
+        try:
+            if os.path.isdir(templateDir): #Generated by another worker
+                return templateDir
+            tmpDir = templateDir+'_tmp'
+            if os.path.isdir(tmpDir):
+                shutil.rmtree(tmpDir)
+            procCard = os.path.join(cacheFolder,key,'proc_card.dat')
+            commands = [c.strip().rstrip(';') for c in mgCommand.split('\n') if c.strip()]
+            with open(procCard,'w') as f:
+                f.write("\n".join(commands)+"\n")
+                f.write("output %s -nojpeg\n" %tmpDir)
+            logger.info("Generating MadGraph process %s" %key)
+            returncode,outputTail,_ = runLogged([os.path.join(os.path.abspath(mg5Folder),'bin','mg5_aMC'),procCard],
+                                           cwd=os.path.join(cacheFolder,key),
+                                           logFile=os.path.join(logDir,'mg5_process_%s.log.gz' %key),
+                                           timeout=timeout)
+            if returncode != 0 or not os.path.isdir(tmpDir):
+                logger.error("Could not generate MadGraph process:\n%s" %outputTail)
+                return None
+            shutil.copy(runCard,os.path.join(tmpDir,'Cards','run_card.dat'))
+            os.rename(tmpDir,templateDir)
+        finally:
+            fcntl.flock(lockF,fcntl.LOCK_UN)
+
+    return templateDir
+
+def acquireProcessDir(templateDir):
+    """
+    Get a copy of the process folder which is not being used by any other
+    worker (created from the template if needed). The copies are reused,
+    so the MadGraph code only has to be compiled once for each copy.
+
+    :param templateDir: Path to the template process folder
+
+    :return: Tuple with the path to the process folder and the lock file object
+             (must be released with releaseProcessDir)
+    """
+
+    i = 0
+    while True:
+        procDir = os.path.join(os.path.dirname(templateDir),'run_%i' %i)
+        lockF = open(procDir+'.lock','w')
+        try:
+            fcntl.flock(lockF,fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError,OSError):
+            lockF.close()
+            i += 1
+            continue
+        if not os.path.isdir(procDir):
+            shutil.copytree(templateDir,procDir,symlinks=True)
+        return procDir,lockF
+
+def releaseProcessDir(lockF):
+    """
+    Release the process folder acquired with acquireProcessDir.
+    """
+
+    fcntl.flock(lockF,fcntl.LOCK_UN)
+    lockF.close()
+
+def readBannerXSec(bannerFile):
+    """
+    Read the integrated cross-section (in pb) from the MadGraph banner.
+    """
+
+    with open(bannerFile,'r') as f:
+        for line in f:
+            match = re.search(r'Integrated weight \(pb\)\s*:\s*([\d\.eE+-]+)',line)
+            if match:
+                return float(match.group(1))
+
+    return None
+
+def setNumberOfCores(procDir,nCores):
+    """
+    Set the number of cores used by MadGraph (nb_core) in the process folder.
+
+    :param procDir: Path to the (worker) process folder
+    :param nCores: Number of cores
+    """
+
+    configFile = os.path.join(procDir,'Cards','me5_configuration.txt')
+    config = ''
+    if os.path.isfile(configFile):
+        with open(configFile,'r') as f:
+            config = f.read()
+    line = 'nb_core = %i' %int(nCores)
+    if re.search(r'^\s*#?\s*nb_core\s*=.*$',config,flags=re.M):
+        config = re.sub(r'^\s*#?\s*nb_core\s*=.*$',line,config,flags=re.M)
+    else:
+        config += '\n%s\n' %line
+    with open(configFile,'w') as f:
+        f.write(config)
+
+def generateEvents(procDir,paramCard,runName,outputFile,logDir,timeout=None,runCard=None,nCores=None,
+                   compressed=False):
+    """
+    Generate parton level events for a point with the given param card.
+
+    :param procDir: Path to the (worker) process folder
+    :param paramCard: Path to the param card (SLHA file)
+    :param runName: Name for the MadGraph run
+    :param outputFile: Path for storing the (uncompressed) LHE file
+    :param logDir: Folder for storing the MadGraph output
+    :param timeout: Maximum time (in seconds) for generating the events
+    :param runCard: Path to the run card (if None, the run card from the template is used)
+    :param nCores: Number of cores used by MadGraph (if None, the MadGraph configuration is used)
+    :param compressed: If True, the LHE file is stored compressed (gzip)
+
+    :return: Cross-section (in pb) or None if the events could not be generated
+    """
+
+    shutil.copy(paramCard,os.path.join(procDir,'Cards','param_card.dat'))
+    if runCard is not None:
+        shutil.copy(runCard,os.path.join(procDir,'Cards','run_card.dat'))
+    if nCores is not None:
+        setNumberOfCores(procDir,nCores)
+    returncode,outputTail,_ = runLogged(['./bin/generate_events',runName,'-f'],cwd=procDir,
+                                      logFile=os.path.join(logDir,'%s_mg5.log.gz' %runName),
+                                      timeout=timeout)
+    eventsDir = os.path.join(procDir,'Events',runName)
+    lheFile = os.path.join(eventsDir,'unweighted_events.lhe.gz')
+    if returncode != 0 or not os.path.isfile(lheFile):
+        logger.error("MadGraph event generation failed for %s:\n%s" %(runName,outputTail))
+        if os.path.isdir(eventsDir):
+            shutil.rmtree(eventsDir)
+        return None
+
+    xsec = None
+    for f in os.listdir(eventsDir):
+        if f.endswith('banner.txt'):
+            xsec = readBannerXSec(os.path.join(eventsDir,f))
+    if compressed:
+        shutil.move(lheFile,outputFile)
+    else:
+        with gzip.open(lheFile,'rb') as fIn, open(outputFile,'wb') as fOut:
+            shutil.copyfileobj(fIn,fOut)
+    shutil.rmtree(eventsDir)
+
+    return xsec
+
+def getRunCardValue(runCard,name):
+    """
+    Read the value of a parameter from the MadGraph run card.
+
+    :return: String with the value or None if not found
+    """
+
+    with open(runCard,'r') as f:
+        for line in f:
+            match = re.match(r'^\s*(\S+)\s*=\s*%s\b' %re.escape(name),line)
+            if match:
+                return match.group(1)
+
+    return None
+
+def getSpectrumKey(paramCard,sharedWidths=[]):
+    """
+    Compute the key for the param card content which changes the parton level events:
+    all the BLOCK entries and the total widths (except the ones of the particles given).
+
+    :param paramCard: Path to the param card (SLHA file)
+    :param sharedWidths: List of PDG codes of the particles whose widths are ignored
+
+    :return: Hex digest
+    """
+
+    sharedWidths = [abs(int(pdg)) for pdg in sharedWidths]
+    sha = hashlib.sha1()
+    inBlock = False
+    with open(paramCard,'r') as f:
+        for line in f:
+            line = line.split('#',1)[0]
+            if not line.strip():
+                continue
+            fields = line.split()
+            if not line[0].isspace():
+                tag = fields[0].upper()
+                inBlock = (tag == 'BLOCK')
+                if inBlock:
+                    entry = 'BLOCK %s' %(" ".join(fields[1:]).upper())
+                elif tag == 'DECAY' and not abs(int(fields[1])) in sharedWidths:
+                    entry = 'DECAY %i %.6e' %(int(fields[1]),float(fields[2]))
+                else:
+                    continue
+            elif inBlock:
+                values = []
+                for field in fields:
+                    try:
+                        values.append('%.6e' %float(field))
+                    except ValueError:
+                        values.append(field)
+                entry = " ".join(values)
+            else:
+                continue
+            sha.update((entry+'\n').encode('utf-8'))
+
+    return sha.hexdigest()
+
+def getSharedEvents(templateDir,eventsFolder,eventsKey,paramCard,runName,logDir,
+                    timeout=None,runCard=None,nCores=None):
+    """
+    Get the parton level events shared by the points with the same key, generating them
+    if they are not yet stored. A file lock ensures that the events are only generated once
+    when several workers request them.
+
+    :param templateDir: Path to the template process folder
+    :param eventsFolder: Folder for storing the shared events
+    :param eventsKey: Key for the events (process, run card and spectrum)
+    :param paramCard: Path to the param card used if the events have to be generated
+    :param runName: Name for the MadGraph run
+    :param logDir: Folder for storing the MadGraph output
+    :param timeout: Maximum time (in seconds) for generating the events
+    :param runCard: Path to the run card
+    :param nCores: Number of cores used by MadGraph
+
+    :return: Tuple with the path to the (compressed) event file and the cross-section in pb
+             (None,None if the events could not be generated)
+    """
+
+    eventFile = os.path.join(eventsFolder,'%s.lhe.gz' %eventsKey)
+    infoFile = os.path.join(eventsFolder,'%s.json' %eventsKey)
+
+    def readInfo():
+        with open(infoFile,'r') as f:
+            return json.load(f)['xsec']
+
+    if os.path.isfile(eventFile):
+        return eventFile,readInfo()
+
+    if not os.path.isdir(eventsFolder):
+        os.makedirs(eventsFolder,exist_ok=True)
+    with open(os.path.join(eventsFolder,'%s.lock' %eventsKey),'w') as lockF:
+        fcntl.flock(lockF,fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(eventFile): #Generated by another worker
+                return eventFile,readInfo()
+            logger.info("Generating the events shared by the points with the spectrum of %s" %runName)
+            tmpFile = eventFile+'.tmp'
+            procDir,procLock = acquireProcessDir(templateDir)
+            try:
+                xsec = generateEvents(procDir,paramCard,runName,tmpFile,logDir,timeout,runCard,nCores,
+                                      compressed=True)
+            finally:
+                releaseProcessDir(procLock)
+            if xsec is None and not os.path.isfile(tmpFile):
+                return None,None
+            with open(infoFile,'w') as f:
+                json.dump({'xsec' : xsec, 'paramCard' : paramCard},f)
+            os.rename(tmpFile,eventFile)
+        finally:
+            fcntl.flock(lockF,fcntl.LOCK_UN)
+
+    return eventFile,xsec
+
+def copySharedEvents(sharedFile,outputFile,paramCard,sharedWidths,timeOfFlight=None,seedKey=''):
+    """
+    Create the event file for a point from the shared events. The param card in the
+    header is replaced and the lifetimes of the particles with shared widths are
+    sampled from the widths in the param card (as done by MadGraph, the lifetimes
+    below the time_of_flight threshold are set to zero).
+
+    :param sharedFile: Path to the (compressed) shared event file
+    :param outputFile: Path for storing the (uncompressed) LHE file
+    :param paramCard: Path to the param card (SLHA file) for the point
+    :param sharedWidths: List of PDG codes of the particles with shared widths
+    :param timeOfFlight: time_of_flight threshold (in mm) from the run card. If None or negative,
+                         the lifetimes are not written (as in MadGraph)
+    :param seedKey: String identifying the process (combined with the param card to seed the
+                    lifetime sampling, so different processes of a point are not correlated)
+
+    :return: Number of events
+    """
+
+    with open(paramCard,'r') as f:
+        slha = f.read()
+    if not slha.endswith('\n'):
+        slha += '\n'
+    widths = readMassesAndWidths(paramCard)[1]
+    ctau = {}
+    for pdg in sharedWidths:
+        width = widths.get(abs(int(pdg)),0.)
+        ctau[abs(int(pdg))] = hbarc/width if width > 0. else 0.
+    setLifetimes = (timeOfFlight is not None and timeOfFlight >= 0.)
+    #The lifetimes are reproducible for each point and process:
+    rng = random.Random(int(hashlib.sha1((seedKey+'\n'+slha).encode('utf-8')).hexdigest()[:8],16))
+
+    nEvents = 0
+    nParticles = 0
+    inSLHA = False
+    with gzip.open(sharedFile,'rt') as fIn, open(outputFile,'w') as fOut:
+        for line in fIn:
+            if inSLHA:
+                if '</slha>' in line.lower():
+                    inSLHA = False
+                    fOut.write('</slha>\n')
+                continue
+            tag = line.strip().lower()
+            if tag.startswith('<slha>'):
+                fOut.write('<slha>\n'+slha)
+                if '</slha>' in tag:
+                    fOut.write('</slha>\n')
+                else:
+                    inSLHA = True
+                continue
+            if tag.startswith('<event>') or tag.startswith('<event '):
+                nEvents += 1
+                nParticles = None
+            elif nParticles is None: #Event header (the first entry is the number of particles)
+                nParticles = int(line.split()[0])
+            elif nParticles > 0:
+                nParticles -= 1
+                fields = line.split()
+                if setLifetimes and abs(int(fields[0])) in ctau:
+                    lifetime = -ctau[abs(int(fields[0]))]*math.log(1.-rng.random())
+                    if lifetime < timeOfFlight:
+                        lifetime = 0.
+                    fields[11] = '%.4e' %lifetime
+                    line = ' '+' '.join(fields)+'\n'
+            fOut.write(line)
+
+    return nEvents
+
+def useCachedProcesses(parser,processTags,mg5Folder,cacheFolder,eventsDir,logDir,timeout=None,nCores=None,
+                       sharedWidths=None,sharedEventsFolder=None):
+    """
+    Generate the parton level events for all processes defined by MGcommand
+    using the cached process folders and replace the MadGraph options by the
+    event files (and the cross-sections, if not defined).
+
+    :param parser: ConfigParserExt object for the point (modified in place)
+    :param processTags: List of process sections
+    :param mg5Folder: Path to the MadGraph5 installation
+    :param cacheFolder: Path to the cache folder
+    :param eventsDir: Folder for storing the event files
+    :param logDir: Folder for storing the MadGraph output
+    :param timeout: Maximum time (in seconds) for each MadGraph run
+    :param nCores: Number of cores used by MadGraph (if None, the MadGraph configuration is used)
+    :param sharedWidths: List of PDG codes of the particles whose widths do not change the parton level
+                         events. If given, the events are shared by all the points with the same spectrum
+                         (see getSpectrumKey and copySharedEvents)
+    :param sharedEventsFolder: Folder for the shared events (default is cacheFolder/events)
+
+    :return: List of event files created (or None if the generation failed)
+    """
+
+    name = parser.get("CheckMateParameters","Name")
+    if not os.path.isdir(eventsDir):
+        os.makedirs(eventsDir)
+    eventFiles = []
+    for pTag in processTags:
+        if not parser.has_option(pTag,"MGcommand"):
+            continue
+        mgCommand = parser.get(pTag,"MGcommand")
+        runCard = os.path.abspath(parser.get(pTag,"MGrun"))
+        paramCard = os.path.abspath(parser.get(pTag,"MGparam"))
+        templateDir = getProcessTemplate(mg5Folder,cacheFolder,mgCommand,runCard,logDir,timeout)
+        if templateDir is None:
+            return None
+        runName = '%s_%s' %(name,pTag)
+        eventFile = os.path.join(eventsDir,'%s.lhe' %runName)
+        if sharedWidths:
+            sha = hashlib.sha1()
+            sha.update(getProcessKey(mgCommand,runCard).encode('utf-8'))
+            with open(runCard,'rb') as f:
+                sha.update(f.read()) #Also include the number of events and the seed
+            sha.update(getSpectrumKey(paramCard,sharedWidths).encode('utf-8'))
+            if sharedEventsFolder is None:
+                sharedEventsFolder = os.path.join(cacheFolder,'events')
+            sharedKey = sha.hexdigest()
+            sharedFile,xsec = getSharedEvents(templateDir,sharedEventsFolder,sharedKey,paramCard,
+                                              runName,logDir,timeout,runCard,nCores)
+            if sharedFile is None:
+                return None
+            timeOfFlight = getRunCardValue(runCard,'time_of_flight')
+            if timeOfFlight is not None:
+                timeOfFlight = float(timeOfFlight)
+            copySharedEvents(sharedFile,eventFile,paramCard,sharedWidths,timeOfFlight,
+                             seedKey='%s_%s' %(pTag,sharedKey))
+        else:
+            procDir,lockF = acquireProcessDir(templateDir)
+            try:
+                xsec = generateEvents(procDir,paramCard,runName,eventFile,logDir,timeout,runCard,nCores)
+            finally:
+                releaseProcessDir(lockF)
+        if xsec is None and not os.path.isfile(eventFile):
+            return None
+        eventFiles.append(eventFile)
+        for opt in ['MGcommand','MGparam','MGrun']:
+            parser.remove_option(pTag,opt)
+        parser.set(pTag,"Events",eventFile)
+        if not parser.has_option(pTag,"XSect") and xsec is not None:
+            parser.set(pTag,"XSect","%1.5g PB" %xsec)
+
+    return eventFiles
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""Retention policy for the CheckMATE output of each point and readers for the archived output."""
+
+#The policy is a list of (pattern,action) pairs. The patterns are matched (fnmatch)
+#against the file paths relative to the point output folder (e.g. 'analysis/atlas_1712_02118_ew_cutflow.dat')
+#and the first matching pattern defines the action:
+#  keep: the file is left in the output folder
+#  compress: the file is moved to the point archive (<output folder>.zip)
+#  drop: the file is removed
+#Files not matching any pattern are kept. Policies for specific analyses can be defined
+#by including the analysis name in the pattern.
+#The archive contains an index (index.json) with the action, size and checksum of each file.
+#Files in the archive can be read without extracting it (see openPointFile).
+
+import os,shutil
+import io
+import json
+import fnmatch
+import hashlib
+import zipfile
+import tempfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+actions = ['keep','compress','drop']
+#Policy reproducing the cleanUp option (remove the MadGraph output and the analysis stdout):
+cleanUpPolicy = [('*mg5amcatnlo/*/*','drop'),('*analysisstdout_*.log','drop'),('*','keep')]
+
+
+def checkPolicy(policy):
+    """
+    Check if the policy is a list of (pattern,action) pairs with valid actions.
+
+    :param policy: List of (pattern,action) tuples
+
+    :return: The policy as a list of tuples
+    """
+
+    newPolicy = []
+    for rule in policy:
+        if len(rule) != 2 or not rule[1] in actions:
+            raise ValueError("Retention rules must be (pattern,action) with action in %s (got %s)"
+                             %(actions,str(rule)))
+        newPolicy.append((rule[0],rule[1]))
+
+    return newPolicy
+
+def getAction(relPath,policy):
+    """
+    Get the action for a file.
+
+    :param relPath: File path relative to the point output folder
+    :param policy: List of (pattern,action) tuples
+
+    :return: Action (keep, compress or drop)
+    """
+
+    for pattern,action in policy:
+        if fnmatch.fnmatch(relPath,pattern):
+            return action
+
+    return 'keep'
+
+def getArchiveFile(resultFolder):
+    """
+    Path to the archive for a point output folder.
+    """
+
+    return os.path.abspath(resultFolder).rstrip(os.sep)+'.zip'
+
+def applyRetention(resultFolder,policy):
+    """
+    Apply the retention policy to the output folder of a point.
+    The files to be compressed are added to the point archive (merged with
+    the files from a previous archive, if it exists) and then removed from
+    the folder. Empty folders are removed.
+
+    :param resultFolder: Point output folder
+    :param policy: List of (pattern,action) tuples
+
+    :return: Dictionary with the number of files for each action
+    """
+
+    resultFolder = os.path.abspath(resultFolder)
+    counts = dict([(action,0) for action in actions])
+    if not os.path.isdir(resultFolder):
+        return counts
+    files = {}
+    for root,dirs,fileNames in os.walk(resultFolder):
+        for fileName in fileNames:
+            path = os.path.join(root,fileName)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            relPath = os.path.relpath(path,resultFolder)
+            files[relPath] = getAction(relPath,policy)
+    for action in files.values():
+        counts[action] += 1
+
+    compressed = sorted([relPath for relPath,action in files.items() if action == 'compress'])
+    if compressed:
+        archiveFile = getArchiveFile(resultFolder)
+        index = {}
+        tmpFile = archiveFile+'.tmp'
+        with zipfile.ZipFile(tmpFile,'w',compression=zipfile.ZIP_DEFLATED) as zf:
+            #Keep the files from a previous archive which are no longer in the folder:
+            if os.path.isfile(archiveFile):
+                with zipfile.ZipFile(archiveFile,'r') as oldZf:
+                    oldIndex = json.loads(oldZf.read('index.json').decode('utf-8'))
+                    for member in oldZf.namelist():
+                        if member == 'index.json' or member in files:
+                            continue
+                        with oldZf.open(member,'r') as fIn, zf.open(member,'w') as fOut:
+                            shutil.copyfileobj(fIn,fOut,1 << 20)
+                        index[member] = oldIndex.get(member,{})
+            for relPath in compressed:
+                path = os.path.join(resultFolder,relPath)
+                sha = hashlib.sha1()
+                zinfo = zipfile.ZipInfo.from_file(path,relPath)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with open(path,'rb') as fIn, zf.open(zinfo,'w') as fOut:
+                    for block in iter(lambda: fIn.read(1 << 20), b''):
+                        sha.update(block)
+                        fOut.write(block)
+                index[relPath] = {'size' : os.path.getsize(path), 'sha1' : sha.hexdigest()}
+            for relPath,action in files.items():
+                index.setdefault(relPath,{})['action'] = action
+            zf.writestr('index.json',json.dumps(index,indent=1,sort_keys=True))
+        os.replace(tmpFile,archiveFile)
+
+    #Remove the compressed and dropped files only after the archive is complete:
+    for relPath,action in files.items():
+        if action != 'keep':
+            os.remove(os.path.join(resultFolder,relPath))
+    for root,dirs,fileNames in os.walk(resultFolder,topdown=False):
+        if not os.listdir(root):
+            os.rmdir(root)
+
+    return counts
+
+def removePointOutput(resultFolder):
+    """
+    Remove the output folder and the archive for a point.
+    """
+
+    if os.path.isdir(resultFolder):
+        shutil.rmtree(resultFolder)
+    archiveFile = getArchiveFile(resultFolder)
+    if os.path.isfile(archiveFile):
+        os.remove(archiveFile)
+
+def movePointOutput(workFolder,resultFolder):
+    """
+    Move the output folder (and archive) of a point from a scratch folder to its
+    final location. The output is first moved (or copied, if on a different
+    filesystem) next to the final location and then renamed, so incomplete
+    outputs are never visible in the output folder.
+
+    :param workFolder: Point output folder in the scratch folder
+    :param resultFolder: Final point output folder (replaced if it exists)
+    """
+
+    resultFolder = os.path.abspath(resultFolder)
+    parentFolder = os.path.dirname(resultFolder)
+    if not os.path.isdir(parentFolder):
+        os.makedirs(parentFolder,exist_ok=True)
+    tmpFolder = tempfile.mkdtemp(prefix='.tmp_%s_' %os.path.basename(resultFolder),dir=parentFolder)
+    try:
+        tmpOutput = os.path.join(tmpFolder,'output')
+        shutil.move(workFolder,tmpOutput)
+        archiveFile = getArchiveFile(workFolder)
+        if os.path.isfile(archiveFile):
+            shutil.move(archiveFile,getArchiveFile(tmpOutput))
+        removePointOutput(resultFolder)
+        #The archive is renamed first, so the output is complete once the folder exists:
+        if os.path.isfile(getArchiveFile(tmpOutput)):
+            os.rename(getArchiveFile(tmpOutput),getArchiveFile(resultFolder))
+        os.rename(tmpOutput,resultFolder)
+    finally:
+        shutil.rmtree(tmpFolder,ignore_errors=True)
+
+def _findArchive(path,maxDepth=4):
+    """
+    Find the point archive containing the file (path as in the unpacked output folder).
+
+    :return: Tuple with the archive path and the member name (or None,None)
+    """
+
+    path = os.path.abspath(path)
+    folder = os.path.dirname(path)
+    for i in range(maxDepth):
+        archiveFile = folder+'.zip'
+        if os.path.isfile(archiveFile):
+            return archiveFile,os.path.relpath(path,folder).replace(os.sep,'/')
+        folder = os.path.dirname(folder)
+
+    return None,None
+
+def copyPointFolder(folder,destination):
+    """
+    Copy a folder of a point output, including its files moved to the point archive.
+    The files in the output folder take precedence over the ones in the archive.
+
+    :param folder: Path to the folder (as in the unpacked output folder, e.g. <output folder>/evaluation)
+    :param destination: Path to the copy (must not exist)
+    """
+
+    archiveFile,member = _findArchive(folder)
+    if os.path.isdir(folder):
+        shutil.copytree(folder,destination)
+    elif archiveFile is None:
+        raise IOError("No such file or directory: '%s'" %folder)
+    else:
+        os.makedirs(destination)
+    if archiveFile is None:
+        return
+    prefix = member+'/'
+    with zipfile.ZipFile(archiveFile,'r') as zf:
+        for name in zf.namelist():
+            if not name.startswith(prefix) or name.endswith('/'):
+                continue
+            path = os.path.join(destination,*name[len(prefix):].split('/'))
+            if os.path.isfile(path):
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with zf.open(name,'r') as fIn, open(path,'wb') as fOut:
+                shutil.copyfileobj(fIn,fOut,1 << 20)
+
+def pointFileExists(path):
+    """
+    Check if a point output file exists, either in the output folder or in the point archive.
+
+    :param path: Path to the file (as in the unpacked output folder)
+    """
+
+    if os.path.isfile(path):
+        return True
+    archiveFile,member = _findArchive(path)
+    if archiveFile is None:
+        return False
+    with zipfile.ZipFile(archiveFile,'r') as zf:
+        return member in zf.namelist()
+
+def pointFileHash(path):
+    """
+    Compute the SHA1 checksum of a point output file, either in the output folder or in the point archive.
+
+    :param path: Path to the file (as in the unpacked output folder)
+
+    :return: Hex digest or None if the file does not exist
+    """
+
+    if not pointFileExists(path):
+        return None
+    sha = hashlib.sha1()
+    with openPointFile(path,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+def openPointFile(path,mode='r'):
+    """
+    Open a point output file for reading, either from the output folder or from the point archive.
+
+    :param path: Path to the file (as in the unpacked output folder)
+    :param mode: 'r' (text) or 'rb' (binary)
+
+    :return: File object
+    """
+
+    if os.path.isfile(path):
+        return open(path,mode)
+    archiveFile,member = _findArchive(path)
+    if archiveFile is None:
+        raise IOError("No such file or directory: '%s'" %path)
+    zf = zipfile.ZipFile(archiveFile,'r')
+    try:
+        f = zf.open(member,'r')
+    except KeyError:
+        zf.close()
+        raise IOError("No such file or directory: '%s' (archive %s)" %(path,archiveFile))
+    zf.close() #The member file object keeps its own reference to the archive
+    if mode == 'rb':
+        return f
+    return io.TextIOWrapper(f,encoding='utf-8')
+
+
+class RetentionPool(object):
+    """
+    Applies the retention policy to the point output folders using a pool of background threads.
+
+    :param policy: List of (pattern,action) tuples
+    :param nThreads: Number of threads
+    """
+
+    def __init__(self,policy,nThreads=2):
+
+        self.policy = checkPolicy(policy)
+        self.pool = ThreadPoolExecutor(max_workers=max(1,int(nThreads)))
+        self.futures = []
+        self.counts = dict([(action,0) for action in actions])
+
+    def submit(self,resultFolder):
+        """
+        Schedule the retention policy for a point output folder.
+        """
+
+        future = self.pool.submit(applyRetention,resultFolder,self.policy)
+        future.resultFolder = resultFolder
+        self.futures.append(future)
+        self._collect(wait=False)
+
+    def addCounts(self,counts):
+        """
+        Add the number of files for each action from a folder processed elsewhere
+        (e.g. by the job itself, see applyRetention).
+        """
+
+        for action,n in counts.items():
+            self.counts[action] += n
+
+    def _collect(self,wait):
+
+        pending = []
+        for future in self.futures:
+            if not wait and not future.done():
+                pending.append(future)
+                continue
+            try:
+                self.addCounts(future.result())
+            except Exception as e:
+                logger.error("Could not apply the retention policy to %s: %s" %(future.resultFolder,e))
+        self.futures = pending
+
+    def close(self):
+        """
+        Wait for all the scheduled folders to be processed.
+
+        :return: Dictionary with the total number of files for each action
+        """
+
+        self._collect(wait=True)
+        self.pool.shutdown(wait=True)
+
+        return self.counts
@@ -31,10 +31,10 @@ def getContour(xpts,ypts,zpts,levels,ylog=False,xlog=False):
     levelPts = {}
     for il,level in enumerate(CS.levels):
         levelPts[level] = []
-        c = CS.collections[il]
-        paths = c.get_paths()
-        for path in paths:
-            levelPts[level].append(path.vertices)
+        #allsegs is available for all matplotlib versions (CS.collections was removed in 3.10)
+        for segment in CS.allsegs[il]:
+            if len(segment):
+                levelPts[level].append(segment)
     plt.close(fig)
 
     #scale back:
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""Content-addressed store of CheckMATE results, shared between points and scans."""
+
+#The results are stored under a key computed from the physics content of the SLHA
+#file (see slhaTools.readCanonicalContent) and the CheckMATE steering card, with the
+#point dependent entries (name, output folder and file paths) removed. Files
+#referenced in the card (e.g. the run card) enter the key through their checksum.
+#Points with the same key get the stored evaluation folder (hard linked when
+#possible, copied otherwise) instead of running CheckMATE.
+#Note that hard linked files are shared with the store and should not be modified.
+
+import os,shutil
+import json
+import time
+import tempfile
+import logging
+from slhaTools import readCanonicalContent
+from scanLedger import fileHash,stringHash
+from outputRetention import removePointOutput,copyPointFolder
+
+logger = logging.getLogger(__name__)
+
+#Steering card entries which only label the point:
+pointCardEntries = ['Name','OutputDirectory','SLHAFile','RandomSeed']
+#Scan options which change the results:
+resultOptions = ['adaptiveEvents','initialEvents','maxEvents','targetPrecision','rSeparation','signalSysError']
+
+
+def normalizeCard(cardText,slhaFile):
+    """
+    Remove the point dependent entries from the steering card text. References to the
+    SLHA file are replaced by a fixed label and other files by their checksum.
+
+    :param cardText: Steering card text (see runCheckMateScan.getCheckMateCardText)
+    :param slhaFile: Path to the SLHA file of the point
+
+    :return: Normalized card text
+    """
+
+    lines = []
+    for line in cardText.split('\n'):
+        if not ':' in line or line.startswith('['):
+            lines.append(line)
+            continue
+        key,value = [x.strip() for x in line.split(':',1)]
+        if key in pointCardEntries:
+            continue
+        if value == slhaFile:
+            value = '<SLHA>'
+        elif os.path.isfile(value):
+            value = 'sha1:%s' %fileHash(value)
+        lines.append('%s: %s' %(key,value))
+
+    return "\n".join(lines)
+
+def getContentHash(slhaFile,cardText,options={},blocks=['MASS','DECAY','XSECTION']):
+    """
+    Compute the key for a point.
+
+    :param slhaFile: Path to the SLHA file
+    :param cardText: Steering card text
+    :param options: Dictionary with the scan options (only the ones in resultOptions are used)
+    :param blocks: SLHA blocks used for the key (see slhaTools.readCanonicalContent)
+
+    :return: Hex digest
+    """
+
+    content = readCanonicalContent(slhaFile,blocks)
+    content += '\n' + normalizeCard(cardText,slhaFile)
+    for opt in resultOptions:
+        if opt in options:
+            content += '\n%s = %r' %(opt,options[opt])
+
+    return stringHash(content)
+
+
+class ResultStore(object):
+    """
+    Content-addressed store of CheckMATE evaluation folders.
+
+    :param storeFolder: Path to the store (created if it does not exist)
+    :param useLinks: If True, hard link the stored files instead of copying them
+    """
+
+    def __init__(self,storeFolder,useLinks=True):
+
+        self.storeFolder = os.path.abspath(storeFolder)
+        self.useLinks = useLinks
+        if not os.path.isdir(self.storeFolder):
+            os.makedirs(self.storeFolder)
+
+    def getEntryFolder(self,contentHash):
+
+        return os.path.join(self.storeFolder,contentHash[:2],contentHash)
+
+    def has(self,contentHash):
+        """
+        Check if the results for the key are in the store.
+        """
+
+        return os.path.isfile(os.path.join(self.getEntryFolder(contentHash),'evaluation','total_results.txt'))
+
+    def publish(self,contentHash,resultFolder,name=None):
+        """
+        Add the evaluation folder of a finished point to the store
+        (nothing is done if the key is already in the store). The files already
+        moved to the point archive by the retention policy are included.
+
+        :param contentHash: Key for the point
+        :param resultFolder: CheckMATE output folder for the point
+        :param name: Point name (stored as metadata)
+
+        :return: True if the results were added
+        """
+
+        if self.has(contentHash):
+            return False
+        entryFolder = self.getEntryFolder(contentHash)
+        if not os.path.isdir(os.path.dirname(entryFolder)):
+            os.makedirs(os.path.dirname(entryFolder),exist_ok=True)
+        #Copy to a temporary folder and rename, so incomplete entries are never visible:
+        tmpFolder = tempfile.mkdtemp(prefix='.tmp_',dir=os.path.dirname(entryFolder))
+        try:
+            copyPointFolder(os.path.join(resultFolder,'evaluation'),os.path.join(tmpFolder,'evaluation'))
+            with open(os.path.join(tmpFolder,'entry.json'),'w') as f:
+                json.dump({'name' : name, 'resultFolder' : resultFolder, 'created' : time.time()},f)
+            os.rename(tmpFolder,entryFolder)
+        except OSError as e:
+            #The entry may have been published by another scan in the meantime
+            shutil.rmtree(tmpFolder,ignore_errors=True)
+            if not self.has(contentHash):
+                logger.warning("Could not store results from %s: %s" %(resultFolder,e))
+            return False
+
+        return True
+
+    def fetch(self,contentHash,resultFolder):
+        """
+        Create the evaluation folder for a point from the store.
+
+        :param contentHash: Key for the point
+        :param resultFolder: CheckMATE output folder for the point (replaced if it exists)
+
+        :return: True if the results were found in the store
+        """
+
+        if not self.has(contentHash):
+            return False
+        removePointOutput(resultFolder)
+        source = os.path.join(self.getEntryFolder(contentHash),'evaluation')
+        copyFunction = shutil.copy2
+        if self.useLinks:
+            copyFunction = self._linkOrCopy
+        shutil.copytree(source,os.path.join(resultFolder,'evaluation'),copy_function=copyFunction)
+
+        return True
+
+    def _linkOrCopy(self,src,dst):
+
+        try:
+            os.link(src,dst)
+        except OSError: #Different filesystems or links not supported
+            shutil.copy2(src,dst)
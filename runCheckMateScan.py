@@ -10,78 +10,278 @@
 
 #First tell the system where to find the modules:
 import sys,os,glob,shutil
-from configParserWrapper import ConfigParserExt
+import itertools
+from configParserWrapper import ConfigParserExt,ParsingError
 import logging,shutil
-import subprocess
 import time,datetime
 import multiprocessing
 import tempfile
-import pyslha
+import numpy as np
+from scanScheduler import AdmissionScheduler
+from scanExecutors import PoolExecutor,WorkQueueExecutor
+from jobRunner import runLogged,getForkServer
+from cpuTopology import getCoreSlots,pinProcess,restoreProcess,getMemorySlots
+from madgraphCache import useCachedProcesses
+from scanLedger import ScanLedger,stringHash
+from slhaTools import getXSections
+from slhaGridGenerator import generateGrid,planGrid,getGridFiles
+from scanResults import ResultsTable,ProgressMonitor,readTotalResults,getSLHAParameters,formatTime
+from costModel import CostModel,getMakespan,orderJobs
+from resultStore import ResultStore,getContentHash
+from jobMetrics import StageTimer,MetricsLog,newMetrics,addStages,addUsage,closeMetrics,summarizeMetrics,readMetrics
+from outputRetention import RetentionPool,checkPolicy,cleanUpPolicy,getArchiveFile,removePointOutput
+from outputRetention import applyRetention,movePointOutput
+from eventBatches import writeRunCard,getBatchSeed,getExtraEvents,mergeResults,writeTotalResults,readHeader
 
 FORMAT = '%(levelname)s in %(module)s.%(funcName)s() in %(lineno)s: %(message)s at %(asctime)s'
 logging.basicConfig(format=FORMAT,datefmt='%m/%d/%Y %I:%M:%S %p')
 logger = logging.getLogger(__name__)
 
+#Sections in the parameters file which do not define CheckMATE processes:
+nonProcessSections = ['options','checkmateparameters','adaptivescan','slhagrid']
 
-def getCheckMateCard(parser):
+
+def getResultsFile(parser):
     """
-    Create a process card using the user defined input.
+    Get the path to the table with the results for all points.
 
     :param parser: ConfigParser object with all the parameters needed
 
-    :return: The path to the process card
+    :return: Absolute path to the results table
     """
-    cardFile = tempfile.mkstemp(suffix='.dat', prefix='checkmateCard_',
-                                   dir=os.getcwd())
-    os.close(cardFile[0])
-    cardFile = os.path.abspath(cardFile[1])
 
-    cardF = open(cardFile,'w')
-    cardF.write("[Parameters]\n")
-    pars = parser.toDict(raw=False)["CheckMateParameters"]
+    if parser.has_option("options","resultsFile"):
+        return os.path.abspath(parser.get("options","resultsFile"))
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+
+    return os.path.join(outputDir,'scanResults.csv')
+
+def getLedgerFile(parser):
+    """
+    Get the path to the scan ledger.
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: Absolute path to the ledger file
+    """
+
+    if parser.has_option("options","ledgerFile"):
+        return os.path.abspath(parser.get("options","ledgerFile"))
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+
+    return os.path.join(outputDir,'scanLedger.sqlite')
+
+def getMetricsFile(parser):
+    """
+    Get the path to the file with the job metrics.
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: Absolute path to the metrics file
+    """
+
+    if parser.has_option("options","metricsFile"):
+        return os.path.abspath(parser.get("options","metricsFile"))
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+
+    return os.path.join(outputDir,'jobMetrics.jsonl')
+
+def getJobMemory(parser):
+    """
+    Get the expected peak memory of each job. If not defined in the parameters file,
+    it is estimated from the job metrics of previous runs (90% quantile plus a 20% margin).
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: Memory (in MB) or None if not available
+    """
+
+    if parser.has_option("options","jobMemory"):
+        return parser.get("options","jobMemory")
+    maxRSS = [e['maxRSS'] for e in readMetrics(getMetricsFile(parser)) if e.get('maxRSS')]
+    if not maxRSS:
+        return None
+
+    return 1.2*np.percentile(maxRSS,90)
+
+def getCostModel(parser,ledger=None):
+    """
+    Create the runtime model for the points, fitted to the timings stored in the ledger.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param ledger: ScanLedger object (if None, only the default time is used)
+
+    :return: CostModel object
+    """
+
+    costParameters = None
+    if parser.has_option("options","costParameters"):
+        costParameters = parser.get("options","costParameters")
+    elif parser.has_option("options","resultParameters"):
+        costParameters = parser.get("options","resultParameters")
+    defaultTime = 600.
+    if parser.has_option("options","defaultPointTime"):
+        defaultTime = float(parser.get("options","defaultPointTime"))
+    costModel = CostModel(costParameters,nProcesses=len(getProcessTags(parser)),
+                          defaultTime=defaultTime)
+    if ledger is not None:
+        costModel.addTimings(ledger)
+    costModel.fit()
+
+    return costModel
+
+def getProcessTags(parser):
+    """
+    Get the tags (section names) of the CheckMATE processes defined in parser.
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: List of section names
+    """
+
+    processTags = [tag for tag in parser.sections()
+                    if not tag.lower() in nonProcessSections]
+
+    return processTags
+
+def getCheckMateCardText(parser):
+    """
+    Render the process card using the user defined input.
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: String with the process card content (or False if the input is not valid)
+    """
+
+    cardText = "[Parameters]\n"
+    parserDict = parser.toDict(raw=False)
+    pars = parserDict["CheckMateParameters"]
     for key,val in pars.items():
-        cardF.write("%s: %s\n" %(key,val))
+        cardText += "%s: %s\n" %(key,val)
 
     #Get tags of processes:
-    processTags = [tag for tag in parser.sections()
-                    if (tag.lower() != 'options' and  tag.lower() != 'checkmateparameters')]
+    processTags = getProcessTags(parser)
 
     for pTag in processTags:
-        process = parser.toDict(raw=False)[pTag]
+        process = parserDict[pTag]
         if not 'Name' in process:
             logger.error("The field 'Name' must be defined in %s" %pTag)
             return False
-        cardF.write("\n[%s]\n" %process['Name'])
+        cardText += "\n[%s]\n" %process['Name']
         for key,val in process.items():
             if key == 'Name': continue
-            cardF.write("%s: %s\n" %(key,val))
-    cardF.close()
+            cardText += "%s: %s\n" %(key,val)
+
+    return cardText
+
+def getCheckMateCard(parser,cardDir=None):
+    """
+    Create a process card using the user defined input.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param cardDir: Folder for the card file (default is the current folder)
+
+    :return: The path to the process card
+    """
+
+    cardText = getCheckMateCardText(parser)
+    if cardText is False:
+        return False
+
+    if cardDir is None:
+        cardDir = os.getcwd()
+    cardFile = tempfile.mkstemp(suffix='.dat', prefix='checkmateCard_',
+                                   dir=cardDir)
+    os.close(cardFile[0])
+    cardFile = os.path.abspath(cardFile[1])
+
+    with open(cardFile,'w') as cardF:
+        cardF.write(cardText)
 
     return cardFile
 
-def RunCheckMate(parserDict):
+def removeEventFiles(eventFiles):
     """
-    Run CheckMATE using the parameters given in parser.
+    Remove the parton level events passed to CheckMATE. The other files in the
+    CheckMATE output are handled by the retention policy (see outputRetention).
 
-    :param parser: ConfigParser object with all the parameters needed.
+    :param eventFiles: List of event files to be removed
     """
-    t0 = time.time()
-    parser = ConfigParserExt()
-    parser.read_dict(parserDict)
 
-    pars = parser.toDict(raw=False)["options"]
+    for eventFile in eventFiles:
+        if os.path.isfile(eventFile):
+            os.remove(eventFile)
+
+def getRetentionPolicy(parser):
+    """
+    Get the retention policy for the point output folders.
+
+    :param parser: ConfigParser object with all the parameters needed
+
+    :return: List of (pattern,action) tuples (or None if no policy should be applied)
+    """
+
+    if parser.has_option("options","retentionPolicy"):
+        return checkPolicy(parser.get("options","retentionPolicy"))
+    if parser.has_option("options","cleanUp") and parser.get("options","cleanUp") is True:
+        return cleanUpPolicy
+
+    return None
+
+def runCheckMateOnce(parser,logDir,logName,metrics=None):
+    """
+    Create the steering card and run CheckMATE once for the point defined in parser
+    (generating the events with the cached MadGraph processes, if required).
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param logDir: Folder for storing the CheckMATE (and MadGraph) output
+    :param logName: Name of the log file (without extension)
+    :param metrics: Dictionary for storing the stage times and peak memory (see jobMetrics)
 
+    :return: Dictionary with the return code (None if CheckMATE could not be started), the last
+             lines of the output (or the error message), the timeout flag, the event files
+             created and the log file.
+    """
+
+    pars = parser.toDict(raw=False)["options"]
     outputFolder = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
-    resultFolder = os.path.join(outputFolder,parser.get("CheckMateParameters","Name"))
-    if os.path.isdir(resultFolder):
-        logger.info("Results folder %s found." %resultFolder)
-        if parser.get("CheckMateParameters","OutputExists") == 'overwrite':
-            logger.info("Overwriting")
-            shutil.rmtree(resultFolder)
+    logFile = os.path.join(logDir,logName+'.log.gz')
+    run = {'returncode' : None, 'outputTail' : '', 'timedOut' : False,
+           'eventFiles' : [], 'logFile' : logFile}
+    if metrics is None:
+        metrics = newMetrics()
+
+    #Generate the parton level events using the cached MadGraph processes:
+    if pars.get('reuseMGProcess') is True:
+        tMG = time.time()
+        if 'mgCacheFolder' in pars:
+            mgCacheFolder = os.path.abspath(pars['mgCacheFolder'])
         else:
-            logger.info("Skipping" %resultFolder)
-            return "---- %s skipped" %resultFolder
-    cardFile = getCheckMateCard(parser)
+            mgCacheFolder = os.path.join(outputFolder,'mg5cache')
+        sharedEventsFolder = None
+        if 'sharedEventsFolder' in pars:
+            sharedEventsFolder = os.path.abspath(pars['sharedEventsFolder'])
+        eventFiles = useCachedProcesses(parser,getProcessTags(parser),
+                                        pars.get('madgraphFolder','./MG5'),mgCacheFolder,
+                                        eventsDir=os.path.join(outputFolder,'events'),
+                                        logDir=logDir,timeout=pars.get('jobTimeout'),
+                                        nCores=pars.get('jobCores'),
+                                        sharedWidths=pars.get('sharedEventWidths'),
+                                        sharedEventsFolder=sharedEventsFolder)
+        addStages(metrics,{'mgEvents' : time.time()-tMG})
+        if eventFiles is None:
+            run['outputTail'] = "MadGraph event generation failed"
+            return run
+        run['eventFiles'] = eventFiles
+
+    #Keep the card in the scratch folder, if running there:
+    cardDir = None
+    if 'scratchFolder' in pars:
+        cardDir = outputFolder
+    cardFile = getCheckMateCard(parser,cardDir)
+    if not cardFile:
+        run['outputTail'] = "could not create steering card"
+        return run
     logger.debug('Steering card %s created' %cardFile)
 
     #Create output dirs, if do not exist:
@@ -93,44 +293,306 @@ def RunCheckMate(parserDict):
     #Run CheckMate
     checkmatePath = os.path.abspath(pars['checkmateFolder'])
     checkmateBin = os.path.join(checkmatePath,'bin')
+    checkmatePython = pars.get('checkmatePython','python2')
     logger.info('Running checkmate with steering card: %s ' %cardFile)
-    logger.debug('Running: python2 ./CheckMATE %s at %s' %(cardFile,checkmateBin))
-    run = subprocess.Popen('python2 ./CheckMATE %s' %(cardFile)
-                       ,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=checkmateBin)
-    output,errorMsg= run.communicate()
-    logger.debug('CheckMATE error:\n %s \n' %errorMsg)
-    logger.debug('CheckMATE output:\n %s \n' %output)
+    logger.debug('Running: %s ./CheckMATE %s at %s' %(checkmatePython,cardFile,checkmateBin))
+    #Stream the CheckMATE output to the log file:
+    tailLines = pars.get('logTailLines',50)
+    stageTimer = StageTimer(pars.get('stageMarkers'))
+    usage = {}
+    if pars.get('warmWorkers') is True:
+        #Fork the run from a CheckMATE process with the modules already imported:
+        server = getForkServer(checkmatePython,checkmateBin,pars.get('checkmatePreload'))
+        returncode,outputTail,timedOut = server.run(cardFile,logFile=logFile,tailLines=tailLines,
+                                                    timeout=pars.get('jobTimeout'),
+                                                    lineCallback=stageTimer.line,usage=usage)
+        addUsage(metrics,usage) #The run is not a child of this process
+    else:
+        returncode,outputTail,timedOut = runLogged([checkmatePython,'./CheckMATE',cardFile],cwd=checkmateBin,
+                                          logFile=logFile,tailLines=tailLines,
+                                          timeout=pars.get('jobTimeout'),
+                                          lineCallback=stageTimer.line,usage=usage)
+    addStages(metrics,stageTimer.close())
+    metrics['maxRSS'] = max(metrics['maxRSS'],usage.get('maxRSS',0.))
+    run.update({'returncode' : returncode, 'outputTail' : outputTail, 'timedOut' : timedOut})
+    logger.debug('CheckMATE output stored in %s' %logFile)
 
     os.remove(cardFile)
 
+    return run
+
+def runEventBatches(parser,logDir,metrics=None):
+    """
+    Run CheckMATE over batches of events (with different random seeds) until
+    the relative statistical uncertainty on r is below the target precision, r is clearly
+    away from 1 or the maximum number of events is reached (see eventBatches.getExtraEvents).
+    The number of events is set in copies of the MadGraph run cards and the merged
+    results are stored in the evaluation folder of the point.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param logDir: Folder for storing the CheckMATE output
+    :param metrics: Dictionary for storing the stage times and peak memory (summed over batches)
+
+    :return: Dictionary with the run summary of the last batch (see runCheckMateOnce)
+    """
+
+    pars = parser.toDict(raw=False)["options"]
+    name = parser.get("CheckMateParameters","Name")
+    resultFolder = os.path.join(os.path.abspath(parser.get("CheckMateParameters","OutputDirectory")),name)
+    batchFolder = os.path.join(resultFolder,'batches')
+    processTags = [pTag for pTag in getProcessTags(parser) if parser.has_option(pTag,"MGrun")]
+    if not processTags:
+        logger.warning("adaptiveEvents requires MadGraph processes (MGrun). Running %s once." %name)
+        return runCheckMateOnce(parser,logDir,name,metrics)
+    if not os.path.isdir(batchFolder):
+        os.makedirs(batchFolder)
+
+    initialEvents = int(pars.get('initialEvents',5000))
+    maxEvents = int(pars.get('maxEvents',50000))
+    targetPrecision = pars.get('targetPrecision',0.1)
+    rSeparation = pars.get('rSeparation',3.)
+    sysError = pars.get('signalSysError',0.)
+    pointHash = stringHash(getCheckMateCardText(parser))
+    nEvents = initialEvents
+    batchRows = []
+    batchEvents = []
+    batchSeeds = []
+    while nEvents > 0:
+        batchName = '%s_batch%i' %(name,len(batchEvents))
+        seed = getBatchSeed(pointHash,len(batchEvents))
+        batchParser = parser.clone()
+        batchParser.set("CheckMateParameters","Name",batchName)
+        batchParser.set("CheckMateParameters","OutputDirectory",batchFolder)
+        batchParser.set("CheckMateParameters","RandomSeed",str(seed))
+        if not 'mgCacheFolder' in pars: #Share the MadGraph processes with the other points
+            batchParser.set("options","mgCacheFolder",os.path.join(os.path.dirname(resultFolder),'mg5cache'))
+        for pTag in processTags:
+            runCard = os.path.join(batchFolder,'%s_%s_run_card.dat' %(batchName,pTag))
+            writeRunCard(os.path.abspath(parser.get(pTag,"MGrun")),runCard,nEvents,seed)
+            batchParser.set(pTag,"MGrun",runCard)
+        run = runCheckMateOnce(batchParser,logDir,batchName,metrics)
+        if pars['cleanUp'] is True:
+            removeEventFiles(run['eventFiles'])
+        resultFile = os.path.join(batchFolder,batchName,'evaluation','total_results.txt')
+        if run['returncode'] != 0 or run['timedOut'] or not os.path.isfile(resultFile):
+            return run
+        batchRows.append(readTotalResults(resultFile))
+        batchEvents.append(nEvents)
+        batchSeeds.append(seed)
+        merged = mergeResults(batchRows,batchEvents,sysError)
+        nEvents = getExtraEvents(merged,sum(batchEvents),maxEvents,targetPrecision,
+                                 rSeparation,minBatch=initialEvents,sysError=sysError)
+        logger.info("Point %s: %i events generated in %i batches, %i more events required"
+                    %(name,sum(batchEvents),len(batchEvents),nEvents))
+
+    #Store the merged results:
+    evaluationFolder = os.path.join(resultFolder,'evaluation')
+    if not os.path.isdir(evaluationFolder):
+        os.makedirs(evaluationFolder)
+    with open(os.path.join(evaluationFolder,'event_batches.txt'),'w') as f:
+        f.write("batch nevents seed\n")
+        for i,(n,seed) in enumerate(zip(batchEvents,batchSeeds)):
+            f.write("%i %i %i\n" %(i,n,seed))
+    writeTotalResults(merged,readHeader(resultFile),os.path.join(evaluationFolder,'total_results.txt'))
+
+    return run
+
+def RunCheckMate(parserDict):
+    """
+    Run CheckMATE using the parameters given in parser.
+
+    :param parser: ConfigParser object with all the parameters needed.
+
+    :return: Dictionary with the run summary (name, status, result folder, timings and message)
+    """
+    t0 = time.time()
+    parser = ConfigParserExt()
+    parser.read_dict(parserDict)
+
+    pars = parser.toDict(raw=False)["options"]
+
+    outputFolder = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+    name = parser.get("CheckMateParameters","Name")
+    resultFolder = os.path.join(outputFolder,name)
+    result = {'name' : name, 'resultFolder' : resultFolder,
+              'startTime' : t0, 'endTime' : None}
+    if os.path.isdir(resultFolder) or os.path.isfile(getArchiveFile(resultFolder)):
+        logger.info("Results folder %s found." %resultFolder)
+        if parser.get("CheckMateParameters","OutputExists") == 'overwrite':
+            logger.info("Overwriting")
+            removePointOutput(resultFolder)
+        elif pars.get('rerun') is True:
+            #Results from a failed or outdated run
+            logger.info("Removing incomplete or outdated results")
+            removePointOutput(resultFolder)
+        else:
+            logger.info("Skipping %s" %resultFolder)
+            result.update({'status' : 'skipped', 'endTime' : time.time(),
+                           'message' : "---- %s skipped" %resultFolder})
+            return result
+
+    if 'logDir' in pars:
+        logDir = os.path.abspath(pars['logDir'])
+    else:
+        logDir = os.path.join(outputFolder,'logs')
+
+    #Pin the job to a free set of cores (the number of threads is capped to its size):
+    if not 'coreSlots' in pars:
+        return runPoint(parser,result,logDir,t0)
+    coreSlots = getCoreSlots(pars['coreSlots'])
+    cores,lockFiles = coreSlots.acquire()
+    state = pinProcess(cores)
+    try:
+        logger.debug("Running %s on cores %s" %(name,cores))
+        parser.set("options","jobCores",str(len(cores)))
+        result = runPoint(parser,result,logDir,t0)
+    finally:
+        restoreProcess(state)
+        coreSlots.release(lockFiles)
+
+    return result
+
+def runPoint(parser,result,logDir,t0):
+    """
+    Run CheckMATE for the point in the output folder or in a node-local
+    scratch folder, if defined (the output is moved to the output folder at the end).
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param result: Dictionary with the run summary (updated with the status, message and metrics)
+    :param logDir: Folder for storing the logs
+    :param t0: Start time of the job
+
+    :return: Dictionary with the run summary
+    """
+
+    pars = parser.toDict(raw=False)["options"]
+    outputFolder = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+    name = parser.get("CheckMateParameters","Name")
+    resultFolder = os.path.join(outputFolder,name)
+    if not 'scratchFolder' in pars:
+        return runInFolder(parser,result,resultFolder,logDir,t0)
+    scratchFolder = os.path.abspath(pars['scratchFolder'])
+    if not os.path.isdir(scratchFolder):
+        os.makedirs(scratchFolder,exist_ok=True)
+    scratchDir = tempfile.mkdtemp(prefix='checkmate_%s_' %name,dir=scratchFolder)
+    try:
+        parser.set("CheckMateParameters","OutputDirectory",scratchDir)
+        if not 'mgCacheFolder' in pars: #Keep the MadGraph processes shared between points
+            parser.set("options","mgCacheFolder",os.path.join(outputFolder,'mg5cache'))
+        workFolder = os.path.join(scratchDir,name)
+        result = runInFolder(parser,result,workFolder,logDir,t0)
+        if result['status'] == 'finished':
+            #Only the retained output is moved:
+            retentionPolicy = getRetentionPolicy(parser)
+            if retentionPolicy:
+                result['retentionCounts'] = applyRetention(workFolder,retentionPolicy)
+            movePointOutput(workFolder,resultFolder)
+    finally:
+        shutil.rmtree(scratchDir,ignore_errors=True)
+
+    return result
+
+def runInFolder(parser,result,workFolder,logDir,t0):
+    """
+    Run CheckMATE for the point and check its output.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param result: Dictionary with the run summary (updated with the status, message and metrics)
+    :param workFolder: Folder where CheckMATE writes the output for the point
+    :param logDir: Folder for storing the CheckMATE output
+    :param t0: Start time of the job
+
+    :return: The run summary
+    """
+
+    pars = parser.toDict(raw=False)["options"]
+    name = parser.get("CheckMateParameters","Name")
+
+    #Run CheckMate
+    metrics = newMetrics()
+    if pars.get('adaptiveEvents') is True:
+        run = runEventBatches(parser,logDir,metrics)
+    else:
+        run = runCheckMateOnce(parser,logDir,name,metrics)
+    returncode,outputTail,timedOut = run['returncode'],run['outputTail'],run['timedOut']
+    if returncode is None: #CheckMATE could not be started
+        result.update({'status' : 'failed', 'endTime' : time.time(),
+                       'message' : "---- %s: %s" %(result['resultFolder'],outputTail),
+                       'metrics' : closeMetrics(metrics,t0)})
+        return result
+    result['returncode'] = returncode
+    result['timedOut'] = timedOut
+    result['logFile'] = run['logFile']
+
     logger.info("Done in %3.2f min" %((time.time()-t0)/60.))
+    if timedOut:
+        logger.error("CheckMATE exceeded the time limit (%s s) for %s. Last lines of output:\n %s \n"
+                     %(pars['jobTimeout'],name,outputTail))
+    elif returncode != 0:
+        logger.error("CheckMATE returned %i for %s. Last lines of output:\n %s \n"
+                     %(returncode,name,outputTail))
 
     #Remove parton level events:
     if pars['cleanUp'] is True:
-        mg5folder = os.path.join(resultFolder,'mg5amcatnlo')
-        if os.path.isdir(mg5folder):
-            logger.debug('Removing data from: %s \n' %mg5folder)
-            for f in os.listdir(mg5folder):
-                file_path = os.path.join(mg5folder, f)
-                if os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-        analysisfolder = os.path.join(resultFolder,'analysis')
-        if os.path.isfile(os.path.join(analysisfolder,'analysisstdout_atlas_1712_02118_ew.log')):
-            os.remove(os.path.join(analysisfolder,'analysisstdout_atlas_1712_02118_ew.log'))
+        removeEventFiles(run['eventFiles'])
 
+    result['metrics'] = closeMetrics(metrics,t0,workFolder)
     now = datetime.datetime.now()
+    result['endTime'] = time.time()
+    if timedOut:
+        result['status'] = 'failed'
+        result['message'] = "CheckMATE killed after exceeding the time limit (%s s) at %s. Output:\n%s" %(pars['jobTimeout'],
+                                                    now.strftime("%Y-%m-%d %H:%M"),outputTail)
+    elif returncode == 0 and os.path.isfile(os.path.join(workFolder,'evaluation','total_results.txt')):
+        result['status'] = 'finished'
+        result['message'] = "Finished running CheckMATE at %s" %(now.strftime("%Y-%m-%d %H:%M"))
+    else:
+        result['status'] = 'failed'
+        result['message'] = "CheckMATE failed (return code %i) at %s. Output:\n%s" %(returncode,
+                                                    now.strftime("%Y-%m-%d %H:%M"),outputTail)
 
-    return "Finished running CheckMATE at %s" %(now.strftime("%Y-%m-%d %H:%M"))
+    return result
 
 
-def main(parfile,verbose):
+def storedPoint(store,contentHash,name,slhaFile,outputDir,ledger,table,resultParameters=None):
     """
-    Submit parallel jobs using the parameter file.
+    Get the results for a point from the result store and record them in the ledger
+    and in the results table.
 
-    :param parfile: name of the parameter file.
-    :param verbose: level of debugging messages.
+    :param store: ResultStore object
+    :param contentHash: Key for the point
+    :param name: Point name
+    :param slhaFile: Path to the SLHA file
+    :param outputDir: Output directory for the scan
+    :param ledger: ScanLedger object
+    :param table: ResultsTable object
+    :param resultParameters: SLHA parameters stored in the table (see scanResults.getSLHAParameters)
+
+    :return: True if the results were found in the store
     """
-    level = args.verbose.lower()
+
+    resultFolder = os.path.join(outputDir,name)
+    if not store.fetch(contentHash,resultFolder):
+        return False
+    outputFile = os.path.join(resultFolder,'evaluation','total_results.txt')
+    ledger.recordResult(name,'finished',outputFile=outputFile,
+                        message="Results taken from the result store (%s)" %contentHash)
+    try:
+        table.addPoint(name,getSLHAParameters(slhaFile,resultParameters),
+                       readTotalResults(outputFile))
+    except Exception as e:
+        logger.error("Could not store results for point %s: %s" %(name,e))
+
+    return True
+
+def setLogLevel(verbose):
+    """
+    Set the logging level for the scan modules.
+
+    :param verbose: level of debugging messages (debug, info, warning or error).
+    """
+
+    level = verbose.lower()
     levels = { "debug": logging.DEBUG, "info": logging.INFO,
                "warn": logging.WARNING,
                "warning": logging.WARNING, "error": logging.ERROR }
@@ -138,14 +600,50 @@ def main(parfile,verbose):
         logger.error ( "Unknown log level ``%s'' supplied!" % level )
         sys.exit()
     logger.setLevel(level = levels[level])
+    logging.getLogger().setLevel(level = levels[level]) #Also set the level for the helper modules
 
-    parser = ConfigParserExt()
-    ret = parser.read(parfile)
-    if ret == []:
-        logger.error( "No such file or directory: '%s'" % parfile)
-        sys.exit()
+def getInputFiles(parser,plan=False):
+    """
+    Get the list of input SLHA files defined by the input option or
+    generated from the grid defined in the [SLHAGrid] section (see slhaGridGenerator).
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param plan: If True, the grid files are only listed (not written) and the files
+                 and cross-section computations required are reported
+
+    :return: Tuple with the list of absolute paths to the input files and, for a grid,
+             the generator writing the files (see slhaGridGenerator.generateGrid), which
+             yields each path once the file exists (None if the files already exist)
+    """
+
+    gridFiles = None
 
-    if not parser.has_option('options', 'input'):
+    if parser.has_section('SLHAGrid') and plan:
+        try:
+            gridPlan = planGrid(parser)
+        except ValueError as e:
+            logger.error("Invalid SLHA grid: %s" %e)
+            sys.exit()
+        inputFiles = gridPlan['files']
+        print("SLHA grid: %i points, %i files to be written (existing files are used as they are)"
+              %(len(inputFiles),gridPlan['new']))
+        if gridPlan['xsecJobs'] is not None:
+            print("  cross-section computations required: %i" %gridPlan['xsecJobs'])
+        parser.remove_section('SLHAGrid')
+    elif parser.has_section('SLHAGrid'):
+        ncpus = int(parser.get("options","ncpu"))
+        if ncpus < 0:
+            ncpus = multiprocessing.cpu_count()
+        #The files are written while the scan runs (the points are submitted as they are created):
+        try:
+            inputFiles = getGridFiles(parser)
+            gridFiles = generateGrid(parser,ncpus=ncpus)
+        except ValueError as e:
+            logger.error("Could not generate the SLHA grid: %s" %e)
+            sys.exit()
+        #The grid loops must not be expanded again as scan loops:
+        parser.remove_section('SLHAGrid')
+    elif not parser.has_option('options', 'input'):
         logger.error("An input file or folder must be defined.")
         sys.exit()
     else:
@@ -162,71 +660,666 @@ def main(parfile,verbose):
             logger.error("Input format %s not accepted" %inputF)
             sys.exit()
 
-    parserList = []
-    for f in inputFiles:
-        newParser = ConfigParserExt()
-        newParser.read_dict(parser.toDict(raw=True))
-        newParser.set("CheckMateParameters","SLHAFile",f)
-        newParser.set("CheckMateParameters","Name",
-                       os.path.splitext(os.path.basename(f))[0])
-        newParser.set("CheckMateParameters","OutputDirectory",
-                       os.path.abspath(parser.get("CheckMateParameters","OutputDirectory")))
-        #Get tags of processes:
-        processTags = [tag for tag in newParser.sections()
-                        if (tag.lower() != 'options' and  tag.lower() != 'checkmateparameters')]
-
-        #Get xsec dictionary:
-        useSLHA = False
-        unit = 'PB'
-        xsecDict = {}
-        if newParser.has_option("options","xsecUnit"):
-            unit = newParser.get("options","xsecUnit")
-        if newParser.has_option("options","useSLHAxsecs"):
-            useSLHA = newParser.get("options","useSLHAxsecs")
-            if not isinstance(useSLHA,dict):
-                logger.error("useSLHAxsecs should be defined as dictionary with a key for each CheckMate process.")
-                sys.exit()
-
-            xsecsAll = pyslha.readSLHAFile(f).xsections
-            for pTag,xsecTuple in useSLHA.items():
-                if not xsecTuple in xsecsAll: continue
-                xsecs = xsecsAll[xsecTuple].xsecs
-                xsecs = sorted(xsecs, key = lambda xsec: xsec.qcd_order,
-                                reverse=True)
-                xsecDict[pTag] = xsecs[0]
+    return inputFiles,gridFiles
 
-        for pTag in processTags:
-            pName = newParser.get(pTag,"Name")
-            newParser.set(pTag,"MGparam",f)
-            if useSLHA:
+def iterChunks(iterable,minSize=64,maxSize=4096):
+    """
+    Split an iterable in lists with sizes doubling from minSize up to maxSize.
+    """
+
+    size = minSize
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator,size))
+        if not chunk:
+            return
+        yield chunk
+        size = min(2*size,maxSize)
+
+def countPoints(parser,inputFiles):
+    """
+    Number of points defined by the input files and the $loop{} options.
+    """
+
+    return len(inputFiles)*parser.countLoops()
+
+def getPointParsers(parser,inputFiles,ncpus=1,updateCache=True):
+    """
+    Create the parser for each point (see iterPointParsers).
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param inputFiles: List of paths to the input SLHA files
+    :param ncpus: Number of processes used for reading the cross-sections
+    :param updateCache: If False, the cross-section cache is not written (see slhaTools.getXSections)
+
+    :return: List of parsers and dictionary with the names of the points with ('found')
+             and without ('missing') cross-sections for each process in useSLHAxsecs
+    """
+
+    xsecReport = {'found' : {}, 'missing' : {}}
+    parserList = list(iterPointParsers(parser,inputFiles,ncpus,xsecReport,updateCache))
+
+    return parserList,xsecReport
+
+def iterPointParsers(parser,inputFiles,ncpus=1,xsecReport=None,updateCache=True):
+    """
+    Create the parser for each input file and each combination of the $loop{}
+    options (with the SLHA file, point name and cross-sections set).
+    The parsers are only created when requested, so large scans can start
+    before all points are read. The points from loops get the loop index
+    appended to their name.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param inputFiles: List of paths to the input SLHA files or iterator yielding the paths
+                       as the files are created (see slhaGridGenerator.generateGrid). In the
+                       latter case, the cross-sections are read in chunks of growing size.
+    :param ncpus: Number of processes used for reading the cross-sections
+    :param xsecReport: If a dictionary is given, the names of the points with ('found')
+                       and without ('missing') cross-sections for each process in useSLHAxsecs
+                       are stored in it (only for the first loop point of each input file).
+                       The input files which do not exist (yet) are not included.
+    :param updateCache: If False, the cross-section cache is not written (see slhaTools.getXSections)
+
+    :return: Generator over the parsers
+    """
+
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+
+    #Read the cross-sections from the SLHA files (in parallel and using the cache):
+    xsecsAllFiles = {}
+    xsecCacheFile = None
+    if parser.has_option("options","useSLHAxsecs"):
+        if parser.has_option("options","xsecCacheFile"):
+            xsecCacheFile = os.path.abspath(parser.get("options","xsecCacheFile"))
+        else:
+            xsecCacheFile = os.path.join(outputDir,'slhaXsecCache.json')
+    if isinstance(inputFiles,(list,tuple)):
+        fileChunks = iter([list(inputFiles)])
+    else:
+        fileChunks = iterChunks(inputFiles)
+
+    def iterFiles():
+        #The files already read (for the loop points after the first one) and then the new ones:
+        for f in list(readFiles):
+            yield f
+        for chunk in fileChunks:
+            if xsecCacheFile is not None:
+                xsecsAllFiles.update(getXSections([f for f in chunk if os.path.isfile(f)],cacheFile=xsecCacheFile,
+                                                  ncpus=ncpus,updateCache=updateCache))
+            for f in chunk:
+                readFiles.append(f)
+                yield f
+
+    readFiles = []
+    if xsecReport is None:
+        xsecReport = {'found' : {}, 'missing' : {}}
+    for iLoop,loopParser in parser.iterLoops():
+        for f in iterFiles():
+            newParser = loopParser.clone()
+            name = os.path.splitext(os.path.basename(f))[0]
+            if iLoop is not None:
+                name += '_loop%i' %iLoop
+            newParser.set("CheckMateParameters","SLHAFile",f)
+            newParser.set("CheckMateParameters","Name",name)
+            newParser.set("CheckMateParameters","OutputDirectory",outputDir)
+            #Get tags of processes:
+            processTags = getProcessTags(newParser)
+
+            #Get xsec dictionary:
+            useSLHA = False
+            unit = 'PB'
+            xsecDict = {}
+            if newParser.has_option("options","xsecUnit"):
+                unit = newParser.get("options","xsecUnit")
+            if newParser.has_option("options","useSLHAxsecs"):
+                useSLHA = newParser.get("options","useSLHAxsecs")
+                if not isinstance(useSLHA,dict):
+                    logger.error("useSLHAxsecs should be defined as dictionary with a key for each CheckMate process.")
+                    sys.exit()
+
+                #Center-of-mass energy (in TeV) of the cross-sections used:
+                sqrts = None
+                if newParser.has_option("options","xsecSqrts"):
+                    sqrts = float(newParser.get("options","xsecSqrts"))
+                xsecsAll = xsecsAllFiles.get(f,{})
+                for pTag,xsecTuple in useSLHA.items():
+                    if not xsecTuple in xsecsAll: continue
+                    xsecs = xsecsAll[xsecTuple]
+                    if sqrts is not None:
+                        xsecs = [xsec for xsec in xsecs if abs(xsec[0]-1000.*sqrts) < 1.]
+                        if not xsecs: continue
+                    elif len(set([xsec[0] for xsec in xsecs])) > 1:
+                        logger.error("%s has cross-sections for %s at several energies (%s GeV). Set xsecSqrts in [options] to select one."
+                                     %(f,str(xsecTuple),', '.join(['%1.0f' %e for e in sorted(set([xsec[0] for xsec in xsecs]))])))
+                        sys.exit()
+                    xsecs = sorted(xsecs, key = lambda xsec: xsec[1],
+                                    reverse=True)
+                    xsecDict[pTag] = xsecs[0][2]
+
+            for pTag in processTags:
+                pName = newParser.get(pTag,"Name")
+                newParser.set(pTag,"MGparam",f)
+                if useSLHA:
+                    if pTag in xsecDict:
+                        newParser.set(pTag,"XSect", "%1.5g %s" %(xsecDict[pTag],unit))
+                    if pName in xsecDict:
+                        newParser.set(pTag,"XSect", "%1.5g %s" %(xsecDict[pName],unit))
+
+            #The cross-sections only depend on the input file:
+            for pTag in (useSLHA or {}) if not iLoop and f in xsecsAllFiles else []:
+                xsecReport['found'].setdefault(pTag,[])
+                xsecReport['missing'].setdefault(pTag,[])
                 if pTag in xsecDict:
-                    newParser.set(pTag,"XSect", "%1.5g %s" %(xsecDict[pTag].value,unit))
-                if pName in xsecDict:
-                    newParser.set(pTag,"XSect", "%1.5g %s" %(xsecDict[pName].value,unit))
+                    xsecReport['found'][pTag].append(name)
+                else:
+                    xsecReport['missing'][pTag].append(name)
 
-        parserList.append(newParser)
+            yield newParser
+
+def checkParameters(parser,inputFiles):
+    """
+    Check the parameters for the first point (see ConfigParserExt.validate), so
+    invalid expressions and undefined references are found before running.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param inputFiles: List of paths to the input SLHA files
+
+    :return: List of error messages (empty if no problems were found)
+    """
+
+    if not inputFiles:
+        return parser.validate()
+    try:
+        pointParser = next(iterPointParsers(parser,inputFiles[:1],updateCache=False))
+    except ParsingError as e:
+        return [str(e)]
+
+    return pointParser.validate()
+
+def main(parfile,verbose,plan=False):
+    """
+    Submit parallel jobs using the parameter file.
+
+    :param parfile: name of the parameter file.
+    :param verbose: level of debugging messages.
+    :param plan: if True, only report the scan plan (see planScan).
+    """
+
+    setLogLevel(verbose)
+
+    parser = ConfigParserExt()
+    ret = parser.read(parfile)
+    if ret == []:
+        logger.error( "No such file or directory: '%s'" % parfile)
+        sys.exit()
+
+    inputFiles,gridFiles = getInputFiles(parser,plan)
+    problems = checkParameters(parser,inputFiles)
+    for problem in problems:
+        logger.error("Invalid parameter %s" %problem)
+    if problems:
+        sys.exit()
+    if plan:
+        planScan(parser,inputFiles)
+    else:
+        runScan(parser,inputFiles,gridFiles)
+
+def runScan(parser,inputFiles,fileSource=None):
+    """
+    Run CheckMATE over the input files, skipping the points which have already been computed.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param inputFiles: List of paths to the input SLHA files
+    :param fileSource: Iterator yielding the paths in inputFiles as the files are created
+                       (e.g. slhaGridGenerator.generateGrid). If None, the files must already exist.
+
+    :return: Path to the results table
+    """
 
     ncpus = int(parser.get("options","ncpu"))
     if ncpus  < 0:
         ncpus =  multiprocessing.cpu_count()
-    ncpus = min(ncpus,len(parserList))
-    pool = multiprocessing.Pool(processes=ncpus)
-    children = []
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+
+    #The points are only read when they can be submitted (see iterPointParsers):
+    nPoints = countPoints(parser,inputFiles)
+    xsecReport = {'found' : {}, 'missing' : {}}
+    if fileSource is None:
+        fileSource = inputFiles
+    pointParsers = iterPointParsers(parser,fileSource,ncpus,xsecReport)
+
+    #Check the scan ledger and select the points which have to be (re-)run:
+    ledgerFile = getLedgerFile(parser)
+    resume = True
+    if parser.has_option("options","resume"):
+        resume = parser.get("options","resume")
+    ledger = ScanLedger(ledgerFile)
+    #The runtime model uses the timings from previous runs (stored in the ledger):
+    costModel = None
+    if not parser.has_option("options","orderJobs") or parser.get("options","orderJobs") is True:
+        costModel = getCostModel(parser,ledger)
+    orderWindow = 1000
+    if parser.has_option("options","orderWindow"):
+        orderWindow = parser.get("options","orderWindow")
+    #Points with the same physics content and steering card share the results:
+    store = None
+    if parser.has_option("options","resultStore"):
+        useLinks = True
+        if parser.has_option("options","resultStoreLinks"):
+            useLinks = parser.get("options","resultStoreLinks")
+        storeBlocks = ['MASS','DECAY','XSECTION']
+        if parser.has_option("options","resultStoreBlocks"):
+            storeBlocks = parser.get("options","resultStoreBlocks")
+        store = ResultStore(parser.get("options","resultStore"),useLinks=useLinks)
+
+    #Results table:
+    resultsFile = getResultsFile(parser)
+    resultParameters = None
+    if parser.has_option("options","resultParameters"):
+        resultParameters = parser.get("options","resultParameters")
+    table = ResultsTable(resultsFile)
+
+    progress = ProgressMonitor(nPoints)
+    contentHashes = {}
+    primaries = {}
+    primaryStatus = {}
+    duplicates = {}
+    #Number of points read, selected to run and passed to the scheduler:
+    selection = {'finished' : 0, 'served' : 0, 'jobs' : 0, 'exhausted' : False,
+                 'read' : 0, 'selected' : 0, 'scheduled' : 0}
+
+    def serveDuplicate(primary,status,dupName,dupSLHAFile):
+        #Points with the same content get the results from the store:
+        if status == 'finished' and storedPoint(store,contentHashes[primary],dupName,dupSLHAFile,
+                                                outputDir,ledger,table,resultParameters):
+            message = "Same content as %s, results taken from the result store" %primary
+            dupFailed = False
+        else:
+            message = "Same content as %s, which failed" %primary
+            ledger.recordResult(dupName,'failed',message=message)
+            dupFailed = True
+        print("%s -- %s: %s" %(progress.update(failed=dupFailed),dupName,message))
+
+    def iterJobWindows():
+        #Select the points to run, in windows of orderWindow points, and order
+        #each window by the expected runtime (longest first):
+        window = []
+        ledgerEntries = []
+        servedPoints = []
+        for newParser in itertools.chain(pointParsers,[None]):
+            if newParser is not None:
+                selection['read'] += 1
+                name = newParser.get("CheckMateParameters","Name")
+                slhaFile = newParser.get("CheckMateParameters","SLHAFile")
+                slhaHash,slhaMtime,slhaSize = ledger.getSLHAHash(name,slhaFile)
+                cardHash = stringHash(getCheckMateCardText(newParser))
+                outputFile = os.path.join(outputDir,name,'evaluation','total_results.txt')
+                state = ledger.getState(name,slhaHash,cardHash,outputFile)
+                if resume and state == 'finished':
+                    selection['finished'] += 1
+                    progress.nJobs -= 1
+                    continue
+                logger.debug("Point %s is %s" %(name,state))
+                ledgerEntries.append({'name' : name, 'slhaFile' : slhaFile,
+                                      'slhaMtime' : slhaMtime, 'slhaSize' : slhaSize,
+                                      'slhaHash' : slhaHash, 'cardHash' : cardHash,
+                                      'status' : 'queued', 'submitTime' : time.time()})
+                if store is not None:
+                    contentHash = getContentHash(slhaFile,getCheckMateCardText(newParser),
+                                                 newParser.toDict(raw=False)['options'],storeBlocks)
+                    contentHashes[name] = contentHash
+                    if resume and store.has(contentHash):
+                        servedPoints.append((None,name,slhaFile))
+                        continue
+                    #Only run the first point with the same content:
+                    if contentHash in primaries:
+                        primary = primaries[contentHash]
+                        if contentHash in primaryStatus: #Already done
+                            servedPoints.append((primary,name,slhaFile))
+                        else:
+                            duplicates.setdefault(primary,[]).append((name,slhaFile))
+                        continue
+                    primaries[contentHash] = name
+                parserDict = newParser.toDict(raw=False) #Must convert to dictionary for pickling
+                #Results from failed or outdated runs must be removed
+                parserDict['options']['rerun'] = (state != 'missing' or not resume)
+                window.append((parserDict,name,slhaFile))
+                selection['selected'] += 1
+                if len(window) < orderWindow:
+                    continue
+            else:
+                selection['exhausted'] = True
+
+            ledger.update(ledgerEntries)
+            ledgerEntries = []
+            for primary,name,slhaFile in servedPoints:
+                if primary is None:
+                    storedPoint(store,contentHashes[name],name,slhaFile,outputDir,ledger,table,resultParameters)
+                    selection['served'] += 1
+                    progress.nJobs -= 1
+                else:
+                    serveDuplicate(primary,primaryStatus[contentHashes[primary]],name,slhaFile)
+            servedPoints = []
+            if selection['exhausted']:
+                for pTag,missing in xsecReport['missing'].items():
+                    if missing:
+                        logger.warning("Cross-section for %s not found in %i SLHA files (e.g. %s)"
+                                       %(pTag,len(missing),missing[0]))
+                logger.info("%i points already finished (ledger: %s)" %(selection['finished'],ledgerFile))
+                if selection['served']:
+                    print("%i points served from the result store %s" %(selection['served'],store.storeFolder))
+            if not window:
+                continue
+            #Estimate the runtime of each point and submit the longest ones first:
+            if costModel is not None:
+                costs = [costModel.estimate(name,slhaFile) for _,name,slhaFile in window]
+                window = [window[i] for i in orderJobs(costs)]
+                if not selection['jobs']:
+                    costs = sorted(costs,reverse=True)
+                    if not selection['exhausted']:
+                        print("Jobs are ordered in windows of %i points. Estimates for the first window:" %orderWindow)
+                    print("Expected makespan: %s on %i cores (total %s of CPU time, longest point %s)"
+                          %(formatTime(getMakespan(costs,ncpus)),ncpus,formatTime(sum(costs)),formatTime(costs[0])))
+                    print("  with %i cores: %s, with %i cores: %s"
+                          %(max(1,ncpus//2),formatTime(getMakespan(costs,max(1,ncpus//2))),
+                            2*ncpus,formatTime(getMakespan(costs,2*ncpus))))
+            selection['jobs'] += len(window)
+            yield window
+            window = []
+
+    jobWindows = iterJobWindows()
+    firstWindow = next(jobWindows,[])
+    if not firstWindow:
+        print("All %i points have already been computed" %nPoints)
+        table.close()
+        ledger.close()
+        return resultsFile
+
+    if selection['exhausted']:
+        ncpus = min(ncpus,len(firstWindow))
+    #The number of running jobs is limited by the available memory:
+    jobMemory = getJobMemory(parser)
+    if jobMemory:
+        minFreeMemory = 0.1
+        if parser.has_option("options","minFreeMemory"):
+            minFreeMemory = parser.get("options","minFreeMemory")
+        memorySlots = getMemorySlots(jobMemory,minFreeMemory)
+        if memorySlots is not None and memorySlots < ncpus:
+            print("Available memory is enough for %i jobs of %1.0f MB (running jobs will be limited)"
+                  %(memorySlots,jobMemory))
+    #Pin each job to a set of cores:
+    pinCores = parser.has_option("options","pinCores") and parser.get("options","pinCores") is True
+    executorType = 'pool'
+    if parser.has_option("options","executor"):
+        executorType = parser.get("options","executor").lower()
+    if executorType == 'workqueue':
+        #Jobs are run by workers (started with scanExecutors.py) reading from the queue file:
+        if parser.has_option("options","queueFile"):
+            queueFile = os.path.abspath(parser.get("options","queueFile"))
+        else:
+            queueFile = os.path.join(outputDir,'workQueue.sqlite')
+        maxAttempts = 3
+        if parser.has_option("options","maxQueueAttempts"):
+            maxAttempts = int(parser.get("options","maxQueueAttempts"))
+        executor = WorkQueueExecutor(queueFile,maxAttempts=maxAttempts)
+        logger.info("Jobs will be sent to the work queue %s" %queueFile)
+    elif executorType == 'pool':
+        #Recycle workers after a number of tasks (avoid slowdowns from leaks in long scans):
+        maxTasks = None
+        if parser.has_option("options","maxTasksPerWorker"):
+            maxTasks = parser.get("options","maxTasksPerWorker")
+        executor = PoolExecutor(ncpus,maxTasksPerWorker=maxTasks)
+    else:
+        logger.error("Unknown executor %s (should be pool or workqueue)" %executorType)
+        sys.exit()
+
+    #Scheduler options:
+    schedulerOpts = {}
+    for opt in ['startupTime','minFreeMemory','maxIOWait','maxCPULoad']:
+        if parser.has_option("options",opt):
+            schedulerOpts[opt] = parser.get("options",opt)
+    scheduler = AdmissionScheduler(executor,ncpus,jobMemory=jobMemory,**schedulerOpts)
+
+    #The name, SLHA file and parameters of the jobs not yet finished (by job index):
+    jobInfo = {}
+    def iterJobs():
+        jobID = 0
+        for window in itertools.chain([firstWindow],jobWindows):
+            for parserDict,name,slhaFile in window:
+                if pinCores:
+                    parserDict['options']['coreSlots'] = ncpus
+                jobInfo[jobID] = (name,slhaFile,parserDict)
+                jobID += 1
+                selection['scheduled'] = jobID
+                yield (parserDict,)
+            del window[:]
+
     #Loop over parsers and submit jobs
-    logger.info("Submitting %i jobs over %i cores" %(len(parserList),ncpus))
+    logger.info("Submitting up to %i jobs over %i cores" %(progress.nJobs,ncpus))
+
+    #The retention policy is applied to the finished points by background threads:
+    retention = None
+    retentionPolicy = getRetentionPolicy(parser)
+    if retentionPolicy:
+        nThreads = 2
+        if parser.has_option("options","retentionThreads"):
+            nThreads = parser.get("options","retentionThreads")
+        retention = RetentionPool(retentionPolicy,nThreads)
+
+    #Timing and resource metrics for each job:
+    metricsFile = getMetricsFile(parser)
+    metricsLog = MetricsLog(metricsFile)
+
+    #Retry options:
+    maxRetries = 2
+    retryBackoff = 60.
+    if parser.has_option("options","maxRetries"):
+        maxRetries = int(parser.get("options","maxRetries"))
+    if parser.has_option("options","retryBackoff"):
+        retryBackoff = float(parser.get("options","retryBackoff"))
+    nAttempts = {}
+
+    def nUnread():
+        #Jobs selected but not yet passed to the scheduler and points not yet read
+        #(an upper bound, since some of them may be finished or served from the store):
+        return (selection['selected']-selection['scheduled'])+(nPoints-selection['read'])
+
+    #Store results and print progress as jobs finish:
+    for jobID,out in scheduler.iterResults(RunCheckMate,iterJobs(),nUnread):
+        name,slhaFile,parserDict = jobInfo[jobID]
+        nAttempts[jobID] = nAttempts.get(jobID,0)+1
+        if not isinstance(out,Exception) and 'metrics' in out:
+            entry = dict(out['metrics'])
+            entry.update({'name' : name, 'attempt' : nAttempts[jobID], 'status' : out['status'],
+                          'submitTime' : scheduler.submitTimes.get(jobID),
+                          'startTime' : out['startTime'], 'endTime' : out['endTime'],
+                          'returncode' : out.get('returncode'), 'timedOut' : out.get('timedOut')})
+            metricsLog.add(entry)
+        failed = isinstance(out,Exception) or out['status'] == 'failed'
+        if failed and nAttempts[jobID] <= maxRetries:
+            delay = retryBackoff*2**(nAttempts[jobID]-1)
+            if isinstance(out,Exception):
+                message = str(out)
+            else:
+                message = out['message']
+            logger.warning("Job for point %s failed (attempt %i). Retrying in %1.0f s"
+                           %(name,nAttempts[jobID],delay))
+            ledger.recordResult(name,'failed',message=message)
+            parserDict['options']['rerun'] = True #Remove the output from the failed run
+            scheduler.resubmit(jobID,delay=delay)
+            continue
+        if isinstance(out,Exception):
+            logger.error("Job for point %s failed: %s" %(name,out))
+            ledger.recordResult(name,'failed',message=str(out))
+            print("%s -- %s: failed" %(progress.update(failed=True),name))
+            status = 'failed'
+        else:
+            outputFile = os.path.join(out['resultFolder'],'evaluation','total_results.txt')
+            status = out['status']
+            startTime,endTime = out['startTime'],out['endTime']
+            if status == 'skipped' and os.path.isfile(outputFile):
+                status = 'finished' #Keep results from previous runs
+                #Nothing was run, keep the timings of the previous run (if any) for the cost model:
+                previous = ledger.entries.get(name,{})
+                startTime,endTime = previous.get('startTime'),previous.get('endTime')
+            if status == 'finished':
+                ledger.recordResult(name,status,outputFile=outputFile,startTime=startTime,
+                                    endTime=endTime,message=out['message'])
+                try:
+                    table.addPoint(name,getSLHAParameters(slhaFile,resultParameters),
+                                   readTotalResults(outputFile))
+                except Exception as e:
+                    logger.error("Could not store results for point %s: %s" %(name,e))
+                if store is not None:
+                    store.publish(contentHashes[name],out['resultFolder'],name)
+                if retention is not None and 'retentionCounts' in out:
+                    retention.addCounts(out['retentionCounts']) #Already applied in the scratch folder
+                elif retention is not None and out['status'] == 'finished':
+                    retention.submit(out['resultFolder'])
+            else:
+                ledger.recordResult(name,status,startTime=out['startTime'],
+                                    endTime=out['endTime'],message=out['message'])
+            print("%s -- %s: %s" %(progress.update(failed=(status != 'finished')),name,out['message']))
+        jobInfo.pop(jobID)
+        if store is not None:
+            primaryStatus[contentHashes[name]] = status
+        for dupName,dupSLHAFile in duplicates.pop(name,[]):
+            serveDuplicate(name,status,dupName,dupSLHAFile)
+    table.close()
+    executor.close()
+    ledger.close()
+    if retention is not None:
+        counts = retention.close()
+        print("Retention policy: %i files kept, %i compressed and %i dropped"
+              %(counts['keep'],counts['compress'],counts['drop']))
+    metricsLog.close()
+    print(summarizeMetrics(metricsLog.entries))
+    print("Job metrics stored in %s" %metricsFile)
+
+    print(scheduler.report())
+
+    return resultsFile
+
+def planScan(parser,inputFiles):
+    """
+    Dry run: render the steering cards for all points (without running CheckMATE)
+    and report the number of jobs, the cross-sections found and the estimated
+    CPU time, disk usage and memory. The estimates use the timings in the
+    scan ledger and the job metrics from previous runs.
+
+    :param parser: ConfigParser object with all the parameters needed
+    :param inputFiles: List of paths to the input SLHA files
+
+    :return: Dictionary with the plan summary
+    """
+
+    ncpus = int(parser.get("options","ncpu"))
+    if ncpus  < 0:
+        ncpus =  multiprocessing.cpu_count()
+    outputDir = os.path.abspath(parser.get("CheckMateParameters","OutputDirectory"))
+    checkmateExe = os.path.join(os.path.abspath(parser.get("options","checkmateFolder")),'bin','CheckMATE')
+    resume = True
+    if parser.has_option("options","resume"):
+        resume = parser.get("options","resume")
+    problems = []
+    if not os.path.isfile(checkmateExe):
+        problems.append("CheckMATE executable %s not found" %checkmateExe)
+
+    parserList,xsecReport = getPointParsers(parser,inputFiles,ncpus,updateCache=False)
+
+    #Only use the ledger if it exists (the dry run should not create it):
+    ledgerFile = getLedgerFile(parser)
+    ledger = None
+    if os.path.isfile(ledgerFile):
+        ledger = ScanLedger(ledgerFile)
+    states = {}
+    badCards = []
+    jobNames = []
+    jobSLHAFiles = []
     for newParser in parserList:
-        logger.debug("Submitting job for file %s"
-                    %(newParser.get("CheckMateParameters","SLHAFile")))
-        parserDict = newParser.toDict(raw=False) #Must convert to dictionary for pickling
-        p = pool.apply_async(RunCheckMate, args=(parserDict,))
-        children.append(p)
-        time.sleep(10)
+        name = newParser.get("CheckMateParameters","Name")
+        slhaFile = newParser.get("CheckMateParameters","SLHAFile")
+        cardText = getCheckMateCardText(newParser)
+        if cardText is False:
+            badCards.append(name)
+            continue
+        state = 'missing'
+        if ledger is not None and not os.path.isfile(slhaFile): #Grid file not yet written
+            if name in ledger.entries:
+                state = 'stale'
+        elif ledger is not None:
+            slhaHash = ledger.getSLHAHash(name,slhaFile)[0]
+            outputFile = os.path.join(outputDir,name,'evaluation','total_results.txt')
+            state = ledger.getState(name,slhaHash,stringHash(cardText),outputFile)
+        states[state] = states.get(state,0)+1
+        if resume and state == 'finished':
+            continue
+        jobNames.append(name)
+        jobSLHAFiles.append(slhaFile)
+    if badCards:
+        problems.append("Steering card could not be created for %i points (e.g. %s)" %(len(badCards),badCards[0]))
 
+    #Runtime estimates (from the ledger timings):
+    costModel = getCostModel(parser,ledger)
+    if ledger is not None:
+        ledger.close()
+    costs = [costModel.estimate(name,slhaFile) for name,slhaFile in zip(jobNames,jobSLHAFiles)]
+    nJobs = len(jobNames)
+    nRunning = max(1,min(ncpus,nJobs))
+    plan = {'points' : len(parserList), 'jobs' : nJobs, 'states' : states,
+            'coreHours' : sum(costs)/3600., 'makespan' : getMakespan(sorted(costs,reverse=True),ncpus),
+            'cpuHours' : None, 'diskBytes' : None, 'memoryMB' : None}
+
+    #Resource estimates (from the job metrics of previous runs):
+    metrics = readMetrics(getMetricsFile(parser))
+    if metrics:
+        wallTime = sum([e['wallTime'] for e in metrics])
+        cpuTime = sum([e.get('cpuUser',0.)+e.get('cpuSystem',0.) for e in metrics])
+        if wallTime > 0.:
+            plan['cpuHours'] = plan['coreHours']*cpuTime/wallTime
+        outputBytes = [e['outputBytes'] for e in metrics if 'outputBytes' in e]
+        if outputBytes:
+            plan['diskBytes'] = nJobs*np.percentile(outputBytes,90)
+        plan['memoryMB'] = nRunning*np.percentile([e.get('maxRSS',0.) for e in metrics],90)
+
+    #Compare with the available resources:
+    folder = outputDir
+    while not os.path.isdir(folder):
+        folder = os.path.dirname(folder)
+    freeDisk = shutil.disk_usage(folder).free
+    totalMemory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024.**2
+    if plan['diskBytes'] is not None and plan['diskBytes'] > freeDisk:
+        problems.append("Estimated disk usage (%1.1f GB) exceeds the free space in %s (%1.1f GB)"
+                        %(plan['diskBytes']/1e9,folder,freeDisk/1e9))
+    if plan['memoryMB'] is not None and plan['memoryMB'] > totalMemory:
+        problems.append("Estimated memory for %i simultaneous jobs (%1.1f GB) exceeds the total memory (%1.1f GB)"
+                        %(nRunning,plan['memoryMB']/1024.,totalMemory/1024.))
+    for pTag,missing in xsecReport['missing'].items():
+        if missing:
+            problems.append("Cross-section for %s missing in %i SLHA files (e.g. %s)" %(pTag,len(missing),missing[0]))
+    plan['problems'] = problems
+
+    print("Scan plan for %i points (%s)" %(len(parserList),
+                                           ", ".join(["%i %s" %(n,state) for state,n in sorted(states.items())])))
+    print("  jobs to run: %i over %i cores" %(nJobs,ncpus))
+    for pTag in sorted(xsecReport['found']):
+        print("  cross-sections for %s: %i found, %i missing" %(pTag,len(xsecReport['found'][pTag]),
+                                                                  len(xsecReport['missing'][pTag])))
+    print("  expected wall time: %s (%1.1f core-hours, %i timings in the ledger)"
+          %(formatTime(plan['makespan']),plan['coreHours'],len(costModel.timings)))
+    if metrics:
+        print("  expected CPU time: %1.1f CPU-hours (from %i jobs in the metrics file)" %(plan['cpuHours'] or 0.,len(metrics)))
+        if plan['diskBytes'] is not None:
+            print("  expected disk usage: %1.2f GB before the retention policy (%1.2f GB free)"
+                  %(plan['diskBytes']/1e9,freeDisk/1e9))
+        print("  expected memory: %1.2f GB for %i simultaneous jobs (%1.2f GB total)"
+              %(plan['memoryMB']/1024.,nRunning,totalMemory/1024.))
+    else:
+        print("  no job metrics from previous runs: CPU time, disk and memory can not be estimated")
+    for problem in problems:
+        print("WARNING: %s" %problem)
 
-    #Wait for jobs to finish:
-    output = [p.get() for p in children]
-    for out in output:
-        print(out)
+    return plan
 
 
 if __name__ == "__main__":
@@ -238,6 +1331,8 @@ if __name__ == "__main__":
             help='path to the parameters file. Default is checkmate_parameters.ini')
     ap.add_argument('-v', '--verbose', default='error',
             help='verbose level (debug, info, warning or error). Default is error')
+    ap.add_argument('--plan', action='store_true',
+            help='dry run: report the number of jobs, missing cross-sections and the expected CPU time, disk and memory usage without running CheckMATE')
 
 
     t0 = time.time()
@@ -247,6 +1342,6 @@ if __name__ == "__main__":
     t0 = time.time()
 
     args = ap.parse_args()
-    output = main(args.parfile,args.verbose)
+    output = main(args.parfile,args.verbose,plan=args.plan)
 
     print("\n\nDone in %3.2f min" %((time.time()-t0)/60.))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""Executors used by the scan scheduler to run the jobs (local process pool or shared work queue)."""
+
+#The work queue backend stores the pickled jobs in a SQLite file. Worker processes
+#started on any node with access to the file (e.g. on a shared filesystem) pull
+#jobs from the queue, send heartbeats while running them and store the results,
+#which are then collected by the scan driver. Note that SQLite locking relies on
+#the filesystem, so the queue file should be on a filesystem with working POSIX locks.
+#Each row keeps the worker which claimed the job and the number of attempts: jobs
+#without heartbeat are put back in the queue (or marked as failed after maxAttempts)
+#and late results from a worker which no longer owns the job are discarded.
+
+import os,sys,time
+import socket
+import pickle
+import importlib
+import sqlite3
+import threading
+import multiprocessing
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExecutor(object):
+    """
+    Runs the jobs using a local multiprocessing pool.
+
+    :param ncpus: Number of worker processes
+    :param maxTasksPerWorker: Number of tasks after which the worker processes are restarted
+    """
+
+    isLocal = True
+
+    def __init__(self,ncpus,maxTasksPerWorker=None):
+
+        self.pool = multiprocessing.Pool(processes=ncpus,maxtasksperchild=maxTasksPerWorker)
+
+    def submit(self,func,args,callback):
+        """
+        Submit a job. The callback is called with the result (or the exception) when the job finishes.
+        """
+
+        self.pool.apply_async(func, args=args, callback=callback,
+                              error_callback=callback)
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+
+
+class WorkQueue(object):
+    """
+    Work queue stored in a SQLite file.
+
+    :param queueFile: Path to the SQLite file (created if it does not exist)
+    """
+
+    def __init__(self,queueFile):
+
+        self.queueFile = os.path.abspath(queueFile)
+        queueDir = os.path.dirname(self.queueFile)
+        if not os.path.isdir(queueDir):
+            os.makedirs(queueDir)
+        self.conn = sqlite3.connect(self.queueFile,timeout=120.,isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT, spec BLOB,
+                            status TEXT, worker TEXT, attempts INTEGER DEFAULT 0,
+                            submitTime REAL, startTime REAL, heartbeat REAL,
+                            endTime REAL, result BLOB)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS statusIndex ON jobs (status)")
+
+    def put(self,spec):
+        """
+        Add a job to the queue.
+
+        :param spec: Job specification (any picklable object)
+
+        :return: Job id
+        """
+
+        cur = self.conn.execute("INSERT INTO jobs (spec,status,submitTime) VALUES (?,'queued',?)",
+                                (sqlite3.Binary(pickle.dumps(spec,protocol=2)),time.time()))
+        return cur.lastrowid
+
+    def claim(self,worker):
+        """
+        Take the oldest queued job from the queue.
+
+        :param worker: Worker name
+
+        :return: Tuple with the job id and specification or None if the queue is empty
+        """
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT id,spec FROM jobs WHERE status='queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self.conn.execute("""UPDATE jobs SET status='running', worker=?, startTime=?,
+                                 heartbeat=?, attempts=attempts+1 WHERE id=?""",(worker,now,now,row[0]))
+        finally:
+            self.conn.execute("COMMIT")
+
+        return row[0],pickle.loads(row[1])
+
+    def heartbeat(self,jobID):
+        """
+        Update the heartbeat time of a running job.
+        """
+
+        self.conn.execute("UPDATE jobs SET heartbeat=? WHERE id=?",(time.time(),jobID))
+
+    def finish(self,jobID,result,failed=False,worker=None):
+        """
+        Store the result of a job.
+
+        :param jobID: Job id
+        :param result: Result (any picklable object)
+        :param failed: True if the job raised an exception (result is the exception)
+        :param worker: Worker name. If given, the result is only stored if the job is
+                       still running and owned by this worker.
+
+        :return: True if the result was stored
+        """
+
+        status = 'error' if failed else 'done'
+        values = (status,time.time(),sqlite3.Binary(pickle.dumps(result,protocol=2)),jobID)
+        if worker is None:
+            cur = self.conn.execute("UPDATE jobs SET status=?, endTime=?, result=? WHERE id=?",values)
+        else:
+            cur = self.conn.execute("""UPDATE jobs SET status=?, endTime=?, result=?
+                                       WHERE id=? AND status='running' AND worker=?""",values+(worker,))
+        return cur.rowcount == 1
+
+    def collect(self,jobIDs):
+        """
+        Remove the finished jobs among jobIDs from the queue and return their results.
+
+        :param jobIDs: Collection of job ids to be checked
+
+        :return: List of tuples (job id, result, failed)
+        """
+
+        results = []
+        rows = self.conn.execute("SELECT id,status,result FROM jobs WHERE status IN ('done','error')").fetchall()
+        for jobID,status,result in rows:
+            if not jobID in jobIDs:
+                continue
+            try:
+                result = pickle.loads(result)
+            except Exception as e:
+                result,status = e,'error'
+            results.append((jobID,result,status == 'error'))
+            self.conn.execute("DELETE FROM jobs WHERE id=?",(jobID,))
+
+        return results
+
+    def requeueStale(self,maxAge,maxAttempts=None):
+        """
+        Put running jobs without a heartbeat for more than maxAge seconds back in the queue.
+        Jobs which already ran maxAttempts times are marked as failed instead.
+
+        :param maxAge: Time (in seconds) since the last heartbeat
+        :param maxAttempts: Maximum number of attempts for each job (no limit if None)
+
+        :return: Tuple with the number of jobs put back in the queue and the number of failed jobs
+        """
+
+        tStale = time.time()-maxAge
+        nFailed = 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if maxAttempts is not None:
+                rows = self.conn.execute("""SELECT id,worker,attempts FROM jobs WHERE status='running'
+                                            AND heartbeat < ? AND attempts >= ?""",(tStale,maxAttempts)).fetchall()
+                for jobID,worker,attempts in rows:
+                    error = RuntimeError("Job lost its worker (last %s) in %i attempts" %(worker,attempts))
+                    self.conn.execute("""UPDATE jobs SET status='error', worker=NULL, endTime=?, result=?
+                                         WHERE id=?""",(time.time(),sqlite3.Binary(pickle.dumps(error,protocol=2)),jobID))
+                nFailed = len(rows)
+            cur = self.conn.execute("""UPDATE jobs SET status='queued', worker=NULL
+                                       WHERE status='running' AND heartbeat < ?""",(tStale,))
+        finally:
+            self.conn.execute("COMMIT")
+
+        return cur.rowcount,nFailed
+
+    def cancel(self,jobIDs):
+        """
+        Remove queued (not yet started) jobs from the queue.
+        """
+
+        for jobID in jobIDs:
+            self.conn.execute("DELETE FROM jobs WHERE id=? AND status='queued'",(jobID,))
+
+    def close(self):
+
+        self.conn.close()
+
+
+class WorkQueueExecutor(object):
+    """
+    Runs the jobs through a work queue shared with worker processes
+    (see runWorker), which can be running on several nodes.
+
+    :param queueFile: Path to the SQLite file used as queue
+    :param pollInterval: Time (in seconds) between checks for finished jobs
+    :param heartbeatTimeout: Running jobs without a heartbeat for longer than this
+                             time (in seconds) are put back in the queue
+    :param maxAttempts: Number of times a job is claimed by a worker before it is
+                        considered as failed (if it keeps losing its worker)
+    """
+
+    isLocal = False
+
+    def __init__(self,queueFile,pollInterval=2.,heartbeatTimeout=300.,maxAttempts=3):
+
+        self.queue = WorkQueue(queueFile)
+        self.pollInterval = float(pollInterval)
+        self.heartbeatTimeout = float(heartbeatTimeout)
+        self.maxAttempts = maxAttempts
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.poller = threading.Thread(target=self._poll)
+        self.poller.daemon = True
+        self.poller.start()
+
+    def submit(self,func,args,callback):
+        """
+        Submit a job. The callback is called with the result (or the exception) when the job finishes.
+        """
+
+        #Store the function by module and name, so it can be imported by the workers
+        module = sys.modules[func.__module__]
+        moduleDir = os.path.dirname(os.path.abspath(module.__file__))
+        moduleName = os.path.splitext(os.path.basename(module.__file__))[0]
+        with self.lock:
+            jobID = self.queue.put((moduleDir,moduleName,func.__name__,args,os.getcwd()))
+            self.callbacks[jobID] = callback
+
+    def _poll(self):
+
+        while not self.stop.wait(self.pollInterval):
+            with self.lock:
+                nStale,nFailed = self.queue.requeueStale(self.heartbeatTimeout,self.maxAttempts)
+                if nStale:
+                    logger.warning("%i jobs lost their worker and were put back in the queue" %nStale)
+                if nFailed:
+                    logger.error("%i jobs lost their worker %i times and were marked as failed"
+                                 %(nFailed,self.maxAttempts))
+                results = self.queue.collect(self.callbacks)
+                callbacks = [(self.callbacks.pop(jobID),result) for jobID,result,_ in results]
+            for callback,result in callbacks:
+                callback(result)
+
+    def close(self):
+
+        self.stop.set()
+        self.poller.join()
+        with self.lock:
+            self.queue.cancel(list(self.callbacks.keys()))
+            self.queue.close()
+
+
+def _sendHeartbeats(queueFile,jobID,interval,done):
+
+    queue = WorkQueue(queueFile)
+    while not done.wait(interval):
+        try:
+            queue.heartbeat(jobID)
+        except sqlite3.OperationalError as e:
+            logger.warning("Could not send heartbeat: %s" %e)
+    queue.close()
+
+def runWorker(queueFile,idleTimeout=600.,pollInterval=5.,heartbeatInterval=30.):
+    """
+    Pull jobs from the work queue and run them until the queue has been
+    empty for idleTimeout seconds.
+
+    :param queueFile: Path to the SQLite file used as queue
+    :param idleTimeout: Time (in seconds) to wait for new jobs before exiting.
+                        If negative, wait forever.
+    :param pollInterval: Time (in seconds) between checks for new jobs
+    :param heartbeatInterval: Time (in seconds) between heartbeats
+    """
+
+    queue = WorkQueue(queueFile)
+    worker = "%s:%i" %(socket.gethostname(),os.getpid())
+    logger.info("Worker %s waiting for jobs in %s" %(worker,queue.queueFile))
+    tIdle = time.time()
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if idleTimeout >= 0 and time.time()-tIdle > idleTimeout:
+                break
+            time.sleep(pollInterval)
+            continue
+        jobID,(moduleDir,moduleName,funcName,args,cwd) = job
+        logger.info("Worker %s running job %i" %(worker,jobID))
+        done = threading.Event()
+        heartbeat = threading.Thread(target=_sendHeartbeats,
+                                     args=(queue.queueFile,jobID,heartbeatInterval,done))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            os.chdir(cwd)
+            if not moduleDir in sys.path:
+                sys.path.insert(0,moduleDir)
+            func = getattr(importlib.import_module(moduleName),funcName)
+            result = func(*args)
+            failed = False
+        except Exception as e:
+            logger.error("Job %i failed: %s" %(jobID,e))
+            result = e
+            failed = True
+        done.set()
+        heartbeat.join()
+        if not queue.finish(jobID,result,failed=failed,worker=worker):
+            logger.warning("Job %i is no longer assigned to worker %s, result discarded" %(jobID,worker))
+        tIdle = time.time()
+
+    logger.info("Worker %s: no jobs left, exiting" %worker)
+    queue.close()
+
+
+if __name__ == "__main__":
+
+    import argparse
+    ap = argparse.ArgumentParser( description=
+            "Start worker processes which run the jobs from a scan work queue." )
+    ap.add_argument('-q', '--queue', required=True,
+            help='path to the work queue file (queueFile in the scan parameters file).')
+    ap.add_argument('-n', '--nworkers', default=1, type=int,
+            help='number of worker processes to start. Default is 1')
+    ap.add_argument('-t', '--idletimeout', default=600., type=float,
+            help='time (in seconds) to wait for new jobs before exiting (negative to wait forever). Default is 600')
+    ap.add_argument('-v', '--verbose', default='info',
+            help='verbose level (debug, info, warning or error). Default is info')
+
+    args = ap.parse_args()
+
+    FORMAT = '%(levelname)s in %(module)s.%(funcName)s() in %(lineno)s: %(message)s at %(asctime)s'
+    logging.basicConfig(format=FORMAT,datefmt='%m/%d/%Y %I:%M:%S %p',
+                        level=getattr(logging,args.verbose.upper()))
+    workers = []
+    for i in range(args.nworkers):
+        p = multiprocessing.Process(target=runWorker,args=(args.queue,args.idletimeout))
+        p.start()
+        workers.append(p)
+    for p in workers:
+        p.join()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Persistent ledger (SQLite) with the status of each point in a CheckMATE scan."""
+
+#The ledger stores, for each point (result folder name), the hash of the input
+#SLHA file, the hash of the CheckMATE steering card, the status of the last run,
+#its timings and the checksum of the evaluation output. It is used to decide which
+#points have to be (re-)run when a scan is restarted.
+
+import os,time
+import hashlib
+import sqlite3
+import logging
+from outputRetention import pointFileExists,pointFileHash
+
+logger = logging.getLogger(__name__)
+
+columns = ['name','slhaFile','slhaMtime','slhaSize','slhaHash','cardHash',
+           'status','attempts','submitTime','startTime','endTime','outputHash','message']
+
+
+def fileHash(path,blockSize=1 << 20):
+    """
+    Compute the SHA1 checksum of a file.
+
+    :param path: Path to the file
+
+    :return: Hex digest or None if the file does not exist
+    """
+
+    if not os.path.isfile(path):
+        return None
+    sha = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def stringHash(text):
+    """
+    Compute the SHA1 checksum of a string.
+    """
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ScanLedger(object):
+    """
+    Ledger with the status of each point in the scan, stored in a SQLite file.
+    All the entries are loaded in memory when the ledger is opened, so lookups
+    do not require any database queries.
+
+    :param dbFile: Path to the SQLite file (created if it does not exist)
+    """
+
+    def __init__(self,dbFile):
+
+        self.dbFile = os.path.abspath(dbFile)
+        dbDir = os.path.dirname(self.dbFile)
+        if not os.path.isdir(dbDir):
+            os.makedirs(dbDir)
+        self.conn = sqlite3.connect(self.dbFile,timeout=60.)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS points (
+                            name TEXT PRIMARY KEY, slhaFile TEXT,
+                            slhaMtime REAL, slhaSize INTEGER, slhaHash TEXT,
+                            cardHash TEXT, status TEXT, attempts INTEGER DEFAULT 0,
+                            submitTime REAL, startTime REAL, endTime REAL,
+                            outputHash TEXT, message TEXT)""")
+        self.conn.commit()
+        self.entries = {}
+        for row in self.conn.execute("SELECT %s FROM points" %(",".join(columns))):
+            entry = dict(zip(columns,row))
+            self.entries[entry['name']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getSLHAHash(self,name,slhaFile):
+        """
+        Get the hash of the SLHA file. If the file path, modification time and size
+        match the ones stored in the ledger, the stored hash is used.
+
+        :param name: Point name
+        :param slhaFile: Path to the SLHA file
+
+        :return: Tuple with (hash, mtime, size)
+        """
+
+        stat = os.stat(slhaFile)
+        entry = self.entries.get(name)
+        if entry and entry['slhaFile'] == slhaFile and entry['slhaHash']:
+            if entry['slhaMtime'] == stat.st_mtime and entry['slhaSize'] == stat.st_size:
+                return entry['slhaHash'],stat.st_mtime,stat.st_size
+
+        return fileHash(slhaFile),stat.st_mtime,stat.st_size
+
+    def getState(self,name,slhaHash,cardHash,outputFile):
+        """
+        Check the state of a point.
+
+        :param name: Point name
+        :param slhaHash: Hash of the current SLHA file
+        :param cardHash: Hash of the current steering card
+        :param outputFile: Path to the output file used to validate finished points
+                           (it may be stored in the point archive, see outputRetention)
+
+        :return: 'missing' (not in ledger), 'failed' (last run failed, was interrupted or output is missing),
+                 'stale' (input changed or output modified) or 'finished'
+        """
+
+        entry = self.entries.get(name)
+        if entry is None:
+            return 'missing'
+        if entry['status'] != 'finished':
+            return 'failed'
+        if entry['slhaHash'] != slhaHash or entry['cardHash'] != cardHash:
+            return 'stale'
+        if not pointFileExists(outputFile):
+            return 'failed'
+        if pointFileHash(outputFile) != entry['outputHash']:
+            return 'stale'
+
+        return 'finished'
+
+    def update(self,entryList,commit=True):
+        """
+        Insert or update entries in the ledger.
+
+        :param entryList: List of dictionaries with the values for the ledger columns.
+                          Must contain the 'name' key.
+        :param commit: If True, commit the changes to the database.
+        """
+
+        for newEntry in entryList:
+            name = newEntry['name']
+            entry = self.entries.setdefault(name,dict([(c,None) for c in columns]))
+            entry.update(newEntry)
+            if not entry['attempts']:
+                entry['attempts'] = 0
+        self.conn.executemany("INSERT OR REPLACE INTO points (%s) VALUES (%s)"
+                              %(",".join(columns),",".join(["?"]*len(columns))),
+                              [[self.entries[e['name']][c] for c in columns] for e in entryList])
+        if commit:
+            self.conn.commit()
+
+    def recordResult(self,name,status,outputFile=None,startTime=None,endTime=None,message=None):
+        """
+        Store the result of a run.
+
+        :param name: Point name
+        :param status: Status of the run ('finished','failed',...)
+        :param outputFile: Path to the output file (its checksum is stored)
+        :param startTime: Start time of the run
+        :param endTime: End time of the run
+        :param message: Message to be stored (e.g. error message)
+        """
+
+        entry = self.entries.get(name,{})
+        newEntry = {'name' : name, 'status' : status,
+                    'attempts' : (entry.get('attempts') or 0)+1,
+                    'startTime' : startTime, 'endTime' : endTime or time.time(),
+                    'message' : message}
+        if outputFile:
+            newEntry['outputHash'] = pointFileHash(outputFile)
+        self.update([newEntry])
+
+    def close(self):
+        """
+        Commit pending changes and close the database.
+        """
+
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""Incremental storage of the CheckMATE results and progress report for a scan."""
+
+import os,time
+import csv
+import logging
+from slhaTools import readMassesAndWidths
+from outputRetention import openPointFile
+
+logger = logging.getLogger(__name__)
+
+
+def readTotalResults(resultFile):
+    """
+    Read the CheckMATE evaluation/total_results.txt file.
+
+    :param resultFile: Path to the file (it may be stored in the point archive, see outputRetention)
+
+    :return: List of dictionaries (one for each line/signal region) with
+             the column names as keys. Numerical values are converted to floats.
+    """
+
+    rows = []
+    with openPointFile(resultFile,'r') as f:
+        header = None
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if header is None:
+                header = fields
+                continue
+            row = {}
+            for col,val in zip(header,fields):
+                try:
+                    row[col] = float(val)
+                except ValueError:
+                    row[col] = val
+            rows.append(row)
+
+    return rows
+
+def getSLHAParameters(slhaFile,parameters=None):
+    """
+    Extract the parameters defining the point from the SLHA file.
+
+    :param slhaFile: Path to the SLHA file
+    :param parameters: Dictionary with the column names as keys and (block,pdg) as values
+                       (e.g. {'mC1' : ('MASS',1000024), 'widthC1' : ('DECAY',1000024)}).
+                       If not defined, the masses and widths of all BSM particles are used.
+
+    :return: Dictionary with the parameter values
+    """
+
+    masses,widths = readMassesAndWidths(slhaFile)
+    if parameters is None:
+        parameters = {}
+        for pdg in sorted(masses,key=abs):
+            if abs(pdg) > 1000000:
+                parameters['mass_%i' %pdg] = ('MASS',pdg)
+                parameters['width_%i' %pdg] = ('DECAY',pdg)
+
+    values = {}
+    for label,(block,pdg) in parameters.items():
+        if block.upper() == 'MASS':
+            values[label] = masses.get(pdg)
+        elif block.upper() == 'DECAY':
+            values[label] = widths.get(pdg)
+        else:
+            logger.warning("Only MASS and DECAY values can be used as parameters (%s)" %label)
+            values[label] = None
+
+    return values
+
+
+class ResultsTable(object):
+    """
+    Table (CSV file) with one row for each point and signal region, containing the point
+    name, its SLHA parameters and the columns from total_results.txt.
+    Rows are appended as soon as each point finishes. If a point is re-run,
+    the old rows are removed when the table is closed.
+
+    :param tableFile: Path to the CSV file
+    """
+
+    def __init__(self,tableFile):
+
+        self.tableFile = os.path.abspath(tableFile)
+        self.header = None
+        self.nRows = {}
+        self.superseded = set()
+        if os.path.isfile(self.tableFile):
+            with open(self.tableFile,'r') as f:
+                reader = csv.reader(f)
+                self.header = next(reader,None)
+                for row in reader:
+                    if row:
+                        self.nRows[row[0]] = self.nRows.get(row[0],0)+1
+        self.fileObj = None
+        self.writer = None
+
+    def addPoint(self,name,parameters,resultRows):
+        """
+        Append the results for a point to the table.
+
+        :param name: Point name
+        :param parameters: Dictionary with the parameter values for the point
+        :param resultRows: List of dictionaries with the values for each row in total_results.txt
+        """
+
+        if self.header is None:
+            self.header = ['name']+list(parameters.keys())
+            if resultRows:
+                self.header += [c for c in resultRows[0].keys() if c not in self.header]
+        if self.writer is None:
+            newFile = not os.path.isfile(self.tableFile)
+            self.fileObj = open(self.tableFile,'a',newline='')
+            self.writer = csv.writer(self.fileObj)
+            if newFile:
+                self.writer.writerow(self.header)
+
+        if name in self.nRows:
+            self.superseded.add(name)
+        for resultRow in resultRows:
+            values = dict(parameters)
+            values.update(resultRow)
+            values['name'] = name
+            self.writer.writerow([values.get(c,'') for c in self.header])
+        self.fileObj.flush()
+        self.nRows[name] = len(resultRows)
+
+    def close(self):
+        """
+        Close the file and remove rows from previous runs of points which have been re-run.
+        """
+
+        if self.fileObj is not None:
+            self.fileObj.close()
+            self.fileObj = None
+            self.writer = None
+        if not self.superseded:
+            return
+
+        with open(self.tableFile,'r') as f:
+            rows = list(csv.reader(f))
+        header,rows = rows[0],rows[1:]
+        #Keep only the last rows for each re-run point
+        keep = []
+        nSeen = {}
+        for row in rows[::-1]:
+            if not row:
+                continue
+            name = row[0]
+            nSeen[name] = nSeen.get(name,0)+1
+            if name in self.superseded and nSeen[name] > self.nRows[name]:
+                continue
+            keep.append(row)
+        tmpFile = self.tableFile+'.tmp'
+        with open(tmpFile,'w',newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(keep[::-1])
+        os.replace(tmpFile,self.tableFile)
+        self.superseded = set()
+
+
+class ProgressMonitor(object):
+    """
+    Keeps track of the number of finished jobs and estimates the remaining time.
+
+    :param nJobs: Total number of jobs
+    """
+
+    def __init__(self,nJobs):
+
+        self.nJobs = nJobs
+        self.nDone = 0
+        self.nFailed = 0
+        self.t0 = time.time()
+
+    def update(self,failed=False):
+        """
+        Register a finished job.
+
+        :param failed: True if the job failed
+
+        :return: String with the progress status
+        """
+
+        self.nDone += 1
+        if failed:
+            self.nFailed += 1
+        elapsed = time.time()-self.t0
+        remaining = self.nJobs-self.nDone
+        eta = elapsed*remaining/float(self.nDone)
+        status = "[%i/%i] %1.1f%% done (%i failed), elapsed %s, ETA %s" %(self.nDone,self.nJobs,
+                                        100.*self.nDone/self.nJobs,self.nFailed,
+                                        formatTime(elapsed),formatTime(eta))
+
+        return status
+
+def formatTime(seconds):
+    """
+    Format a time interval as hh:mm:ss.
+    """
+
+    seconds = int(round(seconds))
+    return "%i:%02i:%02i" %(seconds//3600,(seconds%3600)//60,seconds%60)
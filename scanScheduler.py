@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+"""Adaptive admission scheduler for submitting CheckMATE jobs to an executor."""
+
+#Jobs are started as soon as a pool slot is free. The number of jobs allowed to be
+#in their start-up phase at the same time (the window) is only reduced when the machine
+#is under pressure (CPU, memory or disk I/O) while jobs are starting and it is then
+#increased again one job at a time. Contention never blocks the admission of a job
+#when no other job is starting, so all the slots are eventually filled.
+
+import os
+import time
+import queue
+import logging
+from cpuTopology import readMemoryMB,getMemorySlots
+
+logger = logging.getLogger(__name__)
+
+
+def readCPUTimes():
+    """
+    Read the aggregated CPU times from /proc/stat.
+
+    :return: Tuple with (busy,iowait,total) jiffies or None if not available.
+    """
+
+    try:
+        with open('/proc/stat','r') as f:
+            fields = f.readline().split()
+    except (IOError,OSError):
+        return None
+    if not fields or fields[0] != 'cpu':
+        return None
+    values = [int(v) for v in fields[1:]]
+    total = sum(values[:8]) #Skip guest times (already included in user)
+    idle = values[3]
+    iowait = values[4] if len(values) > 4 else 0
+    busy = total-idle-iowait
+
+    return busy,iowait,total
+
+def readMemAvailable():
+    """
+    Read the fraction of the total memory available for new processes.
+
+    :return: Available fraction (between 0 and 1) or None if not available.
+    """
+
+    total,available = readMemoryMB()
+    if total is None:
+        return None
+
+    return available/total
+
+
+class AdmissionScheduler(object):
+    """
+    Submits jobs to an executor (see scanExecutors), starting them as soon as
+    a slot is free and the resources allow it. For executors which do not run
+    the jobs on the local machine, the local resources are not checked.
+
+    :param executor: Executor object used to run the jobs
+    :param ncpus: Maximum number of jobs running simultaneously
+    :param startupTime: Time (in seconds) a job is considered to be starting up
+    :param minFreeMemory: Fraction of available memory below which the start-up window is reduced
+    :param maxIOWait: Fraction of CPU time spent waiting for I/O above which the start-up window is reduced
+    :param maxCPULoad: Fraction of busy CPU time above which the start-up window is reduced (only if
+                       the CPU usage is also above the one expected from the running jobs)
+    :param interval: Time (in seconds) between resource checks
+    :param reportInterval: Time (in seconds) between status reports
+    :param jobMemory: Expected peak memory (in MB) of each job. If defined, the number of
+                      running jobs is limited by the available memory (shrinking and growing with it)
+    """
+
+    def __init__(self,executor,ncpus,startupTime=60.,minFreeMemory=0.1,
+                 maxIOWait=0.25,maxCPULoad=0.98,interval=0.5,reportInterval=60.,jobMemory=None):
+
+        self.executor = executor
+        self.ncpus = max(1,int(ncpus))
+        self.startupTime = float(startupTime)
+        self.minFreeMemory = float(minFreeMemory)
+        self.maxIOWait = float(maxIOWait)
+        self.maxCPULoad = float(maxCPULoad)
+        self.interval = float(interval)
+        self.reportInterval = float(reportInterval)
+        self.jobMemory = jobMemory
+
+        self.window = self.ncpus
+        self.running = {}
+        self.submitTimes = {}
+        self.jobs = {}
+        self.pending = []
+        self.source = None
+        self.nUnread = None
+        self.delayed = []
+        self.finished = queue.Queue()
+        self.lastCPU = readCPUTimes()
+        self.stats = {'submitted' : 0, 'completed' : 0, 'contention' : 0,
+                      'idleCoreTime' : 0., 'queuedIdleCoreTime' : 0.,
+                      'maxQueueDepth' : 0, 'queueDepthTime' : 0.,
+                      'wallTime' : 0., 'memoryLimited' : 0, 'minMemoryLimit' : self.ncpus}
+
+    def sampleResources(self):
+        """
+        Compute the CPU usage since the last call and the available memory.
+
+        :return: Tuple with (busy fraction, iowait fraction, available memory fraction).
+                 Values which can not be obtained are set to None.
+        """
+
+        busyFrac,iowaitFrac = None,None
+        cpu = readCPUTimes()
+        if cpu is not None and self.lastCPU is not None:
+            dTotal = cpu[2]-self.lastCPU[2]
+            if dTotal > 0:
+                busyFrac = (cpu[0]-self.lastCPU[0])/float(dTotal)
+                iowaitFrac = (cpu[1]-self.lastCPU[1])/float(dTotal)
+        if cpu is not None:
+            self.lastCPU = cpu
+
+        return busyFrac,iowaitFrac,readMemAvailable()
+
+    def isContended(self,busyFrac,iowaitFrac,memFrac):
+        """
+        Check if the resources are under pressure. The CPU is only considered
+        contended if its usage is above the one expected from the running jobs
+        (one core per job), so a full machine running the scan jobs is not contended.
+        """
+
+        if memFrac is not None and memFrac < self.minFreeMemory:
+            return True
+        if iowaitFrac is not None and iowaitFrac > self.maxIOWait:
+            return True
+        if busyFrac is not None and busyFrac > self.maxCPULoad:
+            expectedLoad = len(self.running)/float(os.cpu_count() or 1)
+            if busyFrac > expectedLoad:
+                return True
+        return False
+
+    def getMemoryLimit(self,nStarting):
+        """
+        Maximum number of running jobs allowed by the available memory. The jobs
+        still starting up are assumed to have not yet reached their peak memory.
+
+        :param nStarting: Number of running jobs in their start-up phase
+
+        :return: Maximum number of running jobs
+        """
+
+        if not self.jobMemory or not self.executor.isLocal:
+            return self.ncpus
+        newJobs = getMemorySlots(self.jobMemory,self.minFreeMemory)
+        if newJobs is None:
+            return self.ncpus
+
+        return max(1,min(self.ncpus,len(self.running)+newJobs-nStarting))
+
+    def nStarting(self,now):
+        """
+        Number of running jobs which are still in their start-up phase.
+        """
+
+        return len([t for t in self.running.values() if now-t < self.startupTime])
+
+    def _submit(self,func,jobID,args):
+
+        def callback(result):
+            self.finished.put((jobID,result))
+
+        self.submitTimes[jobID] = time.time()
+        self.executor.submit(func,args,callback)
+        self.running[jobID] = time.time()
+        self.stats['submitted'] += 1
+
+    def _readJob(self):
+        """
+        Move the next job from the job source to the queue (if the queue is empty).
+        """
+
+        if self.pending or self.source is None:
+            return
+        try:
+            jobID,args = next(self.source)
+        except StopIteration:
+            self.source = None
+            return
+        self.jobs[jobID] = args
+        self.pending.append((jobID,args))
+
+    def queueDepth(self):
+        """
+        Number of jobs waiting to be submitted (including the ones not yet read from the job source).
+        """
+
+        depth = len(self.pending)
+        if self.source is not None and self.nUnread is not None:
+            depth += max(0,self.nUnread())
+
+        return depth
+
+    def iterResults(self,func,jobs,nUnread=None):
+        """
+        Run func over the list of arguments in jobs and yield the results
+        in the order the jobs finish.
+
+        :param func: Function to be executed by the pool workers
+        :param jobs: List of tuples with the arguments for each job. If it is an iterator
+                     (e.g. a generator), the jobs are only read when they can be submitted
+                     and are forgotten once they finish.
+        :param nUnread: Function returning the number of jobs not yet read from the iterator
+                        (an upper bound is enough). It is only used for reporting the queue depth.
+
+        :return: Generator over (job index, result). If the job raised an
+                 exception, result is the exception.
+        """
+
+        lazy = not isinstance(jobs,(list,tuple))
+        self.nUnread = nUnread
+        if not lazy:
+            self.jobs = dict(enumerate(jobs))
+            self.pending = list(enumerate(jobs))[::-1] #Pop from the end
+            self.source = None
+        else:
+            self.jobs = {}
+            self.pending = []
+            self.source = enumerate(jobs)
+            self._readJob()
+        pending = self.pending
+        t0 = time.time()
+        tLast = t0
+        tReport = t0
+        while pending or self.running or self.delayed:
+            #Wait for jobs to finish (or for the next resource check)
+            done = []
+            try:
+                if self.running:
+                    done.append(self.finished.get(timeout=self.interval))
+                while True:
+                    done.append(self.finished.get_nowait())
+            except queue.Empty:
+                pass
+            for jobID,result in done:
+                self.running.pop(jobID,None)
+                self.stats['completed'] += 1
+                yield jobID,result
+                #Keep the arguments only for the jobs resubmitted
+                if lazy and not jobID in [item[1] for item in self.delayed]:
+                    self.jobs.pop(jobID,None)
+            self._readJob()
+
+            now = time.time()
+            #Move resubmitted jobs to the queue once their delay has passed
+            for item in sorted(self.delayed):
+                if item[0] <= now:
+                    self.delayed.remove(item)
+                    pending.append(item[1:])
+            dt = now-tLast
+            tLast = now
+            idleCores = max(0,self.ncpus-len(self.running))
+            self.stats['idleCoreTime'] += idleCores*dt
+            if pending:
+                self.stats['queuedIdleCoreTime'] += idleCores*dt
+            queueDepth = self.queueDepth()
+            self.stats['queueDepthTime'] += queueDepth*dt
+            self.stats['maxQueueDepth'] = max(self.stats['maxQueueDepth'],queueDepth)
+
+            if not pending:
+                if not self.running and self.delayed:
+                    time.sleep(self.interval)
+                continue
+
+            #Adapt the start-up window
+            nStarting = self.nStarting(now)
+            if self.executor.isLocal:
+                busyFrac,iowaitFrac,memFrac = self.sampleResources()
+                contended = self.isContended(busyFrac,iowaitFrac,memFrac)
+            else:
+                contended = False
+            if contended and nStarting:
+                self.stats['contention'] += 1
+                self.window = max(1,self.window//2)
+                logger.debug("Start-up contention detected (cpu=%s, iowait=%s, mem=%s). Window reduced to %i"
+                             %(busyFrac,iowaitFrac,memFrac,self.window))
+            elif not contended and self.window < self.ncpus:
+                self.window += 1
+
+            #Limit the number of running jobs by the available memory
+            maxRunning = self.getMemoryLimit(nStarting)
+            if maxRunning < self.ncpus and len(self.running) >= maxRunning:
+                self.stats['memoryLimited'] += 1
+                self.stats['minMemoryLimit'] = min(self.stats['minMemoryLimit'],maxRunning)
+                logger.debug("Memory limits the number of running jobs to %i" %maxRunning)
+
+            #Admit new jobs (contention only limits the number of jobs starting simultaneously)
+            while pending and len(self.running) < maxRunning:
+                if nStarting >= self.window:
+                    break
+                jobID,args = pending.pop()
+                logger.debug("Submitting job %i (queue depth = %i)" %(jobID,self.queueDepth()))
+                self._submit(func,jobID,args)
+                nStarting += 1
+                self._readJob()
+
+            if now-tReport > self.reportInterval:
+                tReport = now
+                logger.info("Queue depth: %i, running: %i, completed: %i, start-up window: %i"
+                            %(self.queueDepth(),len(self.running),self.stats['completed'],self.window))
+
+        self.stats['wallTime'] = time.time()-t0
+
+    def resubmit(self,jobID,delay=0.):
+        """
+        Add a job back to the queue (e.g. for retrying a failed job).
+        Can be called while iterating over iterResults.
+
+        :param jobID: Job index (as yielded by iterResults)
+        :param delay: Time (in seconds) to wait before the job can be started again
+        """
+
+        self.delayed.append((time.time()+delay,jobID,self.jobs[jobID]))
+
+    def report(self):
+        """
+        Summary of the scheduler statistics.
+
+        :return: String with the summary
+        """
+
+        wallTime = self.stats['wallTime']
+        if wallTime > 0:
+            meanDepth = self.stats['queueDepthTime']/wallTime
+            busyFrac = 1.-self.stats['idleCoreTime']/(self.ncpus*wallTime)
+        else:
+            meanDepth = 0.
+            busyFrac = 0.
+        summary = "Scheduler: %i jobs completed over %i cores in %3.2f min\n" %(self.stats['completed'],
+                                                                    self.ncpus,wallTime/60.)
+        summary += "  queue depth: max = %i, mean = %1.1f\n" %(self.stats['maxQueueDepth'],meanDepth)
+        summary += "  idle core time: %3.2f core-min (%3.2f core-min with queued jobs)\n" %(self.stats['idleCoreTime']/60.,
+                                                                    self.stats['queuedIdleCoreTime']/60.)
+        summary += "  core usage: %1.1f%%, contention events: %i" %(100.*busyFrac,self.stats['contention'])
+        if self.stats['memoryLimited']:
+            summary += "\n  memory limited the running jobs %i times (down to %i jobs)" %(self.stats['memoryLimited'],
+                                                                                       self.stats['minMemoryLimit'])
+
+        return summary
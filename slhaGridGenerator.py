@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+"""Generate the SLHA files for a grid of points from a template file."""
+
+#The template is read once and compiled into patch slots: the lines holding the MASS
+#entries and DECAY widths to be changed (and, optionally, lines to be replaced as a whole).
+#Rendering a point only formats the slot lines, so the files can be created quickly and
+#in parallel. The grid is defined in the [SLHAGrid] section of the parameters file,
+#with the scanned parameters given as options with the loop tag, e.g.:
+#  [SLHAGrid]
+#  template = './wino_template.slha'
+#  slhaFolder = './data/TDTM1M2F_slha'
+#  filename = 'TDTM1M2F_%(mC1)1.0f_%(widthC1)1.1e.slha'
+#  mC1 = $loop{numpy.arange(100.,700.,50.)}
+#  widthC1 = $loop{numpy.logspace(-17,-13,30)}
+#  derived = {'mN1' : 'mC1-0.5'}
+#  masses = {1000022 : 'mN1', 1000024 : 'mC1'}
+#  widths = {1000024 : 'widthC1'}
+#Alternatively, the grid can be given as a dictionary with the values for each parameter:
+#  grid = {'mC1' : numpy.arange(100.,700.,50.), 'widthC1' : numpy.logspace(-17,-13,30)}
+#If the [SLHAGrid] section is defined, runCheckMateScan generates the files (skipping the
+#ones which have not changed) and uses them as input. The files are written in the background
+#and each point is submitted as soon as its file exists, so the scan does not wait for the full grid.
+#The cross-sections can be added to the files (as XSECTION blocks) with the options:
+#  xsecCommand = './smodelsTools.py xseccomputer -f %(file)s -s %(sqrts)s -8 -p'
+#  xsecFolder = '~/smodels'
+#  xsecSqrts = [13.]
+#  xsecMasses = [1000022,1000024]
+#They are computed once for each set of masses (see xsecTable), instead of once per file.
+
+import os,sys,time
+import itertools
+import multiprocessing
+import logging
+from configParserWrapper import ConfigParserExt,evaluateExpression
+from xsecTable import getXSectionTexts,XSecTable,getContext,getMassKey
+
+logger = logging.getLogger(__name__)
+
+#Options in [SLHAGrid] which are not point parameters:
+gridOptions = ['template','slhaFolder','filename','derived','masses','widths','replacements','grid','ncpu',
+               'xsecCommand','xsecFolder','xsecSqrts','xsecMasses','xsecTable','xsecInterpolationStep']
+
+#Template used by the pool workers (see _initWorker):
+_workerTemplate = None
+
+
+class SLHATemplate(object):
+    """
+    SLHA template compiled into patch slots.
+
+    :param templateFile: Path to the template SLHA file
+    :param masses: Dictionary with the PDG codes as keys and the parameter names as values
+                   for the MASS block entries to be set
+    :param widths: Dictionary with the PDG codes as keys and the parameter names as values
+                   for the total widths (DECAY lines) to be set
+    :param replacements: Dictionary with template lines (or parts of lines) as keys and the
+                         new lines (with %(parameter)s formatting) as values
+
+    :raises ValueError: if a MASS entry, DECAY line or line to be replaced is not found in the template
+    """
+
+    def __init__(self,templateFile,masses={},widths={},replacements={}):
+
+        self.templateFile = templateFile
+        with open(templateFile,'r') as f:
+            self.lines = f.read().splitlines()
+        #Slots: line index -> format string
+        self.slots = {}
+        massLines,decayLines = self.findLines()
+        for pdg,label in masses.items():
+            if not int(pdg) in massLines:
+                raise ValueError("MASS entry for %s not found in %s" %(pdg,templateFile))
+            i = massLines[int(pdg)]
+            self.slots[i] = '%10i    %%(%s)15.8E   #%s' %(int(pdg),label,self.getComment(i))
+        for pdg,label in widths.items():
+            if not int(pdg) in decayLines:
+                raise ValueError("DECAY line for %s not found in %s" %(pdg,templateFile))
+            i = decayLines[int(pdg)]
+            self.slots[i] = 'DECAY   %7i  %%(%s)15.8E   #%s' %(int(pdg),label,self.getComment(i))
+        for line,newLine in replacements.items():
+            matches = [i for i,l in enumerate(self.lines) if line in l]
+            if not matches:
+                raise ValueError("Line:\n %s \n not found in %s" %(line,templateFile))
+            for i in matches:
+                self.slots[i] = self.lines[i].replace('%','%%').replace(line,newLine)
+        self.slotIndices = sorted(self.slots)
+
+    def getComment(self,i):
+
+        if '#' in self.lines[i]:
+            return self.lines[i].split('#',1)[1].rstrip()
+        return ''
+
+    def findLines(self):
+        """
+        Find the MASS block entries and the DECAY lines (the first ones for each particle).
+
+        :return: Tuple of dictionaries ({pdg : line index} for the masses and the widths)
+        """
+
+        massLines = {}
+        decayLines = {}
+        inMass = False
+        for i,line in enumerate(self.lines):
+            line = line.split('#',1)[0]
+            if not line.strip():
+                continue
+            fields = line.split()
+            if not line[0].isspace():
+                tag = fields[0].upper()
+                inMass = (tag == 'BLOCK' and len(fields) > 1 and fields[1].upper() == 'MASS')
+                if tag == 'DECAY' and len(fields) > 2:
+                    decayLines.setdefault(int(fields[1]),i)
+                continue
+            if inMass and len(fields) >= 2:
+                massLines.setdefault(int(fields[0]),i)
+
+        return massLines,decayLines
+
+    def render(self,values):
+        """
+        Create the SLHA content for a point.
+
+        :param values: Dictionary with the parameter values
+
+        :return: String with the SLHA file content
+        """
+
+        lines = list(self.lines)
+        for i in self.slotIndices:
+            lines[i] = self.slots[i] %values
+
+        return '\n'.join(lines)+'\n'
+
+
+def getPointValues(values,derived={}):
+    """
+    Add the derived parameters to the point values.
+
+    :param values: Dictionary with the values of the scanned parameters
+    :param derived: Dictionary with parameter names as keys and the expressions for
+                    computing them (as a function of the other parameters) as values
+
+    :return: Dictionary with all the parameter values
+    """
+
+    values = dict(values)
+    for label,expr in derived.items():
+        values[label] = evaluateExpression(expr,values)
+
+    return values
+
+def writeSLHAFile(template,values,slhaFile,xsecText=''):
+    """
+    Write the SLHA file for a point (the file is not changed if its content is the same).
+
+    :param template: SLHATemplate object
+    :param values: Dictionary with the parameter values (including the derived ones)
+    :param slhaFile: Path to the file
+    :param xsecText: XSECTION blocks appended to the file
+
+    :return: True if the file was written
+    """
+
+    data = template.render(values)+xsecText
+    if os.path.isfile(slhaFile):
+        with open(slhaFile,'r') as f:
+            if f.read() == data:
+                return False
+    tmpFile = slhaFile+'.tmp'
+    with open(tmpFile,'w') as f:
+        f.write(data)
+    os.rename(tmpFile,slhaFile)
+
+    return True
+
+def _initWorker(template):
+
+    global _workerTemplate
+    _workerTemplate = template
+
+def _writeEntry(args):
+
+    values,slhaFile,xsecText = args
+    return slhaFile,writeSLHAFile(_workerTemplate,values,slhaFile,xsecText)
+
+def iterGrid(grid):
+    """
+    Iterate over the product of the parameter values.
+
+    :param grid: Dictionary with the parameter names as keys and lists of values as values
+
+    :return: Generator over dictionaries with the values for each point
+    """
+
+    labels = sorted(grid)
+    for values in itertools.product(*[grid[label] for label in labels]):
+        yield dict(zip(labels,[float(v) for v in values]))
+
+def iterLoopPoints(parser,section='SLHAGrid'):
+    """
+    Iterate over the points defined by the loop options in the section.
+
+    :param parser: ConfigParserExt object
+    :param section: Section with the point parameters
+
+    :return: Generator over dictionaries with the values of the parameters for each point
+    """
+
+    gridParser = ConfigParserExt()
+    gridParser.read_dict({section : parser.toDict(raw=True)[section]})
+    for _,pointParser in gridParser.iterLoops():
+        pars = pointParser.toDict(raw=False)[section]
+        yield dict([(label,val) for label,val in pars.items() if not label in gridOptions])
+
+def generateFiles(template,points,slhaFolder,filename,derived={},ncpus=1,xsecTexts=None):
+    """
+    Write the SLHA files for the points. The files are rendered and written by a pool of
+    processes and yielded as they are created, in the order of the points.
+
+    :param template: SLHATemplate object
+    :param points: Iterable over dictionaries with the parameter values
+    :param slhaFolder: Folder for the SLHA files
+    :param filename: File name format (with %(parameter)s formatting)
+    :param derived: Dictionary with the expressions for the derived parameters (see getPointValues)
+    :param ncpus: Number of processes (if 1, the files are written by this process)
+    :param xsecTexts: List with the XSECTION blocks for each point (see xsecTable.getXSectionTexts)
+
+    :return: Generator over (path to the SLHA file, True if the file was written)
+    """
+
+    if not os.path.isdir(slhaFolder):
+        os.makedirs(slhaFolder)
+
+    if xsecTexts is None:
+        xsecTexts = itertools.repeat('')
+
+    def iterJobs():
+        for values,xsecText in zip(points,xsecTexts):
+            values = getPointValues(values,derived)
+            yield values,os.path.abspath(os.path.join(slhaFolder,filename %values)),xsecText
+
+    if ncpus == 1:
+        _initWorker(template)
+        for job in iterJobs():
+            yield _writeEntry(job)
+        return
+    pool = multiprocessing.Pool(processes=ncpus,initializer=_initWorker,initargs=(template,))
+    try:
+        for entry in pool.imap(_writeEntry,iterJobs(),chunksize=64):
+            yield entry
+    finally:
+        pool.close()
+        pool.join()
+
+def getGridTemplate(parser,section='SLHAGrid'):
+    """
+    Compile the template defined in the section.
+
+    :param parser: ConfigParserExt object
+    :param section: Section with the grid definition
+
+    :return: SLHATemplate object
+    """
+
+    pars = parser.toDict(raw=False)[section]
+
+    return SLHATemplate(pars['template'],masses=pars.get('masses',{}),widths=pars.get('widths',{}),
+                        replacements=pars.get('replacements',{}))
+
+def getXSectionMassLabels(pars):
+    """
+    Names of the parameters the cross-sections depend on (see the xsecMasses option).
+    """
+
+    masses = dict([(int(pdg),label) for pdg,label in pars.get('masses',{}).items()])
+    pdgs = pars.get('xsecMasses',sorted(masses))
+    if not pdgs or any(not int(pdg) in masses for pdg in pdgs):
+        raise ValueError("The xsecMasses (%s) must be set by the masses option" %pdgs)
+
+    return [masses[int(pdg)] for pdg in pdgs]
+
+def getXSectionTableFile(pars):
+
+    return pars.get('xsecTable',os.path.abspath(pars['slhaFolder']).rstrip(os.sep)+'_xsecTable.json')
+
+def getGridXSections(template,points,pars,ncpus=1):
+    """
+    Get the cross-sections for the grid points using the xsec options (see the module description).
+
+    :param template: SLHATemplate object
+    :param points: List of dictionaries with the parameter values (including the derived ones)
+    :param pars: Dictionary with the [SLHAGrid] options
+    :param ncpus: Number of cross-section computations running simultaneously
+
+    :return: List with the XSECTION blocks for each point
+    """
+
+    if any(line.split()[0].upper() == 'XSECTION' for line in template.lines if line.strip()):
+        raise ValueError("The template %s already contains XSECTION blocks" %template.templateFile)
+    return getXSectionTexts(template,points,getXSectionMassLabels(pars),pars.get('xsecSqrts',[13.]),
+                            pars['xsecCommand'],getXSectionTableFile(pars),folder=pars.get('xsecFolder'),
+                            step=pars.get('xsecInterpolationStep',1),ncpus=ncpus)
+
+def getGridPoints(parser,section='SLHAGrid'):
+    """
+    Get the parameter values (including the derived ones) for the points of the grid defined in the section.
+
+    :param parser: ConfigParserExt object
+    :param section: Section with the grid definition
+
+    :return: List of dictionaries with the parameter values
+    """
+
+    pars = parser.toDict(raw=False)[section]
+    if 'grid' in pars:
+        points = iterGrid(pars['grid'])
+    else:
+        points = iterLoopPoints(parser,section)
+    derived = pars.get('derived',{})
+
+    return [getPointValues(values,derived) for values in points]
+
+def getGridFiles(parser,section='SLHAGrid',points=None):
+    """
+    Get the paths to the SLHA files of the grid defined in the section (without writing them).
+
+    :param parser: ConfigParserExt object
+    :param section: Section with the grid definition
+    :param points: List with the parameter values for each point (default is getGridPoints)
+
+    :return: List of absolute paths, in the order the files are generated (see generateGrid)
+    """
+
+    pars = parser.toDict(raw=False)[section]
+    if points is None:
+        points = getGridPoints(parser,section)
+    slhaFolder = os.path.abspath(pars['slhaFolder'])
+
+    return [os.path.abspath(os.path.join(slhaFolder,pars['filename'] %values)) for values in points]
+
+def planGrid(parser,section='SLHAGrid'):
+    """
+    Enumerate the points of the grid defined in the section without writing any file
+    or computing cross-sections (used by the dry run of runCheckMateScan).
+
+    :param parser: ConfigParserExt object
+    :param section: Section with the grid definition
+
+    :return: Dictionary with the paths to the SLHA files ('files'), the number of files which do not
+             exist yet ('new') and, if xsecCommand is defined, the number of cross-section computations
+             required ('xsecJobs', for the masses and energies not in the table)
+    """
+
+    pars = parser.toDict(raw=False)[section]
+    points = getGridPoints(parser,section)
+    slhaFiles = getGridFiles(parser,section,points)
+    plan = {'files' : slhaFiles, 'new' : len([f for f in slhaFiles if not os.path.isfile(f)]),
+            'xsecJobs' : None}
+    if 'xsecCommand' in pars:
+        massLabels = getXSectionMassLabels(pars)
+        table = XSecTable(getXSectionTableFile(pars),getContext(pars['template'],pars['xsecCommand']))
+        keys = sorted(set([getMassKey([values[label] for label in massLabels]) for values in points]))
+        step = max(1,int(pars.get('xsecInterpolationStep',1)))
+        if step > 1: #Only these are computed (the others are interpolated when possible)
+            keys = sorted(set(keys[::step]+keys[-1:]))
+        plan['xsecJobs'] = len([key for key in keys for sqrts in pars.get('xsecSqrts',[13.])
+                                if table.get(key,sqrts) is None])
+
+    return plan
+
+def generateGrid(parser,ncpus=1,section='SLHAGrid'):
+    """
+    Generate the SLHA files for the grid defined in the section (see the module description).
+    The grid definition, the template and the cross-sections (if xsecCommand is defined) are
+    processed when the function is called (so invalid grids raise an error right away), while
+    the files are written in the background and yielded as they are created.
+
+    :param parser: ConfigParserExt object
+    :param ncpus: Number of processes
+    :param section: Section with the grid definition
+
+    :return: Generator over the paths to the SLHA files (in the order of getGridFiles)
+    """
+
+    pars = parser.toDict(raw=False)[section]
+    template = getGridTemplate(parser,section)
+    slhaFolder = os.path.abspath(pars['slhaFolder'])
+    points = getGridPoints(parser,section)
+    xsecTexts = None
+    if 'xsecCommand' in pars:
+        xsecTexts = getGridXSections(template,points,pars,ncpus)
+
+    return _iterGridFiles(template,points,slhaFolder,pars['filename'],ncpus,xsecTexts)
+
+def _iterGridFiles(template,points,slhaFolder,filename,ncpus,xsecTexts):
+
+    nWritten = 0
+    nFiles = 0
+    for slhaFile,written in generateFiles(template,points,slhaFolder,filename,{},ncpus,xsecTexts):
+        nFiles += 1
+        nWritten += written
+        yield slhaFile
+    logger.info("%i SLHA files in %s (%i new or changed)" %(nFiles,slhaFolder,nWritten))
+
+def main(parfile,verbose,ncpus=None):
+    """
+    Generate the SLHA files for the grid defined in the [SLHAGrid] section of the parameter file.
+
+    :param parfile: name of the parameter file.
+    :param verbose: level of debugging messages.
+    :param ncpus: Number of processes (default is the ncpu option in [SLHAGrid] or all CPUs)
+
+    :return: List of paths to the SLHA files
+    """
+
+    from runCheckMateScan import setLogLevel
+    setLogLevel(verbose)
+
+    parser = ConfigParserExt()
+    ret = parser.read(parfile)
+    if ret == []:
+        logger.error( "No such file or directory: '%s'" % parfile)
+        sys.exit()
+    if not parser.has_section("SLHAGrid"):
+        logger.error("The [SLHAGrid] section must be defined in %s" %parfile)
+        sys.exit()
+    if ncpus is None:
+        ncpus = multiprocessing.cpu_count()
+        if parser.has_option("SLHAGrid","ncpu"):
+            ncpus = parser.get("SLHAGrid","ncpu")
+
+    try:
+        slhaFiles = list(generateGrid(parser,ncpus))
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit()
+    print("%i SLHA files in %s" %(len(slhaFiles),os.path.dirname(slhaFiles[0]) if slhaFiles else '-'))
+
+    return slhaFiles
+
+
+if __name__ == "__main__":
+
+    import argparse
+    ap = argparse.ArgumentParser( description=
+            "Generate the SLHA files for the grid defined in the [SLHAGrid] section of the parameters file." )
+    ap.add_argument('-p', '--parfile', default='checkmate_parameters.ini',
+            help='path to the parameters file. Default is checkmate_parameters.ini')
+    ap.add_argument('-n', '--ncpus', default=None, type=int,
+            help='number of processes. Default is the ncpu option in [SLHAGrid] or the number of CPUs')
+    ap.add_argument('-v', '--verbose', default='error',
+            help='verbose level (debug, info, warning or error). Default is error')
+
+    args = ap.parse_args()
+
+    t0 = time.time()
+    main(args.parfile,args.verbose,args.ncpus)
+
+    print("\n\nDone in %3.2f min" %((time.time()-t0)/60.))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""Lightweight helpers for extracting information from SLHA files without fully parsing them."""
+
+import os
+import json
+import multiprocessing
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def readMassesAndWidths(slhaFile):
+    """
+    Read the MASS block entries and the total widths from the DECAY lines.
+
+    :param slhaFile: Path to the SLHA file
+
+    :return: Tuple of dictionaries ({pdg : mass}, {pdg : width})
+    """
+
+    masses = {}
+    widths = {}
+    inMass = False
+    with open(slhaFile,'r') as f:
+        for line in f:
+            line = line.split('#',1)[0]
+            if not line.strip():
+                continue
+            if not line[0].isspace():
+                fields = line.split()
+                tag = fields[0].upper()
+                inMass = (tag == 'BLOCK' and len(fields) > 1 and fields[1].upper() == 'MASS')
+                if tag == 'DECAY' and len(fields) > 2:
+                    widths[int(fields[1])] = float(fields[2])
+                continue
+            if inMass:
+                fields = line.split()
+                if len(fields) >= 2:
+                    masses[int(fields[0])] = float(fields[1])
+
+    return masses,widths
+
+def readXSections(slhaFile):
+    """
+    Read only the XSECTION blocks from a SLHA file.
+    The processes are labeled as in pyslha: (initial state PDGs + sorted final state PDGs).
+
+    :param slhaFile: Path to the SLHA file
+
+    :return: Dictionary with the process tuples as keys and a list of (sqrts,qcd_order,value) as values
+    """
+
+    xsecs = {}
+    current = None
+    with open(slhaFile,'r') as f:
+        for line in f:
+            line = line.split('#',1)[0]
+            if not line.strip():
+                continue
+            if not line[0].isspace():
+                fields = line.split()
+                if fields[0].upper() != 'XSECTION':
+                    current = None
+                    continue
+                sqrts = float(fields[1])
+                nFinal = int(fields[4])
+                finalState = sorted([int(pdg) for pdg in fields[5:5+nFinal]])
+                process = tuple([int(fields[2]),int(fields[3])]+finalState)
+                current = (sqrts,process)
+                xsecs.setdefault(process,[])
+                continue
+            if current is not None:
+                fields = line.split()
+                xsecs[current[1]].append((current[0],int(fields[1]),float(fields[6])))
+
+    return xsecs
+
+def readXSectionBlocks(slhaFile):
+    """
+    Read the XSECTION blocks from a SLHA file keeping their lines (and comments) unchanged.
+
+    :param slhaFile: Path to the SLHA file
+
+    :return: List of (header line, list of entry lines) tuples
+    """
+
+    blocks = []
+    current = None
+    with open(slhaFile,'r') as f:
+        for line in f:
+            line = line.rstrip()
+            if not line.split('#',1)[0].strip():
+                continue
+            if not line[0].isspace():
+                if line.split()[0].upper() == 'XSECTION':
+                    current = (line,[])
+                    blocks.append(current)
+                else:
+                    current = None
+                continue
+            if current is not None:
+                current[1].append(line)
+
+    return blocks
+
+def _formatNumber(value):
+    return '%.6e' %float(value)
+
+def readCanonicalContent(slhaFile,blocks=['MASS','DECAY','XSECTION']):
+    """
+    Build a canonical representation of the selected blocks of a SLHA file,
+    which does not depend on comments, formatting, number precision (beyond 7 digits)
+    or on the ordering of blocks and entries.
+
+    :param slhaFile: Path to the SLHA file
+    :param blocks: Names of the blocks to be included. DECAY and XSECTION refer to the
+                   decay tables and cross-section blocks, the other names to the
+                   BLOCK entries.
+
+    :return: String with the canonical content
+    """
+
+    blocks = [b.upper() for b in blocks]
+    entries = {}
+    current = None
+    with open(slhaFile,'r') as f:
+        for line in f:
+            line = line.split('#',1)[0]
+            if not line.strip():
+                continue
+            fields = line.split()
+            if not line[0].isspace():
+                tag = fields[0].upper()
+                if tag == 'BLOCK' and len(fields) > 1 and fields[1].upper() in blocks:
+                    current = 'BLOCK %s' %fields[1].upper()
+                elif tag == 'DECAY' and 'DECAY' in blocks:
+                    current = 'DECAY %i %s' %(int(fields[1]),_formatNumber(fields[2]))
+                elif tag == 'XSECTION' and 'XSECTION' in blocks:
+                    nFinal = int(fields[4])
+                    finalState = sorted([int(pdg) for pdg in fields[5:5+nFinal]])
+                    current = 'XSECTION %s %s' %(_formatNumber(fields[1]),
+                                                 " ".join([str(int(pdg)) for pdg in fields[2:4]+finalState]))
+                else:
+                    current = None
+                    continue
+                entries.setdefault(current,[])
+                continue
+            if current is None:
+                continue
+            if current.startswith('DECAY'):
+                #Branching ratio and sorted daughters:
+                nDaughters = int(fields[1])
+                daughters = sorted([int(pdg) for pdg in fields[2:2+nDaughters]])
+                entry = "%s %s" %(_formatNumber(fields[0])," ".join([str(pdg) for pdg in daughters]))
+            elif current.startswith('XSECTION'):
+                #Scale, PDF and QCD/EW orders and the value (the code name is not included):
+                entry = "%s %s" %(" ".join(fields[:6]),_formatNumber(fields[6]))
+            else:
+                values = []
+                for field in fields:
+                    try:
+                        values.append(str(int(field)))
+                    except ValueError:
+                        try:
+                            values.append(_formatNumber(field))
+                        except ValueError:
+                            values.append(field)
+                entry = " ".join(values)
+            entries[current].append(entry)
+
+    lines = []
+    for key in sorted(entries):
+        lines.append(key)
+        lines += sorted(entries[key])
+
+    return "\n".join(lines)
+
+def _readXSectionsEntry(slhaFile):
+    return slhaFile,readXSections(slhaFile)
+
+def getXSections(slhaFiles,cacheFile=None,ncpus=1,updateCache=True):
+    """
+    Get the cross-sections for a list of SLHA files. The files which are not
+    found in the cache (or have been modified) are read in parallel.
+
+    :param slhaFiles: List of paths to the SLHA files
+    :param cacheFile: Path to the JSON file used to cache the cross-sections
+                      (keyed by file path, modification time and size). If None, no cache is used.
+    :param ncpus: Number of processes used to read the files
+    :param updateCache: If False, the cache file is only read (the files not found in it are read but not stored)
+
+    :return: Dictionary with the file paths as keys and the output of readXSections as values
+    """
+
+    cache = {}
+    if cacheFile and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile,'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            logger.warning("Could not read cross-section cache %s. It will be rebuilt." %cacheFile)
+            cache = {}
+
+    xsecsDict = {}
+    missing = []
+    for slhaFile in slhaFiles:
+        stat = os.stat(slhaFile)
+        entry = cache.get(slhaFile)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            xsecsDict[slhaFile] = dict([(tuple(int(pdg) for pdg in proc.split(',')),[tuple(x) for x in xsecs])
+                                        for proc,xsecs in entry['xsecs'].items()])
+        else:
+            missing.append((slhaFile,stat.st_mtime,stat.st_size))
+
+    logger.info("Cross-sections for %i files found in cache, reading %i files"
+                %(len(xsecsDict),len(missing)))
+    if not missing:
+        return xsecsDict
+
+    missingFiles = [m[0] for m in missing]
+    if ncpus > 1 and len(missing) > 1:
+        pool = multiprocessing.Pool(processes=min(ncpus,len(missing)))
+        chunksize = max(1,len(missing)//(4*ncpus))
+        newXsecs = dict(pool.imap_unordered(_readXSectionsEntry,missingFiles,chunksize=chunksize))
+        pool.close()
+        pool.join()
+    else:
+        newXsecs = dict([_readXSectionsEntry(f) for f in missingFiles])
+
+    for slhaFile,mtime,size in missing:
+        xsecs = newXsecs[slhaFile]
+        xsecsDict[slhaFile] = xsecs
+        cache[slhaFile] = {'mtime' : mtime, 'size' : size,
+                           'xsecs' : dict([(",".join([str(pdg) for pdg in proc]),xsecList)
+                                           for proc,xsecList in xsecs.items()])}
+
+    if cacheFile and updateCache:
+        cacheDir = os.path.dirname(os.path.abspath(cacheFile))
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        tmpFile = cacheFile+'.tmp'
+        with open(tmpFile,'w') as f:
+            json.dump(cache,f)
+        os.replace(tmpFile,cacheFile)
+
+    return xsecsDict
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+"""Tests for the expression evaluation and the loops in configParserWrapper."""
+
+import os,sys
+import unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from configParserWrapper import ConfigParserExt,compileExpression
+
+
+class LoopComprehensionTest(unittest.TestCase):
+
+    def test_comprehensionLoop(self):
+
+        parser = ConfigParserExt()
+        parser.read_string("[options]\nx = $loop{[i*100 for i in range(1,4)]}\n")
+        values = [loopParser.get("options","x") for _,loopParser in parser.iterLoops()]
+        self.assertEqual(values,[100,200,300])
+
+    def test_comprehensionValues(self):
+
+        parser = ConfigParserExt()
+        parser.read_string("[options]\ny = sum(j**2 for j in range(3))\nz = {k : v for k,v in zip([1,2],[3,4])}\n")
+        self.assertEqual(parser.get("options","y"),5)
+        self.assertEqual(parser.get("options","z"),{1 : 3, 2 : 4})
+
+    def test_comprehensionSandbox(self):
+
+        code,error = compileExpression("[i.__class__ for i in [1]]")
+        self.assertIsNone(code)
+        self.assertIn("not allowed",error)
+
+
+if __name__ == "__main__":
+    unittest.main()
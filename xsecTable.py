@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""Table of cross-sections keyed by the masses and sqrt(s), shared by the points of a grid."""
+
+#The production cross-sections only depend on the masses (and not, for instance, on the
+#widths scanned for each mass), so they are computed once for each combination of the
+#relevant masses and sqrt(s) and stored (as XSECTION blocks) in a JSON table.
+#The cross-sections are computed by an external command, which must add the XSECTION
+#blocks to the SLHA file given, e.g. the SModelS cross-section calculator:
+#  './smodelsTools.py xseccomputer -f %(file)s -s %(sqrts)s -8 -p'
+#Optionally, the cross-sections are only computed for some of the masses and
+#interpolated (log-linearly) for the others, using the nearest computed points on
+#a line through the masses.
+#The entries are also keyed by the template and command used (the context), so the
+#same table can be shared by grids for different models.
+
+import os
+import json
+import shlex
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+import logging
+import numpy
+from jobRunner import runLogged
+from slhaTools import readXSectionBlocks
+
+logger = logging.getLogger(__name__)
+
+
+def getContext(templateFile,command):
+    """
+    Key for the quantities (other than the masses and sqrt(s)) the cross-sections depend on.
+
+    :param templateFile: Path to the SLHA template
+    :param command: Command used for computing the cross-sections
+
+    :return: Hex digest of the template content and the command
+    """
+
+    sha = hashlib.sha1()
+    with open(templateFile,'rb') as f:
+        sha.update(f.read())
+    sha.update(command.encode('utf-8'))
+
+    return sha.hexdigest()
+
+def getMassKey(masses):
+    """
+    Round the masses (to 7 digits), so equal masses computed in different ways have the same key.
+    """
+
+    return tuple([float('%.6e' %m) for m in masses])
+
+def formatBlocks(blocks):
+    """
+    Convert a list of XSECTION blocks (see readXSectionBlocks) to the SLHA text.
+    """
+
+    lines = []
+    for header,entries in blocks:
+        lines.append(header)
+        lines += entries
+    if not lines:
+        return ''
+
+    return '\n'.join(lines)+'\n'
+
+def _blockKey(header):
+    return tuple(header.split('#',1)[0].split())
+
+def interpolateBlocks(blocksA,blocksB,t):
+    """
+    Interpolate the cross-sections between two sets of XSECTION blocks (log-linearly
+    if both values are positive and linearly otherwise).
+
+    :param blocksA: List of XSECTION blocks (see readXSectionBlocks)
+    :param blocksB: List of XSECTION blocks for the same processes and orders
+    :param t: Position between the two sets (0 for blocksA and 1 for blocksB)
+
+    :return: List of XSECTION blocks or None if the processes or orders do not match
+    """
+
+    blocksB = dict([(_blockKey(header),entries) for header,entries in blocksB])
+    if len(blocksB) != len(blocksA):
+        return None
+    blocks = []
+    for header,entriesA in blocksA:
+        entriesB = blocksB.get(_blockKey(header))
+        if entriesB is None or len(entriesB) != len(entriesA):
+            return None
+        entries = []
+        for entryA,entryB in zip(entriesA,entriesB):
+            fieldsA = entryA.split('#',1)[0].split()
+            fieldsB = entryB.split('#',1)[0].split()
+            if fieldsA[:6] != fieldsB[:6]:
+                return None
+            xsecA,xsecB = float(fieldsA[6]),float(fieldsB[6])
+            if xsecA > 0. and xsecB > 0.:
+                xsec = numpy.exp((1.-t)*numpy.log(xsecA)+t*numpy.log(xsecB))
+            else:
+                xsec = (1.-t)*xsecA+t*xsecB
+            entries.append('  %s    %.8E  %s' %('  '.join(fieldsA[:6]),xsec,' '.join(fieldsA[7:])))
+        blocks.append((header,entries))
+
+    return blocks
+
+
+class XSecTable(object):
+    """
+    Cross-sections (XSECTION blocks) keyed by the masses and sqrt(s), stored in a JSON file.
+
+    :param tableFile: Path to the JSON file (created if it does not exist)
+    :param context: Key for the template and command used (see getContext)
+    """
+
+    def __init__(self,tableFile,context=''):
+
+        self.tableFile = os.path.abspath(tableFile)
+        self.context = context
+        self.entries = self.load()
+
+    def getKey(self,masses,sqrts):
+
+        return '%s:%.6e:%s' %(self.context,sqrts,','.join(['%.6e' %m for m in masses]))
+
+    def load(self):
+        """
+        Read the entries stored in the table file.
+
+        :return: Dictionary with the entries
+        """
+
+        if not os.path.isfile(self.tableFile):
+            return {}
+        try:
+            with open(self.tableFile,'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Could not read cross-section table %s. It will be rebuilt." %self.tableFile)
+            return {}
+
+    def save(self):
+        """
+        Store the entries (merged with the ones added to the file by other processes).
+        """
+
+        entries = self.load()
+        entries.update(self.entries)
+        self.entries = entries
+        tableDir = os.path.dirname(self.tableFile)
+        if not os.path.isdir(tableDir):
+            os.makedirs(tableDir)
+        tmpFile = self.tableFile+'.%i.tmp' %os.getpid()
+        with open(tmpFile,'w') as f:
+            json.dump(self.entries,f)
+        os.replace(tmpFile,self.tableFile)
+
+    def add(self,masses,sqrts,blocks):
+
+        self.entries[self.getKey(masses,sqrts)] = {'context' : self.context, 'sqrts' : float(sqrts),
+                                                   'masses' : [float(m) for m in masses],
+                                                   'blocks' : [[header,entries] for header,entries in blocks]}
+
+    def get(self,masses,sqrts):
+        """
+        Get the XSECTION blocks for the masses and sqrt(s).
+
+        :return: List of XSECTION blocks or None if not in the table
+        """
+
+        entry = self.entries.get(self.getKey(masses,sqrts))
+        if entry is None:
+            return None
+
+        return [(header,list(entries)) for header,entries in entry['blocks']]
+
+    def interpolate(self,masses,sqrts,tolerance=1e-8):
+        """
+        Interpolate the cross-sections between the two closest entries
+        lying on a line through the masses (on opposite sides).
+
+        :param masses: List of masses
+        :param sqrts: Center of mass energy
+        :param tolerance: Tolerance for the alignment of the entries (1 - |cos(angle)|)
+
+        :return: List of XSECTION blocks or None if no pair of entries can be used
+        """
+
+        entries = [e for e in self.entries.values()
+                   if e['context'] == self.context and len(e['masses']) == len(masses)
+                   and abs(e['sqrts']-sqrts) <= 1e-6*abs(sqrts)]
+        if len(entries) < 2:
+            return None
+        delta = numpy.array([e['masses'] for e in entries])-numpy.array(masses,dtype=float)
+        dist = numpy.sqrt((delta**2).sum(axis=1))
+        #Pairs of entries on opposite sides of the point (cos(angle) = -1):
+        norms = numpy.outer(dist,dist)
+        aligned = (numpy.dot(delta,delta.T)+norms <= tolerance*norms) & (norms > 0.)
+        pairs = numpy.argwhere(numpy.triu(aligned))
+        if not len(pairs):
+            return None
+        #Use the closest pairs first:
+        for i,j in sorted(pairs.tolist(), key = lambda p: dist[p[0]]+dist[p[1]]):
+            blocks = interpolateBlocks(entries[i]['blocks'],entries[j]['blocks'],
+                                       dist[i]/(dist[i]+dist[j]))
+            if blocks is not None:
+                return blocks
+
+        return None
+
+
+def computeXSections(slhaData,sqrts,command,folder=None,timeout=None):
+    """
+    Compute the cross-sections for a point running the command, which must
+    add the XSECTION blocks to the SLHA file.
+
+    :param slhaData: SLHA file content (without XSECTION blocks)
+    :param sqrts: Center of mass energy (in the units used by the command)
+    :param command: Command with %(file)s and %(sqrts)s formatting
+    :param folder: Working directory for the command
+    :param timeout: Maximum time (in seconds) for the command
+
+    :return: List of XSECTION blocks (see readXSectionBlocks) or None if the command failed
+
+    :raises ValueError: if the command can not be executed
+    """
+
+    tmpDir = tempfile.mkdtemp(prefix='xsec_')
+    try:
+        slhaFile = os.path.join(tmpDir,'point.slha')
+        with open(slhaFile,'w') as f:
+            f.write(slhaData)
+        cmd = shlex.split(command %{'file' : slhaFile, 'sqrts' : '%g' %sqrts})
+        if folder:
+            folder = os.path.abspath(os.path.expanduser(folder))
+        try:
+            returncode,tail,timedOut = runLogged(cmd,folder,os.path.join(tmpDir,'xsec.log'),timeout=timeout)
+        except OSError as e:
+            raise ValueError("Could not run the cross-section command %s: %s" %(cmd[0],e))
+        blocks = readXSectionBlocks(slhaFile)
+        if returncode != 0 or not blocks:
+            logger.warning("Could not compute the cross-sections with %s (return code %s):\n%s"
+                           %(cmd[0],returncode,tail))
+            return None
+    finally:
+        shutil.rmtree(tmpDir,ignore_errors=True)
+
+    return blocks
+
+def _computeEntry(args):
+
+    masses,sqrts,slhaData,command,folder = args
+    return masses,sqrts,computeXSections(slhaData,sqrts,command,folder)
+
+def computeEntries(table,jobs,ncpus=1):
+    """
+    Compute the cross-sections and add them to the table (which is saved after each entry).
+
+    :param table: XSecTable object
+    :param jobs: List of (masses,sqrts,slhaData,command,folder) tuples
+    :param ncpus: Number of commands running simultaneously
+
+    :return: Number of entries added
+    """
+
+    if ncpus > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(ncpus,len(jobs)))
+        results = pool.imap_unordered(_computeEntry,jobs)
+    else:
+        pool = None
+        results = (_computeEntry(job) for job in jobs)
+    nAdded = 0
+    try:
+        for masses,sqrts,blocks in results:
+            if blocks is None:
+                continue
+            table.add(masses,sqrts,blocks)
+            table.save()
+            nAdded += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return nAdded
+
+def getXSectionTexts(template,points,massLabels,sqrtsList,command,tableFile,
+                     folder=None,step=1,ncpus=1):
+    """
+    Get the XSECTION blocks for each point. The cross-sections are computed once for each
+    combination of masses (for the ones which are not in the table) and shared by all the points
+    with these masses.
+
+    :param template: SLHATemplate object (used for writing the SLHA file for each computation)
+    :param points: List of dictionaries with the parameter values (including the derived ones)
+    :param massLabels: List with the names of the parameters the cross-sections depend on
+    :param sqrtsList: List of center of mass energies
+    :param command: Command for computing the cross-sections (see computeXSections)
+    :param tableFile: Path to the cross-section table
+    :param folder: Working directory for the command
+    :param step: If larger than 1, only one in every step masses (sorted) and the last one are computed
+                 and the cross-sections for the others are interpolated (or computed if they can not be)
+    :param ncpus: Number of commands running simultaneously
+
+    :return: List with the text (XSECTION blocks) for each point (empty if the cross-sections are not available)
+    """
+
+    table = XSecTable(tableFile,getContext(template.templateFile,command))
+    pointKeys = [getMassKey([values[label] for label in massLabels]) for values in points]
+    firstPoint = {}
+    for i,key in enumerate(pointKeys):
+        firstPoint.setdefault(key,i)
+    allKeys = sorted(firstPoint)
+    step = max(1,int(step))
+    computeKeys = set(allKeys[::step]+allKeys[-1:])
+
+    def getJobs(keys):
+        return [(key,sqrts,template.render(points[firstPoint[key]]),command,folder)
+                for key in sorted(keys) for sqrts in sqrtsList if table.get(key,sqrts) is None]
+
+    jobs = getJobs(computeKeys)
+    nComputed = computeEntries(table,jobs,ncpus)
+    #Interpolate the others (or compute them if they can not be interpolated):
+    blocksDict = {}
+    missing = []
+    for key in allKeys:
+        for sqrts in sqrtsList:
+            blocks = table.get(key,sqrts)
+            if blocks is None and not key in computeKeys:
+                blocks = table.interpolate(key,sqrts)
+            if blocks is None:
+                missing.append(key)
+            blocksDict[(key,sqrts)] = blocks
+    jobs = getJobs(set(missing)-computeKeys)
+    if jobs:
+        nComputed += computeEntries(table,jobs,ncpus)
+        for key,sqrts,_,_,_ in jobs:
+            blocksDict[(key,sqrts)] = table.get(key,sqrts)
+
+    texts = {}
+    for key in allKeys:
+        blocks = []
+        for sqrts in sqrtsList:
+            blocks += blocksDict[(key,sqrts)] or []
+        texts[key] = formatBlocks(blocks)
+    nMissing = len([b for b in blocksDict.values() if b is None])
+    nInterpolated = len([k for k in blocksDict if not k[0] in computeKeys
+                         and blocksDict[k] is not None and table.get(*k) is None])
+    logger.info("Cross-sections for %i masses: %i computed, %i interpolated, %i missing (table %s)"
+                %(len(allKeys),nComputed,nInterpolated,nMissing,table.tableFile))
+    if nMissing:
+        logger.warning("The cross-sections for %i masses and energies could not be computed" %nMissing)
+
+    return [texts[key] for key in pointKeys]